@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Compares the CPIM codec with the implementation it replaced, which parsed
+the CPIM headers with a regular expression, went through the email package
+for the encapsulated MIME message and used dateutil for the timestamps.
+"""
+
+import re
+import sys
+import timeit
+
+import dateutil.parser
+
+from email.message import Message as EmailMessage
+from email.parser import Parser as EmailParser
+from optparse import OptionParser
+
+from sipsimple.core import SIPURI
+from sipsimple.streams.msrp.chat import ChatIdentity, CPIMHeader, CPIMNamespace, CPIMParserError, CPIMPayload
+from sipsimple.util import ISOTimestamp, MultilingualText
+
+
+def legacy_decode_header(value):
+    return value.decode('utf-8').encode('raw-unicode-escape').decode('unicode-escape')
+
+
+class LegacyCPIMPayload(CPIMPayload):
+    headers_re = re.compile(r'(?:([^:]+?)\.)?(.+?):\s*(.+?)(?:\r\n|$)')
+
+    def encode(self):
+        namespaces = {u'': CPIMNamespace(self.standard_namespace)}
+        header_list = []
+
+        if self.sender is not None:
+            header_list.append(u'From: {}'.format(self.sender))
+        header_list.extend(u'To: {}'.format(recipient) for recipient in self.recipients)
+        header_list.extend(u'cc: {}'.format(recipient) for recipient in self.courtesy_recipients)
+        if self.subject is not None:
+            header_list.append(u'Subject: {}'.format(self.subject))
+            header_list.extend(u'Subject:;lang={} {}'.format(language, translation) for language, translation in self.subject.translations.iteritems())
+        if self.timestamp is not None:
+            header_list.append(u'DateTime: {}'.format(self.timestamp))
+        if self.required:
+            header_list.append(u'Required: {}'.format(','.join(self.required)))
+
+        for header in self.additional_headers:
+            if namespaces.get(header.namespace.prefix) != header.namespace:
+                if header.namespace.prefix:
+                    header_list.append(u'NS: {0.namespace.prefix} <{0.namespace}>'.format(header))
+                else:
+                    header_list.append(u'NS: <{0.namespace}>'.format(header))
+                namespaces[header.namespace.prefix] = header.namespace
+            if header.namespace.prefix:
+                header_list.append(u'{0.namespace.prefix}.{0.name}: {0.value}'.format(header))
+            else:
+                header_list.append(u'{0.name}: {0.value}'.format(header))
+
+        headers = '\r\n'.join(header.encode('cpim-header') for header in header_list)
+
+        mime_message = EmailMessage()
+        mime_message.set_payload(self.content)
+        mime_message.set_type(self.content_type)
+        if self.charset is not None:
+            mime_message.set_param('charset', self.charset)
+
+        return headers + '\r\n\r\n' + mime_message.as_string(), 'message/cpim'
+
+    @classmethod
+    def decode(cls, message):
+        headers, separator, body = message.partition('\r\n\r\n')
+        if not separator:
+            raise CPIMParserError('Invalid CPIM message')
+
+        sender = None
+        recipients = []
+        courtesy_recipients = []
+        subject = None
+        timestamp = None
+        required = []
+        additional_headers = []
+
+        namespaces = {u'': CPIMNamespace(cls.standard_namespace)}
+        subjects = {}
+
+        for prefix, name, value in cls.headers_re.findall(headers):
+            namespace = namespaces.get(prefix)
+
+            if namespace is None or '.' in name:
+                continue
+
+            try:
+                value = legacy_decode_header(value)
+                if namespace == cls.standard_namespace:
+                    if name == 'From':
+                        sender = ChatIdentity.parse(value)
+                    elif name == 'To':
+                        recipients.append(ChatIdentity.parse(value))
+                    elif name == 'cc':
+                        courtesy_recipients.append(ChatIdentity.parse(value))
+                    elif name == 'Subject':
+                        match = cls.subject_re.match(value)
+                        if match is None:
+                            raise ValueError('Illegal Subject header: %r' % value)
+                        lang, subject = match.groups()
+                        subjects[str(lang) if lang is not None else None] = subject
+                    elif name == 'DateTime':
+                        timestamp = ISOTimestamp(dateutil.parser.parse(value))
+                    elif name == 'Required':
+                        required.extend(re.split(r'\s*,\s*', value))
+                    elif name == 'NS':
+                        match = cls.namespace_re.match(value)
+                        if match is None:
+                            raise ValueError('Illegal NS header: %r' % value)
+                        prefix, uri = match.groups()
+                        namespaces[prefix] = CPIMNamespace(uri, prefix)
+                    else:
+                        additional_headers.append(CPIMHeader(name, namespace, value))
+                else:
+                    additional_headers.append(CPIMHeader(name, namespace, value))
+            except ValueError:
+                pass
+
+        if None in subjects:
+            subject = MultilingualText(subjects.pop(None), **subjects)
+        elif subjects:
+            subject = MultilingualText(**subjects)
+
+        mime_message = EmailParser().parsestr(body)
+        content_type = mime_message.get_content_type()
+        if content_type is None:
+            raise CPIMParserError("CPIM message missing Content-Type MIME header")
+        content = mime_message.get_payload()
+        charset = mime_message.get_content_charset()
+
+        return cls(content, content_type, charset, sender, recipients, courtesy_recipients, subject, timestamp, required, additional_headers)
+
+
+def make_payloads(payload_class):
+    sender = ChatIdentity(SIPURI.parse('sip:alice@example.com'), u'Alice')
+    recipient = ChatIdentity(SIPURI.parse('sip:bob@example.com'), u'Bob')
+    timestamp = ISOTimestamp('2026-10-18T10:20:30.123456+02:00')
+    namespace = CPIMNamespace(u'urn:ietf:params:imdn', u'imdn')
+    return dict(
+        short=payload_class('Hello there', 'text/plain', charset='utf-8', sender=sender, recipients=[recipient], timestamp=timestamp),
+        headers=payload_class('Hello there', 'text/plain', charset='utf-8', sender=sender, recipients=[recipient], timestamp=timestamp,
+                              subject=MultilingualText(u'Greetings', ro=u'Salut'), required=['imdn'],
+                              additional_headers=[CPIMHeader(u'Message-ID', namespace, u'a1b2c3d4'), CPIMHeader(u'Disposition-Notification', namespace, u'positive-delivery, display')]),
+        long=payload_class('<p>%s</p>' % ('Lorem ipsum dolor sit amet. ' * 500), 'text/html', charset='utf-8', sender=sender, recipients=[recipient], timestamp=timestamp))
+
+
+def summary(payload):
+    return (payload.content, payload.content_type, payload.charset, unicode(payload.sender), [unicode(item) for item in payload.recipients], payload.timestamp,
+            unicode(payload.subject) if payload.subject is not None else None, payload.required, [(item.namespace, item.name, item.value) for item in payload.additional_headers])
+
+
+def measure(function, number, repeat):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-n', '--number', type='int', default=2000, help='the number of operations in each measurement (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=5, help='the number of measurements of which the best one is kept (default %default)')
+    options, args = parser.parse_args()
+
+    print '%-10s %-8s %12s %12s %8s' % ('payload', 'codec', 'legacy (us)', 'current (us)', 'speedup')
+    legacy_payloads = make_payloads(LegacyCPIMPayload)
+    for name, payload in sorted(make_payloads(CPIMPayload).iteritems()):
+        legacy_payload = legacy_payloads[name]
+        legacy_message, content_type = legacy_payload.encode()
+        current_message, content_type = payload.encode()
+        if summary(LegacyCPIMPayload.decode(legacy_message)) != summary(CPIMPayload.decode(current_message)):
+            print >>sys.stderr, 'the codecs do not agree on the %s payload' % name
+            sys.exit(1)
+        if summary(LegacyCPIMPayload.decode(current_message)) != summary(CPIMPayload.decode(current_message)):
+            print >>sys.stderr, 'the decoders do not agree on the %s payload' % name
+            sys.exit(1)
+        for codec, legacy, current in (('encode', legacy_payload.encode, payload.encode),
+                                       ('decode', lambda: LegacyCPIMPayload.decode(current_message), lambda: CPIMPayload.decode(current_message))):
+            legacy_time = measure(legacy, options.number, options.repeat)
+            current_time = measure(current, options.number, options.repeat)
+            print '%-10s %-8s %12.2f %12.2f %7.1fx' % (name, codec, legacy_time, current_time, legacy_time / current_time)
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Compares the engine loop which is woken up as soon as other threads need
+it with the loop it replaced, which polled for events every 100ms. It
+measures how late the timeouts of requests sent from another thread fire
+and the CPU time used by an idle engine. The old loop is reproduced by
+starting the engine without the wake-up socket and with an idle timeout of
+100ms. Each loop runs in a separate process, as the engine can only be
+started once.
+"""
+
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from optparse import OptionParser
+from threading import Event
+from zope.interface import implements
+
+from sipsimple.core import Engine, FromHeader, Message, RouteHeader, SIPURI, ToHeader
+
+
+loops = {'wakeup': dict(wakeup=True, idle_timeout=5.0),
+         'polling': dict(wakeup=False, idle_timeout=0.1)}
+
+
+class EngineObserver(object):
+    implements(IObserver)
+
+    def __init__(self):
+        self.started = Event()
+        self.finished = Event()
+        self.finish_time = None
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPEngineDidStart(self, notification):
+        self.started.set()
+
+    def _NH_SIPEngineDidFail(self, notification):
+        self.started.set()
+
+    def _NH_SIPMessageDidFail(self, notification):
+        self.finish_time = time.time()
+        self.finished.set()
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def measure_idle(duration):
+    start_time, start_cpu = time.time(), cpu_time()
+    time.sleep(duration)
+    return (cpu_time() - start_cpu) / (time.time() - start_time)
+
+
+def measure_timeouts(engine, observer, count):
+    # the requests are sent to a socket which never answers them, so they end when their timeout fires
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    uri = SIPURI(user='benchmark', host='127.0.0.1', port=engine.udp_port)
+    route = SIPURI(host='127.0.0.1', port=sink.getsockname()[1])
+    delays = []
+    try:
+        for index in xrange(count):
+            # send at a random point while the engine waits for events
+            time.sleep(random.uniform(0, 0.2))
+            timeout = random.uniform(0.05, 0.3)
+            observer.finished.clear()
+            start_time = time.time()
+            Message(FromHeader(uri), ToHeader(uri), RouteHeader(route), 'text/plain', 'message %d' % index).send(timeout=timeout)
+            observer.finished.wait()
+            delays.append(observer.finish_time - start_time - timeout)
+    finally:
+        sink.close()
+    return delays
+
+
+def run_loop(loop, options):
+    engine = Engine()
+    observer = EngineObserver()
+    notification_center = NotificationCenter()
+    notification_center.add_observer(observer, sender=engine)
+    notification_center.add_observer(observer, name='SIPMessageDidFail')
+    engine.start(ip_address='127.0.0.1', udp_port=0, tcp_port=None, tls_port=None, **loops[loop])
+    observer.started.wait()
+    if not engine.is_running:
+        raise RuntimeError('the engine failed to start')
+    try:
+        idle_cpu = measure_idle(options.idle)
+        delays = sorted(measure_timeouts(engine, observer, options.requests))
+    finally:
+        notification_center.remove_observer(observer, name='SIPMessageDidFail')
+        notification_center.remove_observer(observer, sender=engine)
+        engine.stop()
+        engine.join()
+    print idle_cpu, sum(delays) / len(delays), delays[len(delays) // 2], delays[int(len(delays) * 0.95)], delays[-1]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-i', '--idle', type='float', default=10, help='the number of seconds the idle engine is measured for (default %default)')
+    parser.add_option('-n', '--requests', type='int', default=100, help='the number of request timeouts that are measured (default %default)')
+    parser.add_option('--loop', type='choice', choices=sorted(loops), help='measure only the given loop in this process')
+    options, args = parser.parse_args()
+
+    if options.loop is not None:
+        run_loop(options.loop, options)
+        return
+
+    print '%-8s %16s %20s %20s %20s %20s' % ('loop', 'idle cpu (ms/s)', 'mean late (ms)', 'median late (ms)', '95% late (ms)', 'max late (ms)')
+    for loop in ('polling', 'wakeup'):
+        output = subprocess.check_output([sys.executable, __file__, '--loop', loop, '--idle', str(options.idle), '--requests', str(options.requests)])
+        idle_cpu, mean, median, percentile, maximum = (float(value) for value in output.split()[-5:])
+        print '%-8s %16.3f %20.1f %20.1f %20.1f %20.1f' % (loop, idle_cpu * 1000, mean * 1000, median * 1000, percentile * 1000, maximum * 1000)
+
+
+if __name__ == '__main__':
+    main()
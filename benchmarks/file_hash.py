@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Compares the hashing of the files sent by outgoing file transfers with the
+implementation it replaced, which hashed each file with hashlib in small
+reads every time it was sent, and measures how long it takes to find the
+hash of a file that was already sent in the persistent hash index.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from optparse import OptionParser
+from threading import Thread
+
+from sipsimple.streams.msrp.filetransfer import FileHashIndex, OutgoingFileTransferHandler
+from sipsimple.threading import ThreadManager
+from sipsimple.util import sha1
+
+
+def legacy_hash(path):
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            content = f.read(OutgoingFileTransferHandler.file_part_size)
+            if not content:
+                break
+            file_hash.update(content)
+    return file_hash.hexdigest()
+
+
+def current_hash(path):
+    file_hash = sha1()
+    with open(path, 'rb') as f:
+        while True:
+            content = f.read(OutgoingFileTransferHandler.hash_block_size)
+            if not content:
+                break
+            file_hash.update(content)
+    return file_hash.hexdigest()
+
+
+def hash_files(function, paths, parallel):
+    results = {}
+    def run(path):
+        results[path] = function(path)
+    start_time = time.time()
+    if parallel:
+        threads = [Thread(target=run, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for path in paths:
+            run(path)
+    return time.time() - start_time, results
+
+
+def lookup_files(directory, paths):
+    # a new index, as after a restart of the application, which has to load the index file first
+    hash_index = FileHashIndex()
+    hash_index.directory = directory
+    start_time = time.time()
+    results = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            entry = hash_index.get(hash_index.key_for(path, f))
+        results[path] = entry.hash.hexdigest()
+    return time.time() - start_time, results
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-f', '--files', type='int', default=4, help='the number of files that are hashed (default %default)')
+    parser.add_option('-s', '--file-size', type='int', default=64*1024*1024, help='the size of each file in bytes (default %default)')
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='sipsimple-benchmark-')
+    try:
+        paths = []
+        block = os.urandom(1024*1024)
+        for index in range(options.files):
+            path = os.path.join(directory, 'file-%d' % index)
+            with open(path, 'wb') as f:
+                for offset in xrange(0, options.file_size, len(block)):
+                    f.write(block[:options.file_size-offset])
+            paths.append(path)
+
+        hash_index = FileHashIndex()
+        hash_index.directory = directory
+        for path in paths:
+            file_hash = sha1()
+            with open(path, 'rb') as f:
+                file_hash.update(f.read())
+                hash_index.update(hash_index.key_for(path, f), options.file_size, file_hash)
+        ThreadManager().stop()  # wait for the index to be written
+
+        total_size = float(options.files * options.file_size) / 1024 / 1024
+        print '%-32s %10s %18s' % ('method', 'time (s)', 'throughput (MB/s)')
+        expected = None
+        for name, function in (('legacy, sequential', lambda: hash_files(legacy_hash, paths, False)),
+                               ('legacy, parallel', lambda: hash_files(legacy_hash, paths, True)),
+                               ('current, sequential', lambda: hash_files(current_hash, paths, False)),
+                               ('current, parallel', lambda: hash_files(current_hash, paths, True)),
+                               ('current, index lookup', lambda: lookup_files(directory, paths))):
+            duration, results = function()
+            if expected is None:
+                expected = results
+            elif results != expected:
+                raise RuntimeError('%s computed different hashes' % name)
+            print '%-32s %10.4f %18.1f' % (name, duration, total_size / duration if duration > 0 else float('inf'))
+    finally:
+        ThreadManager().stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Compares the outgoing file transfer with and without the send window, by
+pushing a file through a simulated link with a given bandwidth and round
+trip time. Without the window, which is how the sender worked before, all
+the file is queued for the link as fast as it can be read.
+"""
+
+import heapq
+import time
+
+from optparse import OptionParser
+from Queue import Queue
+from threading import Condition, Thread
+
+from sipsimple.streams.msrp.filetransfer import OutgoingFileTransferHandler, SendWindow
+
+
+class UnboundedWindow(object):
+    def __init__(self):
+        self.in_flight = 0
+        self._condition = Condition()
+
+    def acquire(self, amount):
+        with self._condition:
+            self.in_flight += amount
+            return True
+
+    def release(self, amount):
+        with self._condition:
+            self.in_flight -= amount
+
+
+class Link(object):
+    """Sends the chunks one after another at the given bandwidth and answers each of them after the round trip time"""
+
+    def __init__(self, window, bandwidth, rtt):
+        self.window = window
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.acknowledged = 0
+        self.peak_in_flight = 0
+        self._chunks = Queue()
+        self._responses = []
+        self._condition = Condition()
+        self._threads = [Thread(target=self._send_chunks), Thread(target=self._answer_chunks)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def send(self, size):
+        self.peak_in_flight = max(self.peak_in_flight, self.window.in_flight)
+        self._chunks.put(size)
+
+    def close(self):
+        self._chunks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _send_chunks(self):
+        while True:
+            size = self._chunks.get()
+            if size is not None:
+                time.sleep(float(size) / self.bandwidth)
+            with self._condition:
+                if size is not None:
+                    heapq.heappush(self._responses, (time.time() + self.rtt, size))
+                else:
+                    heapq.heappush(self._responses, (float('inf'), None))
+                self._condition.notify()
+            if size is None:
+                break
+
+    def _answer_chunks(self):
+        while True:
+            with self._condition:
+                while not self._responses:
+                    self._condition.wait()
+                due, size = self._responses[0]
+                if size is None and len(self._responses) == 1:
+                    break
+                delay = due - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._responses)
+            self.window.release(size)
+            self.acknowledged += size
+
+
+def transfer(window, file_size, part_size, bandwidth, rtt):
+    link = Link(window, bandwidth, rtt)
+    start_time = time.time()
+    for offset in xrange(0, file_size, part_size):
+        size = min(part_size, file_size - offset)
+        window.acquire(size)
+        link.send(size)
+    link.close()
+    duration = time.time() - start_time
+    return link.peak_in_flight, duration, link.acknowledged / duration
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-f', '--file-size', type='int', default=32*1024*1024, help='the size of the transferred file in bytes (default %default)')
+    parser.add_option('-b', '--bandwidth', type='float', default=50*1024*1024, help='the bandwidth of the link in bytes per second (default %default)')
+    parser.add_option('-t', '--rtt', type='float', default=0.02, help='the round trip time of the link in seconds (default %default)')
+    parser.add_option('-w', '--window-size', type='int', default=OutgoingFileTransferHandler.send_window_size, help='the size of the send window in bytes (default %default)')
+    options, args = parser.parse_args()
+
+    part_size = OutgoingFileTransferHandler.file_part_size
+    print '%-10s %19s %10s %18s' % ('sender', 'peak in flight (KB)', 'time (s)', 'throughput (MB/s)')
+    for name, window in (('unbounded', UnboundedWindow()), ('window', SendWindow(options.window_size))):
+        peak_in_flight, duration, throughput = transfer(window, options.file_size, part_size, options.bandwidth, options.rtt)
+        print '%-10s %19d %10.2f %18.2f' % (name, peak_in_flight // 1024, duration, throughput / 1024 / 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Compares the memory retained and the time spent by the MSRP trace logger
+while chunks are in flight with the implementation it replaced, which
+captured every chunk in full by string concatenation, whether tracing was
+enabled or not.
+"""
+
+import timeit
+
+from application.notification import NotificationCenter, NotificationData
+from optparse import OptionParser
+
+from sipsimple.streams.msrp import ChunkInfo, NotificationProxyLogger
+
+
+class LegacyNotificationProxyLogger(NotificationProxyLogger):
+    def received_new_chunk(self, data, transport, chunk):
+        self.chunks[chunk.transaction_id] = ChunkInfo(chunk.content_type, header=data)
+
+    def received_chunk_data(self, data, transport, transaction_id):
+        self.chunks[transaction_id].data += data
+
+    def received_chunk_end(self, data, transport, transaction_id):
+        chunk_info = self.chunks.pop(transaction_id)
+        chunk_info.footer = data
+        if self.log_settings.trace_msrp:
+            notification_data = NotificationData(direction='incoming', local_address=transport.getHost(), remote_address=transport.getPeer(), data=chunk_info.normalized_content)
+            self.notification_center.post_notification('MSRPTransportTrace', sender=transport, data=notification_data)
+
+
+class LogSettings(object):
+    def __init__(self, trace_msrp):
+        self.trace_msrp = trace_msrp
+
+
+class Transport(object):
+    def getHost(self):
+        return '127.0.0.1:2855'
+
+    def getPeer(self):
+        return '127.0.0.1:2856'
+
+
+class Chunk(object):
+    def __init__(self, transaction_id, content_type):
+        self.transaction_id = transaction_id
+        self.content_type = content_type
+
+
+def make_logger(logger_class, trace_msrp):
+    # the settings are replaced so that the configuration framework doesn't need to be started
+    logger = logger_class.__new__(logger_class)
+    logger.chunks = {}
+    logger.notification_center = NotificationCenter()
+    logger.log_settings = LogSettings(trace_msrp)
+    return logger
+
+
+def retained_bytes(logger):
+    return sum(len(chunk_info.data) + sum(len(part) for part in chunk_info._parts) for chunk_info in logger.chunks.itervalues())
+
+
+def receive_chunks(logger, content_type, chunk_count, chunk_size, piece_size):
+    # feeds the chunks to the logger the way msrplib does and returns the peak of the retained payload
+    transport = Transport()
+    piece = 'x' * piece_size
+    peak = 0
+    for index in xrange(chunk_count):
+        chunk = Chunk('t%d' % index, content_type)
+        logger.received_new_chunk('MSRP t%d SEND\r\nContent-Type: %s\r\n\r\n' % (index, content_type), transport, chunk)
+        for offset in xrange(0, chunk_size, piece_size):
+            logger.received_chunk_data(piece, transport, chunk.transaction_id)
+        peak = max(peak, retained_bytes(logger))
+        logger.received_chunk_end('\r\n-------t%d$\r\n' % index, transport, chunk.transaction_id)
+    return peak
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-c', '--chunks', type='int', default=20, help='the number of chunks in each measurement (default %default)')
+    parser.add_option('-s', '--chunk-size', type='int', default=2*1024*1024, help='the size of each chunk in bytes (default %default)')
+    parser.add_option('-p', '--piece-size', type='int', default=16384, help='the size of the data pieces the chunks arrive in (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='the number of measurements of which the best one is kept (default %default)')
+    options, args = parser.parse_args()
+
+    print '%-26s %-6s %-8s %14s %14s' % ('content type', 'trace', 'logger', 'retained (KB)', 'per chunk (ms)')
+    for content_type in ('text/plain', 'application/octet-stream'):
+        for trace_msrp in (False, True):
+            for name, logger_class in (('legacy', LegacyNotificationProxyLogger), ('current', NotificationProxyLogger)):
+                logger = make_logger(logger_class, trace_msrp)
+                peak = receive_chunks(logger, content_type, 1, options.chunk_size, options.piece_size)
+                duration = min(timeit.repeat(lambda: receive_chunks(logger, content_type, options.chunks, options.chunk_size, options.piece_size), number=1, repeat=options.repeat))
+                print '%-26s %-6s %-8s %14d %14.3f' % (content_type, 'on' if trace_msrp else 'off', name, peak // 1024, duration / options.chunks * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Compares building large buddy lists with the implementation of the XML
+element insertion it replaced, which looked for the position of every new
+child by indexing all the existing children from the start, and which
+inserted the items passed to update one by one.
+"""
+
+import sys
+import time
+
+from optparse import OptionParser
+
+from sipsimple.payloads import XMLElement, XMLListMixin
+from sipsimple.payloads import resourcelists
+
+
+def legacy_insert_element(self, element):
+    if element in self.element:
+        return
+    order = self._xml_children_order.get(element.tag, self._xml_children_order.get(None, sys.maxint))
+    for i in xrange(len(self.element)):
+        child_order = self._xml_children_order.get(self.element[i].tag, self._xml_children_order.get(None, sys.maxint))
+        if child_order > order:
+            position = i
+            break
+    else:
+        position = len(self.element)
+    self.element.insert(position, element)
+
+
+def legacy_update(self, sequence):
+    for item in sequence:
+        self.add(item)
+
+
+class LegacyInsertion(object):
+    """Replaces the current insertion of child elements with the legacy one while active"""
+
+    def __enter__(self):
+        self.saved = XMLElement._insert_element, XMLListMixin.update
+        XMLElement._insert_element = legacy_insert_element
+        XMLListMixin.update = legacy_update
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        XMLElement._insert_element, XMLListMixin.update = self.saved
+
+
+class CurrentInsertion(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def make_entries(count):
+    return [resourcelists.Entry('sip:buddy%d@example.com' % index, display_name='Buddy %d' % index) for index in xrange(count)]
+
+
+def build_with_update(count):
+    # the entries are passed to the constructor of the list, which adds them with update
+    entries = make_entries(count)
+    start_time = time.time()
+    buddies = resourcelists.List(entries, name='buddies')
+    return time.time() - start_time, buddies
+
+
+def build_with_add(count):
+    entries = make_entries(count)
+    start_time = time.time()
+    buddies = resourcelists.List(name='buddies')
+    for entry in entries:
+        buddies.add(entry)
+    return time.time() - start_time, buddies
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-c', '--counts', default='500,1000,2000', help='comma separated sizes of the buddy lists (default %default)')
+    options, args = parser.parse_args()
+
+    counts = [int(count) for count in options.counts.split(',')]
+    print '%-8s %-8s %-8s %10s' % ('entries', 'method', 'insert', 'time (s)')
+    for count in counts:
+        for method, build in (('update', build_with_update), ('add', build_with_add)):
+            documents = []
+            for insertion, context in (('legacy', LegacyInsertion()), ('current', CurrentInsertion())):
+                with context:
+                    duration, buddies = build(count)
+                documents.append(resourcelists.ResourceLists([buddies]).toxml())
+                print '%-8d %-8s %-8s %10.3f' % (count, method, insertion, duration)
+            if documents[0] != documents[1]:
+                raise RuntimeError('the legacy and the current insertion built different documents')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Compares the lazy conversion of the headers of incoming SIP messages with
+the eager conversion it replaced, which is still available through the
+eager_headers option of the engine. The engine sends MESSAGE requests with
+a number of extra headers to itself and the observer of the incoming
+messages only looks at a few of their headers, as most consumers do.
+
+Besides the time spent for each message, the script counts the objects
+allocated for each message by keeping the data of the incoming messages
+alive and comparing the number of objects tracked by the garbage collector
+before and after they arrive.
+"""
+
+import gc
+import time
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from optparse import OptionParser
+from threading import Event, Semaphore
+from zope.interface import implements
+
+from sipsimple.core import Engine, FromHeader, Header, Message, RouteHeader, SIPURI, ToHeader
+
+
+class MessageReceiver(object):
+    implements(IObserver)
+
+    def __init__(self, window):
+        self.window = Semaphore(window)
+        self.started = Event()
+        self.received = 0
+        self.kept_data = None
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPEngineDidStart(self, notification):
+        self.started.set()
+
+    def _NH_SIPEngineDidFail(self, notification):
+        self.started.set()
+
+    def _NH_SIPEngineGotMessage(self, notification):
+        headers = notification.data.headers
+        headers['From'], headers['To'], headers['Call-ID']
+        if self.kept_data is not None:
+            self.kept_data.append(notification.data)
+        self.received += 1
+        self.window.release()
+
+
+def send_messages(engine, receiver, count, header_count):
+    uri = SIPURI(user='benchmark', host='127.0.0.1', port=engine.udp_port)
+    extra_headers = [Header('X-Benchmark-%d' % index, 'value %d' % index) for index in range(header_count)]
+    receiver.received = 0
+    start_time, start_clock = time.time(), time.clock()
+    for index in xrange(count):
+        receiver.window.acquire()
+        Message(FromHeader(uri), ToHeader(uri), RouteHeader(uri), 'text/plain', 'message %d' % index, extra_headers=extra_headers).send()
+    while receiver.received < count:
+        time.sleep(0.001)
+    return time.time() - start_time, time.clock() - start_clock
+
+
+def count_objects(engine, receiver, count, header_count):
+    receiver.kept_data = []
+    gc.collect()
+    objects = len(gc.get_objects())
+    try:
+        send_messages(engine, receiver, count, header_count)
+        gc.collect()
+        return float(len(gc.get_objects()) - objects) / count
+    finally:
+        receiver.kept_data = None
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-c', '--count', type='int', default=2000, help='the number of messages in each measurement (default %default)')
+    parser.add_option('-w', '--window', type='int', default=20, help='the number of messages that can be in flight (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='the number of measurements of which the best one is kept (default %default)')
+    options, args = parser.parse_args()
+
+    engine = Engine()
+    receiver = MessageReceiver(options.window)
+    notification_center = NotificationCenter()
+    notification_center.add_observer(receiver, sender=engine)
+    # the messages are sent to the engine itself, which would otherwise be detected as a loop
+    engine.start(ip_address='127.0.0.1', udp_port=0, tcp_port=None, tls_port=None, detect_sip_loops=False)
+    receiver.started.wait()
+    if not engine.is_running:
+        raise RuntimeError('the engine failed to start')
+
+    try:
+        print '%-8s %8s %16s %16s %18s' % ('headers', 'mode', 'wall (us/msg)', 'cpu (us/msg)', 'objects (per msg)')
+        for header_count in (0, 10, 30):
+            for mode, eager in (('eager', True), ('lazy', False)):
+                engine.eager_headers = eager
+                send_messages(engine, receiver, options.window, header_count)  # warm up
+                wall, cpu = min(send_messages(engine, receiver, options.count, header_count) for repeat in range(options.repeat))
+                objects = count_objects(engine, receiver, options.count, header_count)
+                print '%-8d %8s %16.1f %16.1f %18.1f' % (header_count, mode, wall / options.count * 1e6, cpu / options.count * 1e6, objects)
+    finally:
+        notification_center.remove_observer(receiver, sender=engine)
+        engine.stop()
+        engine.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Compares the parsing of the bundled XML payloads with the implementation it
+replaced, which validated each document twice, once while parsing it and
+once more after, and built all the child elements upfront. The current
+parser is measured with validation, without validation and with the child
+elements built lazily.
+"""
+
+import timeit
+
+from lxml import etree
+from optparse import OptionParser
+
+from sipsimple.payloads.conference import ConferenceDocument
+from sipsimple.payloads.dialoginfo import DialogInfoDocument
+from sipsimple.payloads.pidf import PIDFDocument
+from sipsimple.payloads.rlmi import RLMIDocument
+from sipsimple.payloads.watcherinfo import WatcherInfoDocument
+from sipsimple.payloads import rpid  # needed to register the RPID extensions with PIDF
+
+
+def make_pidf(count):
+    tuples = ''.join('<tuple id="t%d"><status><basic>open</basic></status><contact priority="0.8">sip:alice@10.0.0.%d</contact>'
+                     '<note>Available</note><timestamp>2026-10-18T10:20:30Z</timestamp></tuple>' % (index, index % 250) for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="sip:alice@example.com">%s</presence>' % tuples)
+
+
+def make_rpid(count):
+    tuples = ''.join('<tuple id="t%d"><status><basic>open</basic></status><rpid:user-input>active</rpid:user-input>'
+                     '<contact>sip:alice@10.0.0.%d</contact></tuple>' % (index, index % 250) for index in range(count))
+    persons = ''.join('<dm:person id="p%d"><rpid:activities><rpid:busy/></rpid:activities><rpid:mood><rpid:happy/></rpid:mood>'
+                      '<rpid:sphere><rpid:work/></rpid:sphere><dm:note>In a meeting</dm:note><dm:timestamp>2026-10-18T10:20:30Z</dm:timestamp></dm:person>'
+                      % index for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<presence xmlns="urn:ietf:params:xml:ns:pidf" xmlns:dm="urn:ietf:params:xml:ns:pidf:data-model" '
+            'xmlns:rpid="urn:ietf:params:xml:ns:pidf:rpid" entity="sip:alice@example.com">%s%s</presence>' % (tuples, persons))
+
+
+def make_rlmi(count):
+    resources = ''.join('<resource uri="sip:buddy%d@example.com"><name>Buddy %d</name><instance id="i%d" state="active" cid="c%d@example.com"/></resource>'
+                        % (index, index, index, index) for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<list xmlns="urn:ietf:params:xml:ns:rlmi" uri="sip:buddies@example.com" version="1" fullState="true">%s</list>' % resources)
+
+
+def make_watcherinfo(count):
+    watchers = ''.join('<watcher id="w%d" event="subscribe" status="active" display-name="Watcher %d">sip:watcher%d@example.com</watcher>'
+                       % (index, index, index) for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<watcherinfo xmlns="urn:ietf:params:xml:ns:watcherinfo" version="0" state="full">'
+            '<watcher-list resource="sip:alice@example.com" package="presence">%s</watcher-list></watcherinfo>' % watchers)
+
+
+def make_dialoginfo(count):
+    dialogs = ''.join('<dialog id="d%d" call-id="call%d" local-tag="l%d" remote-tag="r%d" direction="initiator"><state>confirmed</state>'
+                      '<duration>%d</duration><local><identity>sip:alice@example.com</identity></local>'
+                      '<remote><identity display="Buddy %d">sip:buddy%d@example.com</identity></remote></dialog>'
+                      % (index, index, index, index, index, index, index) for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<dialog-info xmlns="urn:ietf:params:xml:ns:dialog-info" version="1" state="full" entity="sip:alice@example.com">%s</dialog-info>' % dialogs)
+
+
+def make_conference(count):
+    users = ''.join('<user entity="sip:user%d@example.com" state="full"><display-text>User %d</display-text>'
+                    '<endpoint entity="sip:user%d@10.0.0.%d" state="full"><status>connected</status>'
+                    '<media id="m%d"><type>audio</type><status>sendrecv</status></media></endpoint></user>'
+                    % (index, index, index, index % 250, index) for index in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<conference-info xmlns="urn:ietf:params:xml:ns:conference-info" entity="sip:conference@example.com" state="full" version="1">'
+            '<conference-description><display-text>Conference</display-text></conference-description><users>%s</users></conference-info>' % users)
+
+
+payloads = [('pidf', PIDFDocument, make_pidf),
+            ('rpid', PIDFDocument, make_rpid),
+            ('rlmi', RLMIDocument, make_rlmi),
+            ('watcherinfo', WatcherInfoDocument, make_watcherinfo),
+            ('dialoginfo', DialogInfoDocument, make_dialoginfo),
+            ('conference', ConferenceDocument, make_conference)]
+
+
+def legacy_parse(document_class, document):
+    xml = etree.XML(document, parser=document_class.parser)
+    if document_class.schema is not None:
+        document_class.schema.assertValid(xml)
+    return document_class.root_element.from_element(xml, xml_document=document_class)
+
+
+modes = [('legacy', legacy_parse),
+         ('validated', lambda document_class, document: document_class.parse(document)),
+         ('unvalidated', lambda document_class, document: document_class.parse(document, validate=False)),
+         ('lazy', lambda document_class, document: document_class.parse(document, lazy=True)),
+         ('lazy unvalidated', lambda document_class, document: document_class.parse(document, validate=False, lazy=True))]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip())
+    parser.add_option('-c', '--count', type='int', default=50, help='the number of items in each document (default %default)')
+    parser.add_option('-n', '--number', type='int', default=200, help='the number of parses in each measurement (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='the number of measurements of which the best one is kept (default %default)')
+    options, args = parser.parse_args()
+
+    print '%-12s %8s' % ('payload', 'size') + ''.join(' %22s' % ('%s (us)' % name) for name, function in modes)
+    for name, document_class, make_document in payloads:
+        document = make_document(options.count)
+        results = []
+        for mode, function in modes:
+            function(document_class, document)  # make sure the document is valid before measuring it
+            results.append(min(timeit.repeat(lambda: function(document_class, document), number=options.number, repeat=options.repeat)) / options.number * 1e6)
+        print '%-12s %8d' % (name, len(document)) + ''.join(' %22.1f' % result for result in results)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,9 +31,6 @@ from sipsimple.configuration.datatypes import AudioCodecList, MSRPConnectionMode
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.payloads import ParserError
 from sipsimple.payloads.messagesummary import MessageSummary
-from sipsimple.payloads.pidf import PIDFDocument
-from sipsimple.payloads.rlsnotify import RLSNotify
-from sipsimple.payloads.watcherinfo import WatcherInfoDocument
 from sipsimple.threading import call_in_thread
 from sipsimple.threading.green import call_in_green_thread, run_in_green_thread
 from sipsimple.util import user_info
@@ -347,11 +344,11 @@ class Account(SettingsObject):
                 notification.center.post_notification('SIPAccountGotMessageSummary', sender=self, data=NotificationData(message_summary=message_summary))
 
     def _NH_PresenceWinfoSubscriptionGotNotify(self, notification):
-        if notification.data.body and notification.data.content_type == WatcherInfoDocument.content_type:
+        watcher_info = notification.data.document
+        if watcher_info is not None:
             try:
-                watcher_info = WatcherInfoDocument.parse(notification.data.body)
                 watcher_list = watcher_info['sip:' + self.id]
-            except (ParserError, KeyError):
+            except KeyError:
                 pass
             else:
                 if watcher_list.package != 'presence':
@@ -374,11 +371,11 @@ class Account(SettingsObject):
         self._pwi_version = None
 
     def _NH_DialogWinfoSubscriptionGotNotify(self, notification):
-        if notification.data.body and notification.data.content_type == WatcherInfoDocument.content_type:
+        watcher_info = notification.data.document
+        if watcher_info is not None:
             try:
-                watcher_info = WatcherInfoDocument.parse(notification.data.body)
                 watcher_list = watcher_info['sip:' + self.id]
-            except (ParserError, KeyError):
+            except KeyError:
                 pass
             else:
                 if watcher_list.package != 'dialog':
@@ -401,24 +398,20 @@ class Account(SettingsObject):
         self._dwi_version = None
 
     def _NH_PresenceSubscriptionGotNotify(self, notification):
-        if notification.data.body and notification.data.content_type == RLSNotify.content_type:
-            try:
-                rls_notify = RLSNotify.parse('{content_type}\r\n\r\n{body}'.format(content_type=notification.data.headers['Content-Type'], body=notification.data.body))
-            except ParserError:
-                pass
-            else:
-                if rls_notify.uri != self.xcap_manager.rls_presence_uri:
-                    return
-                if self._presence_version is None:
-                    if not rls_notify.full_state:
-                        self._presence_subscriber.resubscribe()
-                elif rls_notify.version <= self._presence_version:
-                    return
-                elif not rls_notify.full_state and rls_notify.version > self._presence_version + 1:
+        rls_notify = notification.data.document
+        if rls_notify is not None:
+            if rls_notify.uri != self.xcap_manager.rls_presence_uri:
+                return
+            if self._presence_version is None:
+                if not rls_notify.full_state:
                     self._presence_subscriber.resubscribe()
-                self._presence_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
-                notification.center.post_notification('SIPAccountGotPresenceState', sender=self, data=data)
+            elif rls_notify.version <= self._presence_version:
+                return
+            elif not rls_notify.full_state and rls_notify.version > self._presence_version + 1:
+                self._presence_subscriber.resubscribe()
+            self._presence_version = rls_notify.version
+            data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
+            notification.center.post_notification('SIPAccountGotPresenceState', sender=self, data=data)
 
     def _NH_PresenceSubscriptionDidEnd(self, notification):
         self._presence_version = None
@@ -427,35 +420,27 @@ class Account(SettingsObject):
         self._presence_version = None
 
     def _NH_SelfPresenceSubscriptionGotNotify(self, notification):
-        if notification.data.body and notification.data.content_type == PIDFDocument.content_type:
-            try:
-                pidf_doc = PIDFDocument.parse(notification.data.body)
-            except ParserError:
-                pass
-            else:
-                if pidf_doc.entity.partition('sip:')[2] != self.id:
-                    return
-                notification.center.post_notification('SIPAccountGotSelfPresenceState', sender=self, data=NotificationData(pidf=pidf_doc))
+        pidf_doc = notification.data.document
+        if pidf_doc is not None:
+            if pidf_doc.entity.partition('sip:')[2] != self.id:
+                return
+            notification.center.post_notification('SIPAccountGotSelfPresenceState', sender=self, data=NotificationData(pidf=pidf_doc))
 
     def _NH_DialogSubscriptionGotNotify(self, notification):
-        if notification.data.body and notification.data.content_type == RLSNotify.content_type:
-            try:
-                rls_notify = RLSNotify.parse('{content_type}\r\n\r\n{body}'.format(content_type=notification.data.headers['Content-Type'], body=notification.data.body))
-            except ParserError:
-                pass
-            else:
-                if rls_notify.uri != self.xcap_manager.rls_dialog_uri:
-                    return
-                if self._dialog_version is None:
-                    if not rls_notify.full_state:
-                        self._dialog_subscriber.resubscribe()
-                elif rls_notify.version <= self._dialog_version:
-                    return
-                elif not rls_notify.full_state and rls_notify.version > self._dialog_version + 1:
+        rls_notify = notification.data.document
+        if rls_notify is not None:
+            if rls_notify.uri != self.xcap_manager.rls_dialog_uri:
+                return
+            if self._dialog_version is None:
+                if not rls_notify.full_state:
                     self._dialog_subscriber.resubscribe()
-                self._dialog_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
-                notification.center.post_notification('SIPAccountGotDialogState', sender=self, data=data)
+            elif rls_notify.version <= self._dialog_version:
+                return
+            elif not rls_notify.full_state and rls_notify.version > self._dialog_version + 1:
+                self._dialog_subscriber.resubscribe()
+            self._dialog_version = rls_notify.version
+            data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
+            notification.center.post_notification('SIPAccountGotDialogState', sender=self, data=data)
 
     def _NH_DialogSubscriptionDidEnd(self, notification):
         self._dialog_version = None
@@ -744,11 +729,12 @@ class AccountManager(object):
     def start(self):
         """
         Start the accounts, which will determine the ones with the enabled flag
-        set to activate.
+        set to activate. When the application runs as one of several shards,
+        only the accounts assigned to the current shard are started.
         """
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPAccountManagerWillStart', sender=self)
-        proc.waitall([proc.spawn(account.start) for account in self.accounts.itervalues()])
+        proc.waitall([proc.spawn(account.start) for account in self.accounts.itervalues() if self._owns(account)])
         notification_center.post_notification('SIPAccountManagerDidStart', sender=self)
 
     def stop(self):
@@ -776,15 +762,20 @@ class AccountManager(object):
 
     def find_account(self, contact_uri):
         # compare contact_address with account contact
-        exact_matches = (account for account in self.accounts.itervalues() if account.enabled and account.contact.username==contact_uri.user)
+        exact_matches = (account for account in self.accounts.itervalues() if account.enabled and account.contact.username==contact_uri.user and self._owns(account))
         # compare username in contact URI with account username
-        loose_matches = (account for account in self.accounts.itervalues() if account.enabled and account.id.username==contact_uri.user)
+        loose_matches = (account for account in self.accounts.itervalues() if account.enabled and account.id.username==contact_uri.user and self._owns(account))
         return chain(exact_matches, loose_matches, [None]).next()
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
+    def _owns(self, account):
+        from sipsimple.application import SIPApplication
+        shard = SIPApplication.shard
+        return shard is None or shard.owns(account.id)
+
     def _NH_CFGSettingsObjectWasActivated(self, notification):
         if isinstance(notification.sender, Account) or (isinstance(notification.sender, BonjourAccount) and _bonjour.available):
             account = notification.sender
@@ -793,7 +784,7 @@ class AccountManager(object):
             notification.center.add_observer(self, sender=account, name='CFGSettingsObjectWasDeleted')
             notification.center.post_notification('SIPAccountManagerDidAddAccount', sender=self, data=NotificationData(account=account))
             from sipsimple.application import SIPApplication
-            if SIPApplication.running:
+            if SIPApplication.running and self._owns(account):
                 call_in_green_thread(account.start)
 
     def _NH_CFGSettingsObjectWasCreated(self, notification):
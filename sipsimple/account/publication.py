@@ -16,6 +16,7 @@ from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implements
 
+from sipsimple.account.scheduler import RequestScheduler
 from sipsimple.core import FromHeader, Publication, PublicationETagError, RouteHeader, SIPURI, SIPCoreError
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.lookup import DNSLookup, DNSLookupError
@@ -77,6 +78,7 @@ class Publisher(object):
         self._command_channel = coros.queue()
         self._data_channel = coros.queue()
         self._publication = None
+        self._destination = None
         self._dns_wait = 1
         self._publish_wait = 1
         self._publication_timer = None
@@ -214,55 +216,65 @@ class Publisher(object):
             body = None if command.state is SameState else command.state.toxml()
 
             # Publish by trying each route in turn
+            scheduler = RequestScheduler()
             publish_timeout = time() + 30
             for route in routes:
                 remaining_time = publish_timeout-time()
                 if remaining_time > 0:
-                    try:
+                    destination = (route.address, route.port)
+                    with scheduler.request(destination):
+                        # waiting for the scheduler may have used up some of the time
+                        remaining_time = publish_timeout-time()
+                        if remaining_time <= 0:
+                            continue
                         try:
-                            self._publication.publish(body, RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
-                        except ValueError as e:  # this happens for an initial PUBLISH with body=None
-                            raise PublicationError(str(e), retry_after=0)
-                        except PublicationETagError:
-                            state = self.state # access self.state only once to avoid race conditions
-                            if state is not None:
-                                self._publication.publish(state.toxml(), RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
-                            else:
-                                command.signal()
-                                return
-                    except SIPCoreError:
-                        raise PublicationError('Internal error', retry_after=5)
+                            try:
+                                self._publication.publish(body, RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
+                            except ValueError as e:  # this happens for an initial PUBLISH with body=None
+                                raise PublicationError(str(e), retry_after=0)
+                            except PublicationETagError:
+                                state = self.state # access self.state only once to avoid race conditions
+                                if state is not None:
+                                    self._publication.publish(state.toxml(), RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
+                                else:
+                                    command.signal()
+                                    return
+                        except SIPCoreError:
+                            raise PublicationError('Internal error', retry_after=5)
 
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPPublicationDidSucceed':
-                                break
-                            if notification.name == 'SIPPublicationDidEnd':
-                                raise PublicationError('Publication expired', retry_after=0)  # publication expired while we were trying to re-publish
-                    except SIPPublicationDidFail, e:
-                        if e.data.code == 407:
-                            # Authentication failed, so retry the publication in some time
-                            raise PublicationError('Authentication failed', retry_after=random.uniform(60, 120))
-                        elif e.data.code == 412:
-                            raise PublicationError('Conditional request failed', retry_after=0)
-                        elif e.data.code == 423:
-                            # Get the value of the Min-Expires header
-                            if e.data.min_expires is not None and e.data.min_expires > self.account.sip.publish_interval:
-                                refresh_interval = e.data.min_expires
+                        try:
+                            while True:
+                                notification = self._data_channel.wait()
+                                if notification.name == 'SIPPublicationDidSucceed':
+                                    break
+                                if notification.name == 'SIPPublicationDidEnd':
+                                    raise PublicationError('Publication expired', retry_after=0)  # publication expired while we were trying to re-publish
+                        except SIPPublicationDidFail, e:
+                            if e.data.retry_after is not None:
+                                scheduler.backoff(destination, e.data.retry_after.seconds)
+                            if e.data.code == 407:
+                                # Authentication failed, so retry the publication in some time
+                                raise PublicationError('Authentication failed', retry_after=random.uniform(60, 120))
+                            elif e.data.code == 412:
+                                raise PublicationError('Conditional request failed', retry_after=0)
+                            elif e.data.code == 423:
+                                # Get the value of the Min-Expires header
+                                if e.data.min_expires is not None and e.data.min_expires > self.account.sip.publish_interval:
+                                    refresh_interval = e.data.min_expires
+                                else:
+                                    refresh_interval = None
+                                raise PublicationError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
+                            elif e.data.code in (405, 406, 489):
+                                raise PublicationError('Method or event not supported', retry_after=3600)
                             else:
-                                refresh_interval = None
-                            raise PublicationError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
-                        elif e.data.code in (405, 406, 489):
-                            raise PublicationError('Method or event not supported', retry_after=3600)
+                                # Otherwise just try the next route
+                                continue
                         else:
-                            # Otherwise just try the next route
-                            continue
-                    else:
-                        self.publishing = True
-                        self._publish_wait = 1
-                        command.signal()
-                        break
+                            self.publishing = True
+                            self._destination = destination
+                            self._publish_wait = 1
+                            command.signal()
+                            break
             else:
                 # There are no more routes to try, reschedule the publication
                 retry_after = random.uniform(self._publish_wait, 2*self._publish_wait)
@@ -279,6 +291,7 @@ class Publisher(object):
                 self._publication_timer = None
             self._publication_timer = reactor.callLater(e.retry_after, publish)
             self._publication = None
+            self._destination = None
             notification_center.post_notification(self.__nickname__ + 'PublicationDidFail', sender=self, data=NotificationData(reason=e.error))
         else:
             notification_center.post_notification(self.__nickname__ + 'PublicationDidSucceed', sender=self)
@@ -293,18 +306,24 @@ class Publisher(object):
         if self._publication is not None:
             notification_center = NotificationCenter()
             if publishing:
-                self._publication.end(timeout=2)
-                try:
-                    while True:
-                        notification = self._data_channel.wait()
-                        if notification.name == 'SIPPublicationDidEnd':
-                            break
-                except (SIPPublicationDidFail, SIPPublicationDidNotEnd):
-                    notification_center.post_notification(self.__nickname__ + 'PublicationDidNotEnd', sender=self)
-                else:
-                    notification_center.post_notification(self.__nickname__ + 'PublicationDidEnd', sender=self)
+                # the unpublications are paced by the scheduler like the publications
+                scheduler = RequestScheduler()
+                with scheduler.request(self._destination):
+                    self._publication.end(timeout=2)
+                    try:
+                        while True:
+                            notification = self._data_channel.wait()
+                            if notification.name == 'SIPPublicationDidEnd':
+                                break
+                    except (SIPPublicationDidFail, SIPPublicationDidNotEnd), e:
+                        if e.data.retry_after is not None:
+                            scheduler.backoff(self._destination, e.data.retry_after.seconds)
+                        notification_center.post_notification(self.__nickname__ + 'PublicationDidNotEnd', sender=self)
+                    else:
+                        notification_center.post_notification(self.__nickname__ + 'PublicationDidEnd', sender=self)
             notification_center.remove_observer(self, sender=self._publication)
             self._publication = None
+            self._destination = None
         command.signal()
 
     def _CH_terminate(self, command):
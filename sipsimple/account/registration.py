@@ -5,6 +5,7 @@ __all__ = ['Registrar']
 
 import random
 
+from functools import partial
 from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
@@ -13,11 +14,12 @@ from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implements
 
-from sipsimple.core import ContactHeader, FromHeader, Header, Registration, RouteHeader, SIPURI, SIPCoreError, NoGRUU
+from sipsimple.account.scheduler import RequestScheduler
+from sipsimple.core import ContactHeader, FromHeader, Header, Registration, Request, RouteHeader, SIPURI, SIPCoreError, NoGRUU
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.lookup import DNSLookup, DNSLookupError, RouteHealth
 from sipsimple.threading import run_in_twisted_thread
-from sipsimple.threading.green import Command, run_in_green_thread
+from sipsimple.threading.green import Command, race, run_in_green_thread
 
 
 
@@ -51,6 +53,8 @@ class Registrar(object):
         self._command_channel = coros.queue()
         self._data_channel = coros.queue()
         self._registration = None
+        self._destination = None
+        self._route_channels = {}
         self._dns_wait = 1
         self._register_wait = 1
         self._registration_timer = None
@@ -137,80 +141,78 @@ class Registrar(object):
             else:
                 self._dns_wait = 1
 
-            # Register by trying each route in turn
-            register_timeout = time() + 30
+            # Register by trying each route in turn, or by racing them if a route stagger interval is configured and we are not registered yet
+            attempts = []
             for route in routes:
-                remaining_time = register_timeout-time()
-                if remaining_time > 0:
-                    try:
-                        contact_uri = self.account.contact[NoGRUU, route]
-                    except KeyError:
-                        continue
-                    contact_header = ContactHeader(contact_uri)
-                    contact_header.parameters['+sip.instance'] = '"<%s>"' % settings.instance_id
-                    if self.account.nat_traversal.use_ice:
-                        contact_header.parameters['+sip.ice'] = None
-                    route_header = RouteHeader(route.uri)
-                    try:
-                        self._registration.register(contact_header, route_header, timeout=limit(remaining_time, min=1, max=10))
-                    except SIPCoreError:
-                        raise RegistrationError('Internal error', retry_after=5)
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPRegistrationDidSucceed':
-                                break
-                            if notification.name == 'SIPRegistrationDidEnd':
-                                raise RegistrationError('Registration expired', retry_after=0)  # registration expired while we were trying to re-register
-                    except SIPRegistrationDidFail, e:
-                        notification_data = NotificationData(code=e.data.code, reason=e.data.reason, registration=self._registration, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
-                        if e.data.code == 401:
-                            # Authentication failed, so retry the registration in some time
-                            raise RegistrationError('Authentication failed', retry_after=random.uniform(60, 120))
-                        elif e.data.code == 423:
-                            # Get the value of the Min-Expires header
-                            if e.data.min_expires is not None and e.data.min_expires > self.account.sip.register_interval:
-                                refresh_interval = e.data.min_expires
-                            else:
-                                refresh_interval = None
-                            raise RegistrationError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
-                        else:
-                            # Otherwise just try the next route
-                            continue
-                    else:
-                        notification_data = NotificationData(code=notification.data.code, reason=notification.data.reason, registration=self._registration, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
-                        self.registered = True
-                        # Save GRUU
-                        try:
-                            header = next(header for header in notification.data.contact_header_list if header.parameters.get('+sip.instance', '').strip('"<>') == settings.instance_id)
-                        except StopIteration:
-                            self.account.contact.public_gruu = None
-                            self.account.contact.temporary_gruu = None
-                        else:
-                            public_gruu = header.parameters.get('pub-gruu', None)
-                            temporary_gruu = header.parameters.get('temp-gruu', None)
-                            try:
-                                self.account.contact.public_gruu = SIPURI.parse(public_gruu.strip('"'))
-                            except (AttributeError, SIPCoreError):
-                                self.account.contact.public_gruu = None
-                            try:
-                                self.account.contact.temporary_gruu = SIPURI.parse(temporary_gruu.strip('"'))
-                            except (AttributeError, SIPCoreError):
-                                self.account.contact.temporary_gruu = None
-                        notification_data = NotificationData(contact_header=notification.data.contact_header,
-                                                             contact_header_list=notification.data.contact_header_list,
-                                                             expires=notification.data.expires_in, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
-                        self._register_wait = 1
-                        command.signal()
-                        break
+                try:
+                    contact_uri = self.account.contact[NoGRUU, route]
+                except KeyError:
+                    continue
+                contact_header = ContactHeader(contact_uri)
+                contact_header.parameters['+sip.instance'] = '"<%s>"' % settings.instance_id
+                if self.account.nat_traversal.use_ice:
+                    contact_header.parameters['+sip.ice'] = None
+                attempts.append((route, contact_header))
+            if settings.sip.route_stagger is not None and not self._registration.is_registered:
+                register = partial(self._register_route, registration=None, timeout=time()+30)
+                stagger = settings.sip.route_stagger / 1000.0
             else:
+                register = partial(self._register_route, registration=self._registration, timeout=time()+30)
+                stagger = None
+            result = None
+            if attempts:
+                try:
+                    result = race(register, attempts, stagger=stagger, failures=(SIPRegistrationDidFail,), cleanup=self._end_route_registration)
+                except SIPRegistrationDidFail:
+                    pass
+            if result is None:
                 # There are no more routes to try, reschedule the registration
                 retry_after = random.uniform(self._register_wait, 2*self._register_wait)
                 self._register_wait = limit(self._register_wait*2, max=30)
                 raise RegistrationError('No more routes to try', retry_after=retry_after)
+            (route, contact_header), (registration, data_channel, notification) = result
+            if registration is not self._registration:
+                notification_center.remove_observer(self, sender=self._registration)
+                self._registration = registration
+                self._data_channel = data_channel
+                del self._route_channels[registration]
+            self._destination = (route.address, route.port)
+            notification_data = NotificationData(code=notification.data.code, reason=notification.data.reason, registration=self._registration, registrar=route)
+            notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
+            self.registered = True
+            # Save GRUU
+            try:
+                header = next(header for header in notification.data.contact_header_list if header.parameters.get('+sip.instance', '').strip('"<>') == settings.instance_id)
+            except StopIteration:
+                self.account.contact.public_gruu = None
+                self.account.contact.temporary_gruu = None
+            else:
+                public_gruu = header.parameters.get('pub-gruu', None)
+                temporary_gruu = header.parameters.get('temp-gruu', None)
+                try:
+                    self.account.contact.public_gruu = SIPURI.parse(public_gruu.strip('"'))
+                except (AttributeError, SIPCoreError):
+                    self.account.contact.public_gruu = None
+                try:
+                    self.account.contact.temporary_gruu = SIPURI.parse(temporary_gruu.strip('"'))
+                except (AttributeError, SIPCoreError):
+                    self.account.contact.temporary_gruu = None
+            notification_data = NotificationData(contact_header=notification.data.contact_header,
+                                                 contact_header_list=notification.data.contact_header_list,
+                                                 expires=notification.data.expires_in, registrar=route)
+            notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
+            self._register_wait = 1
+            command.signal()
+            # Spread the refreshes of the accounts over the second half of the registration lifetime, up to the point
+            # where the core warns that the registration is about to expire, when it is refreshed at the latest
+            expires = notification.data.expires_in
+            if expires:
+                warning_time = max(1, expires - Request.expire_warning_time, expires // 2)
+                def refresh():
+                    if self.active:
+                        self._command_channel.send(Command('register'))
+                    self._registration_timer = None
+                self._registration_timer = reactor.callLater(random.uniform(min(expires / 2.0, warning_time), warning_time), refresh)
         except RegistrationError, e:
             self.registered = False
             notification_center.remove_observer(self, sender=self._registration)
@@ -221,9 +223,98 @@ class Registrar(object):
                 self._registration_timer = None
             self._registration_timer = reactor.callLater(e.retry_after, register)
             self._registration = None
+            self._destination = None
             self.account.contact.public_gruu = None
             self.account.contact.temporary_gruu = None
 
+    def _register_route(self, attempt, registration, timeout):
+        notification_center = NotificationCenter()
+        route, contact_header = attempt
+        remaining_time = timeout - time()
+        if remaining_time <= 0:
+            raise SIPRegistrationDidFail(NotificationData(code=408, reason='Request Timeout'))
+        if registration is None:
+            registration = Registration(FromHeader(self.account.uri, self.account.display_name), credentials=self.account.credentials, duration=self._registration.duration, extra_headers=[Header('Supported', 'gruu')])
+            data_channel = self._route_channels[registration] = coros.queue()
+            notification_center.add_observer(self, sender=registration)
+        else:
+            data_channel = self._data_channel
+        scheduler = RequestScheduler()
+        destination = (route.address, route.port)
+        try:
+            with scheduler.request(destination):
+                # waiting for the scheduler may have used up some of the time
+                remaining_time = timeout - time()
+                if remaining_time <= 0:
+                    raise SIPRegistrationDidFail(NotificationData(code=408, reason='Request Timeout'))
+                start_time = time()
+                try:
+                    registration.register(contact_header, RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
+                except SIPCoreError:
+                    raise RegistrationError('Internal error', retry_after=5)
+                try:
+                    while True:
+                        notification = data_channel.wait()
+                        if notification.name == 'SIPRegistrationDidSucceed':
+                            break
+                        if notification.name == 'SIPRegistrationDidEnd':
+                            raise RegistrationError('Registration expired', retry_after=0)  # registration expired while we were trying to re-register
+                except SIPRegistrationDidFail, e:
+                    RouteHealth().failed(route)
+                    if e.data.retry_after is not None:
+                        scheduler.backoff(destination, e.data.retry_after.seconds)
+                    notification_data = NotificationData(code=e.data.code, reason=e.data.reason, registration=registration, registrar=route)
+                    notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
+                    if e.data.code == 401:
+                        # Authentication failed, so retry the registration in some time
+                        raise RegistrationError('Authentication failed', retry_after=random.uniform(60, 120))
+                    elif e.data.code == 423:
+                        # Get the value of the Min-Expires header
+                        if e.data.min_expires is not None and e.data.min_expires > self.account.sip.register_interval:
+                            refresh_interval = e.data.min_expires
+                        else:
+                            refresh_interval = None
+                        raise RegistrationError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
+                    else:
+                        # Otherwise just try the next route
+                        raise
+        except:
+            if registration is not self._registration:
+                notification_center.remove_observer(self, sender=registration)
+                del self._route_channels[registration]
+            raise
+        RouteHealth().succeeded(route, time()-start_time)
+        return registration, data_channel, notification
+
+    def _end_route_registration(self, attempt, result):
+        # a registration which succeeded after another route won the race, or after the registration process was aborted
+        notification_center = NotificationCenter()
+        route, contact_header = attempt
+        registration, data_channel, notification = result
+        try:
+            self._end_registration(registration, data_channel, (route.address, route.port))
+        except (SIPRegistrationDidFail, SIPRegistrationDidNotEnd):
+            pass
+        finally:
+            notification_center.remove_observer(self, sender=registration)
+            del self._route_channels[registration]
+
+    def _end_registration(self, registration, data_channel, destination):
+        # the unregistrations are paced by the scheduler like the registrations, so that unregistering all the
+        # accounts at once, as when the network conditions change, does not result in a burst of requests
+        scheduler = RequestScheduler()
+        with scheduler.request(destination):
+            registration.end(timeout=2)
+            try:
+                while True:
+                    notification = data_channel.wait()
+                    if notification.name == 'SIPRegistrationDidEnd':
+                        break
+            except (SIPRegistrationDidFail, SIPRegistrationDidNotEnd), e:
+                if e.data.retry_after is not None:
+                    scheduler.backoff(destination, e.data.retry_after.seconds)
+                raise
+
     def _CH_unregister(self, command):
         # Cancel any timer which would restart the registration process
         if self._registration_timer is not None and self._registration_timer.active():
@@ -234,12 +325,8 @@ class Registrar(object):
         if self._registration is not None:
             notification_center = NotificationCenter()
             if registered:
-                self._registration.end(timeout=2)
                 try:
-                    while True:
-                        notification = self._data_channel.wait()
-                        if notification.name == 'SIPRegistrationDidEnd':
-                            break
+                    self._end_registration(self._registration, self._data_channel, self._destination)
                 except (SIPRegistrationDidFail, SIPRegistrationDidNotEnd), e:
                     notification_center.post_notification('SIPAccountRegistrationDidNotEnd', sender=self.account, data=NotificationData(code=e.data.code, reason=e.data.reason,
                                                                                                                                         registration=self._registration))
@@ -247,6 +334,7 @@ class Registrar(object):
                     notification_center.post_notification('SIPAccountRegistrationDidEnd', sender=self.account, data=NotificationData(registration=self._registration))
             notification_center.remove_observer(self, sender=self._registration)
             self._registration = None
+            self._destination = None
             self.account.contact.public_gruu = None
             self.account.contact.temporary_gruu = None
         command.signal()
@@ -255,29 +343,41 @@ class Registrar(object):
         self._CH_unregister(command)
         raise proc.ProcExit
 
+    def _get_data_channel(self, registration):
+        if registration is self._registration:
+            return self._data_channel
+        return self._route_channels.get(registration)
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def _NH_SIPRegistrationDidSucceed(self, notification):
-        if notification.sender is self._registration:
-            self._data_channel.send(notification)
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send(notification)
 
     def _NH_SIPRegistrationDidFail(self, notification):
-        if notification.sender is self._registration:
-            self._data_channel.send_exception(SIPRegistrationDidFail(notification.data))
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send_exception(SIPRegistrationDidFail(notification.data))
 
     def _NH_SIPRegistrationDidEnd(self, notification):
-        if notification.sender is self._registration:
-            self._data_channel.send(notification)
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send(notification)
 
     def _NH_SIPRegistrationDidNotEnd(self, notification):
-        if notification.sender is self._registration:
-            self._data_channel.send_exception(SIPRegistrationDidNotEnd(notification.data))
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send_exception(SIPRegistrationDidNotEnd(notification.data))
 
     def _NH_SIPRegistrationWillExpire(self, notification):
-        if self.active:
+        # the refresh is normally started before this by the timer scheduled when the registration succeeded
+        if self.active and self._registration_timer is not None and self._registration_timer.active():
+            self._registration_timer.cancel()
+            self._registration_timer = None
             self._command_channel.send(Command('register'))
 
     @run_in_green_thread
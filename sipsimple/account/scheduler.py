@@ -0,0 +1,133 @@
+
+"""Implements the scheduler which paces the requests sent on behalf of the accounts"""
+
+__all__ = ['RequestScheduler']
+
+from collections import deque
+from time import time
+
+from application.python.types import Singleton
+from eventlib import coros
+from twisted.internet import reactor
+
+
+class PendingRequest(object):
+    __slots__ = ('destination', 'event', 'timestamp')
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.event = coros.event()
+        self.timestamp = time()
+
+
+class RequestSlot(object):
+    def __init__(self, scheduler, destination):
+        self.scheduler = scheduler
+        self.destination = destination
+
+    def __enter__(self):
+        self.scheduler.acquire(self.destination)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler.release()
+
+
+class RequestScheduler(object):
+    """
+    Paces the REGISTER, SUBSCRIBE and PUBLISH requests sent by the
+    registrars, subscribers and publishers of all the accounts, so that
+    events which affect all of them at once, like starting the application
+    or a change in the network conditions, do not result in a burst of
+    requests towards the servers.
+
+    A request is started only when fewer than max_concurrent requests are in
+    progress, no more than rate requests were started in the last second and
+    its destination is not backing off after replying with Retry-After. The
+    requests which cannot be started yet are queued and started in order as
+    soon as they are allowed to.
+
+    The methods of the scheduler must be called from a green thread in the
+    twisted thread.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.rate = 20
+        self.max_concurrent = 50
+        self._queue = deque()
+        self._active = 0
+        self._next_start = 0
+        self._backoff = {}
+        self._timer = None
+        self._requests = 0
+        self._total_wait = 0
+        self._max_wait = 0
+
+    @property
+    def statistics(self):
+        now = time()
+        return dict(queued=len(self._queue),
+                    active=self._active,
+                    requests=self._requests,
+                    average_wait=self._total_wait / self._requests if self._requests else 0,
+                    max_wait=self._max_wait,
+                    oldest_wait=now - self._queue[0].timestamp if self._queue else 0,
+                    backoffs=sum(1 for expiration in self._backoff.itervalues() if expiration > now))
+
+    def request(self, destination=None):
+        """Return a context manager which holds a request slot for the destination while the request is in progress"""
+        return RequestSlot(self, destination)
+
+    def acquire(self, destination=None):
+        request = PendingRequest(destination)
+        self._queue.append(request)
+        self._process()
+        try:
+            request.event.wait()
+        except:
+            # the waiting green thread was killed, give the slot back if it was already granted
+            try:
+                self._queue.remove(request)
+            except ValueError:
+                self.release()
+            raise
+
+    def release(self):
+        self._active -= 1
+        self._process()
+
+    def backoff(self, destination, retry_after):
+        """Don't send requests to the destination for the next retry_after seconds"""
+        if destination is None or retry_after <= 0:
+            return
+        self._backoff[destination] = max(self._backoff.get(destination, 0), time() + retry_after)
+
+    def _process(self):
+        now = time()
+        for destination, expiration in self._backoff.items():
+            if expiration <= now:
+                del self._backoff[destination]
+        wakeup = None
+        while self._queue and self._active < self.max_concurrent:
+            if self.rate and self._next_start > now:
+                wakeup = self._next_start
+                break
+            request = next((request for request in self._queue if request.destination not in self._backoff), None)
+            if request is None:
+                wakeup = min(self._backoff.itervalues())
+                break
+            self._queue.remove(request)
+            self._active += 1
+            self._requests += 1
+            wait = now - request.timestamp
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            if self.rate:
+                self._next_start = max(self._next_start, now) + 1.0 / self.rate
+            request.event.send()
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = reactor.callLater(max(wakeup - now, 0), self._process) if wakeup is not None else None
+
@@ -6,6 +6,7 @@ __all__ = ['Subscriber', 'MWISubscriber', 'PresenceWinfoSubscriber', 'DialogWinf
 import random
 
 from abc import ABCMeta, abstractproperty
+from functools import partial
 from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
@@ -14,11 +15,17 @@ from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implements
 
+from sipsimple.account.scheduler import RequestScheduler
 from sipsimple.core import ContactHeader, FromHeader, Header, RouteHeader, SIPURI, Subscription, ToHeader, SIPCoreError, NoGRUU
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.lookup import DNSLookup, DNSLookupError, RouteHealth
+from sipsimple.payloads import ParserError
+from sipsimple.payloads.executor import PayloadParser
+from sipsimple.payloads.pidf import PIDFDocument
+from sipsimple.payloads.rlsnotify import RLSNotify
+from sipsimple.payloads.watcherinfo import WatcherInfoDocument
 from sipsimple.threading import run_in_twisted_thread
-from sipsimple.threading.green import Command, run_in_green_thread
+from sipsimple.threading.green import Command, race, run_in_green_thread
 
 
 
@@ -74,6 +81,7 @@ class Subscriber(object):
         self._subscription = None
         self._subscription_proc = None
         self._subscription_timer = None
+        self._route_channels = {}
 
     @abstractproperty
     def event(self):
@@ -172,6 +180,11 @@ class Subscriber(object):
         self._CH_unsubscribe(command)
         raise proc.ProcExit
 
+    def _get_data_channel(self, subscription):
+        if subscription is self._subscription:
+            return self._data_channel
+        return self._route_channels.get(subscription)
+
     def _subscription_handler(self, command):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
@@ -179,6 +192,8 @@ class Subscriber(object):
         subscription_uri = self.subscription_uri
         refresh_interval = command.refresh_interval or self.account.sip.subscribe_interval
         valid_transports = self.__transports__.intersection(settings.sip.transport_list)
+        scheduler = RequestScheduler()
+        destination = None
 
         try:
             # Lookup routes
@@ -197,66 +212,37 @@ class Subscriber(object):
             subscription_uri = SIPURI(user=subscription_uri.username, host=subscription_uri.domain)
             content = self.content
 
-            timeout = time() + 30
+            # Subscribe by trying each route in turn, or by racing them if a route stagger interval is configured
+            attempts = []
             for route in routes:
-                remaining_time = timeout - time()
-                if remaining_time > 0:
-                    try:
-                        contact_uri = self.account.contact[NoGRUU, route]
-                    except KeyError:
-                        continue
-                    subscription = Subscription(subscription_uri, FromHeader(self.account.uri, self.account.display_name),
-                                                ToHeader(subscription_uri),
-                                                ContactHeader(contact_uri),
-                                                self.event,
-                                                RouteHeader(route.uri),
-                                                credentials=self.account.credentials,
-                                                refresh=refresh_interval)
-                    notification_center.add_observer(self, sender=subscription)
-                    try:
-                        subscription.subscribe(body=content.body, content_type=content.type, extra_headers=self.extra_headers, timeout=limit(remaining_time, min=1, max=5))
-                    except SIPCoreError:
-                        notification_center.remove_observer(self, sender=subscription)
-                        raise SubscriptionError('Internal error', retry_after=5)
-                    self._subscription = subscription
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPSubscriptionDidStart':
-                                break
-                    except SIPSubscriptionDidFail, e:
-                        notification_center.remove_observer(self, sender=subscription)
-                        self._subscription = None
-                        if e.data.code == 407:
-                            # Authentication failed, so retry the subscription in some time
-                            raise SubscriptionError('Authentication failed', retry_after=random.uniform(60, 120))
-                        elif e.data.code == 423:
-                            # Get the value of the Min-Expires header
-                            if e.data.min_expires is not None and e.data.min_expires > self.account.sip.subscribe_interval:
-                                refresh_interval = e.data.min_expires
-                            else:
-                                refresh_interval = None
-                            raise SubscriptionError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
-                        elif e.data.code in (405, 406, 489):
-                            raise SubscriptionError('Method or event not supported', retry_after=3600)
-                        elif e.data.code == 1400:
-                            raise SubscriptionError(e.data.reason, retry_after=3600)
-                        else:
-                            # Otherwise just try the next route
-                            continue
-                    else:
-                        self.subscribed = True
-                        command.signal()
-                        break
-            else:
+                try:
+                    attempts.append((route, self.account.contact[NoGRUU, route]))
+                except KeyError:
+                    continue
+            if not attempts:
+                raise SubscriptionError('No more routes to try', retry_after=random.uniform(60, 180))
+            stagger = settings.sip.route_stagger / 1000.0 if settings.sip.route_stagger is not None else None
+            subscribe = partial(self._subscribe_route, subscription_uri=subscription_uri, refresh_interval=refresh_interval, content=content, timeout=time()+30)
+            try:
+                attempt, (self._subscription, self._data_channel) = race(subscribe, attempts, stagger=stagger, failures=(SIPSubscriptionDidFail,), cleanup=self._end_route_subscription)
+            except SIPSubscriptionDidFail:
                 # There are no more routes to try, reschedule the subscription
                 raise SubscriptionError('No more routes to try', retry_after=random.uniform(60, 180))
+            route, contact_uri = attempt
+            destination = (route.address, route.port)
+            del self._route_channels[self._subscription]
+            self.subscribed = True
+            command.signal()
             # At this point it is subscribed. Handle notifications and ending/failures.
             notification_center.post_notification(self.__nickname__ + 'SubscriptionDidStart', sender=self)
             try:
                 while True:
                     notification = self._data_channel.wait()
                     if notification.name == 'SIPSubscriptionGotNotify':
+                        try:
+                            notification.data.document = self._parse_notify(notification.data)
+                        except ParserError:
+                            notification.data.document = None
                         notification_center.post_notification(self.__nickname__ + 'SubscriptionGotNotify', sender=self, data=notification.data)
                     elif notification.name == 'SIPSubscriptionDidEnd':
                         notification_center.post_notification(self.__nickname__ + 'SubscriptionDidEnd', sender=self, data=NotificationData(originator='remote'))
@@ -274,7 +260,8 @@ class Subscriber(object):
             if self._subscription is not None:
                 notification_center.remove_observer(self, sender=self._subscription)
                 try:
-                    self._subscription.end(timeout=2)
+                    with scheduler.request(destination):
+                        self._subscription.end(timeout=2)
                 except SIPCoreError:
                     pass
                 finally:
@@ -284,17 +271,7 @@ class Subscriber(object):
                 command.signal(e)
             if self._subscription is not None:
                 try:
-                    self._subscription.end(timeout=2)
-                except SIPCoreError:
-                    pass
-                else:
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPSubscriptionDidEnd':
-                                break
-                    except SIPSubscriptionDidFail:
-                        pass
+                    self._end_subscription(self._subscription, self._data_channel, destination)
                 finally:
                     notification_center.remove_observer(self, sender=self._subscription)
                     notification_center.post_notification(self.__nickname__ + 'SubscriptionDidEnd', sender=self, data=NotificationData(originator='local'))
@@ -310,26 +287,126 @@ class Subscriber(object):
             self._subscription = None
             self._subscription_proc = None
 
+    def _subscribe_route(self, attempt, subscription_uri, refresh_interval, content, timeout):
+        notification_center = NotificationCenter()
+        route, contact_uri = attempt
+        remaining_time = timeout - time()
+        if remaining_time <= 0:
+            raise SIPSubscriptionDidFail(NotificationData(code=408, reason='Request Timeout'))
+        subscription = Subscription(subscription_uri, FromHeader(self.account.uri, self.account.display_name),
+                                    ToHeader(subscription_uri),
+                                    ContactHeader(contact_uri),
+                                    self.event,
+                                    RouteHeader(route.uri),
+                                    credentials=self.account.credentials,
+                                    refresh=refresh_interval)
+        data_channel = self._route_channels[subscription] = coros.queue()
+        notification_center.add_observer(self, sender=subscription)
+        scheduler = RequestScheduler()
+        destination = (route.address, route.port)
+        try:
+            with scheduler.request(destination):
+                # waiting for the scheduler may have used up some of the time
+                remaining_time = timeout - time()
+                if remaining_time <= 0:
+                    raise SIPSubscriptionDidFail(NotificationData(code=408, reason='Request Timeout'))
+                start_time = time()
+                try:
+                    subscription.subscribe(body=content.body, content_type=content.type, extra_headers=self.extra_headers, timeout=limit(remaining_time, min=1, max=5))
+                except SIPCoreError:
+                    raise SubscriptionError('Internal error', retry_after=5)
+                try:
+                    while True:
+                        notification = data_channel.wait()
+                        if notification.name == 'SIPSubscriptionDidStart':
+                            break
+                except SIPSubscriptionDidFail, e:
+                    RouteHealth().failed(route)
+                    if e.data.retry_after is not None:
+                        scheduler.backoff(destination, e.data.retry_after.seconds)
+                    if e.data.code == 407:
+                        # Authentication failed, so retry the subscription in some time
+                        raise SubscriptionError('Authentication failed', retry_after=random.uniform(60, 120))
+                    elif e.data.code == 423:
+                        # Get the value of the Min-Expires header
+                        if e.data.min_expires is not None and e.data.min_expires > self.account.sip.subscribe_interval:
+                            refresh_interval = e.data.min_expires
+                        else:
+                            refresh_interval = None
+                        raise SubscriptionError('Interval too short', retry_after=random.uniform(60, 120), refresh_interval=refresh_interval)
+                    elif e.data.code in (405, 406, 489):
+                        raise SubscriptionError('Method or event not supported', retry_after=3600)
+                    elif e.data.code == 1400:
+                        raise SubscriptionError(e.data.reason, retry_after=3600)
+                    else:
+                        # Otherwise just try the next route
+                        raise
+        except:
+            notification_center.remove_observer(self, sender=subscription)
+            del self._route_channels[subscription]
+            raise
+        RouteHealth().succeeded(route, time()-start_time)
+        return subscription, data_channel
+
+    def _parse_notify(self, data):
+        # Returns the parsed body of a NOTIFY, which is made available to the observers as the document attribute
+        # of the notification data, or None if the subscriber does not know how to parse it.
+        return None
+
+    def _end_route_subscription(self, attempt, result):
+        # a subscription which succeeded after another route won the race, or after the subscription process was interrupted
+        notification_center = NotificationCenter()
+        route, contact_uri = attempt
+        subscription, data_channel = result
+        destination = (route.address, route.port)
+        try:
+            self._end_subscription(subscription, data_channel, destination)
+        finally:
+            notification_center.remove_observer(self, sender=subscription)
+            del self._route_channels[subscription]
+
+    def _end_subscription(self, subscription, data_channel, destination):
+        # the unsubscriptions are paced by the scheduler like the subscriptions, so that ending all the subscriptions
+        # at once, as when the network conditions change, does not result in a burst of requests
+        scheduler = RequestScheduler()
+        with scheduler.request(destination):
+            try:
+                subscription.end(timeout=2)
+            except SIPCoreError:
+                return
+            try:
+                while True:
+                    notification = data_channel.wait()
+                    if notification.name == 'SIPSubscriptionDidEnd':
+                        break
+            except SIPSubscriptionDidFail, e:
+                if e.data.retry_after is not None:
+                    scheduler.backoff(destination, e.data.retry_after.seconds)
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def _NH_SIPSubscriptionDidStart(self, notification):
-        if notification.sender is self._subscription:
-            self._data_channel.send(notification)
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send(notification)
 
     def _NH_SIPSubscriptionDidEnd(self, notification):
-        if notification.sender is self._subscription:
-            self._data_channel.send(notification)
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send(notification)
 
     def _NH_SIPSubscriptionDidFail(self, notification):
-        if notification.sender is self._subscription:
-            self._data_channel.send_exception(SIPSubscriptionDidFail(notification.data))
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send_exception(SIPSubscriptionDidFail(notification.data))
 
     def _NH_SIPSubscriptionGotNotify(self, notification):
-        if notification.sender is self._subscription:
-            self._data_channel.send(notification)
+        data_channel = self._get_data_channel(notification.sender)
+        if data_channel is not None:
+            data_channel.send(notification)
 
     def _NH_NetworkConditionsDidChange(self, notification):
         if self.active:
@@ -380,6 +457,21 @@ class AbstractPresenceSubscriber(Subscriber):
 
     __transports__ = frozenset(['tls', 'tcp'])
 
+    def __init__(self, account):
+        super(AbstractPresenceSubscriber, self).__init__(account)
+        self._rls_resources = {}
+
+    def _parse_rls_notify(self, data):
+        # the resources received so far are used to skip parsing the ones which didn't change. when the payload parser
+        # runs on its worker threads, the PIDF documents are parsed there as well instead of on first access.
+        payload_parser = PayloadParser()
+        payload = '{content_type}\r\n\r\n{body}'.format(content_type=data.headers['Content-Type'], body=data.body)
+        rls_notify = payload_parser.parse(RLSNotify, payload, previous_resources=self._rls_resources, lazy=not payload_parser.enabled)
+        if rls_notify.full_state:
+            self._rls_resources = {}
+        self._rls_resources.update((resource.uri, resource) for resource in rls_notify)
+        return rls_notify
+
     def _NH_AbstractPresenceSubscriberWillStart(self, notification):
         notification.center.add_observer(self, name='SIPAccountDidDiscoverXCAPSupport', sender=self.account)
         notification.center.add_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
@@ -424,6 +516,11 @@ class PresenceWinfoSubscriber(AbstractPresenceSubscriber):
     def event(self):
         return 'presence.winfo'
 
+    def _parse_notify(self, data):
+        if data.body and data.content_type == WatcherInfoDocument.content_type:
+            return PayloadParser().parse(WatcherInfoDocument, data.body)
+        return None
+
 
 class DialogWinfoSubscriber(AbstractPresenceSubscriber):
     """Dialog Watcher Info subscriber"""
@@ -436,6 +533,11 @@ class DialogWinfoSubscriber(AbstractPresenceSubscriber):
     def event(self):
         return 'dialog.winfo'
 
+    def _parse_notify(self, data):
+        if data.body and data.content_type == WatcherInfoDocument.content_type:
+            return PayloadParser().parse(WatcherInfoDocument, data.body)
+        return None
+
 
 class PresenceSubscriber(AbstractPresenceSubscriber):
     """Presence subscriber"""
@@ -456,6 +558,11 @@ class PresenceSubscriber(AbstractPresenceSubscriber):
     def extra_headers(self):
         return [Header('Supported', 'eventlist')]
 
+    def _parse_notify(self, data):
+        if data.body and data.content_type == RLSNotify.content_type:
+            return self._parse_rls_notify(data)
+        return None
+
 
 class SelfPresenceSubscriber(AbstractPresenceSubscriber):
     """Self presence subscriber"""
@@ -472,6 +579,11 @@ class SelfPresenceSubscriber(AbstractPresenceSubscriber):
     def subscription_uri(self):
         return self.account.id
 
+    def _parse_notify(self, data):
+        if data.body and data.content_type == PIDFDocument.content_type:
+            return PayloadParser().parse(PIDFDocument, data.body)
+        return None
+
 
 class DialogSubscriber(AbstractPresenceSubscriber):
     """Dialog subscriber"""
@@ -492,4 +604,9 @@ class DialogSubscriber(AbstractPresenceSubscriber):
     def extra_headers(self):
         return [Header('Supported', 'eventlist')]
 
+    def _parse_notify(self, data):
+        if data.body and data.content_type == RLSNotify.content_type:
+            return self._parse_rls_notify(data)
+        return None
+
 
@@ -16,6 +16,7 @@ from collections import OrderedDict
 from datetime import datetime
 from itertools import chain
 from operator import attrgetter
+from time import time
 from urllib2 import URLError
 
 from application.notification import IObserver, NotificationCenter, NotificationData
@@ -23,6 +24,7 @@ from application.python import Null
 from application.python.decorator import execute_once
 from eventlib import api, coros, proc
 from eventlib.green.httplib import BadStatusLine
+from lxml import etree
 from twisted.internet.error import ConnectionLost
 from xcaplib.green import XCAPClient
 from xcaplib.error import HTTPError
@@ -54,6 +56,8 @@ class Document(object):
     global_tree        = None
     filename           = None
     cached             = True
+    partial_updates    = True
+    partial_limit      = 16
 
     def __init__(self, manager):
         self.manager = weakref.proxy(manager)
@@ -61,12 +65,24 @@ class Document(object):
         self.etag = None
         self.fetch_time = datetime.fromtimestamp(0)
         self.update_time = datetime.fromtimestamp(0)
+        self.update_statistics = None
         self.dirty = False
         self.supported = False
 
     def __nonzero__(self):
         return self.content is not None
 
+    @property
+    def content(self):
+        return self.__dict__['content']
+
+    @content.setter
+    def content(self, content):
+        if content is not None:
+            # the removed elements are only needed for the element level updates
+            content.track_removals = self.partial_updates
+        self.__dict__['content'] = content
+
     @property
     def dirty(self):
         return self.__dict__['dirty'] or (self.content is not None and self.content.__dirty__)
@@ -91,7 +107,7 @@ class Document(object):
         try:
             document = StringIO(self.manager.storage.load(self.name))
             self.etag = document.readline().strip() or None
-            self.content = self.payload_type.parse(document)
+            self.content = self.payload_type.parse(document, validate=False)
             self.__dict__['dirty'] = False
         except (XCAPStorageError, ParserError):
             self.etag = None
@@ -142,13 +158,26 @@ class Document(object):
     def update(self):
         if not self.dirty:
             return
+        start_time = time()
+        self.update_statistics = dict(partial=False, requests=0, bytes_sent=0, duration=0)
         data = self.content.toxml() if self.content is not None else None
+        if data is None or not self._update_nodes():
+            self._update_document(data)
+        self.update_statistics['duration'] = time() - start_time
+        self.dirty = False
+        self.update_time = datetime.utcnow()
+        if self.cached:
+            try:
+                if data is not None:
+                    self.manager.storage.save(self.name, self.etag + os.linesep + data)
+                else:
+                    self.manager.storage.delete(self.name)
+            except XCAPStorageError:
+                pass
+
+    def _update_document(self, data):
         try:
-            kw = dict(etag=self.etag) if self.etag is not None else dict(etagnot='*')
-            if data is not None:
-                response = self.manager.client.put(self.application, data, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': self.payload_type.content_type}, **kw)
-            else:
-                response = self.manager.client.delete(self.application, data, globaltree=self.global_tree, filename=self.filename, **kw)
+            response = self._send(data)
         except (BadStatusLine, ConnectionLost, URLError), e:
             raise XCAPError("failed to update %s document: %s" % (self.name, e))
         except HTTPError, e:
@@ -159,16 +188,56 @@ class Document(object):
             else:
                 raise XCAPError("failed to update %s document: %s" % (self.name, e))
         self.etag = response.etag if data is not None else None
-        self.dirty = False
-        self.update_time = datetime.utcnow()
-        if self.cached:
-            try:
-                if data is not None:
-                    self.manager.storage.save(self.name, self.etag + os.linesep + data)
+
+    def _update_nodes(self):
+        # Send the subtrees which changed since the document was last in sync with the server as element level
+        # requests addressed by node selectors (RFC 4825), removals first. Returns False if the whole document
+        # needs to be replaced instead, which is also how the document is brought back in sync if the server
+        # rejects one of the element level changes.
+        if not self.partial_updates or self.etag is None or self.__dict__['dirty']:
+            return False
+        removed_paths = self.content.removed_paths()
+        dirty_paths = self.content.dirty_paths()
+        if len(removed_paths) + len(dirty_paths) > self.partial_limit or any(len(path) == 1 for path in dirty_paths):
+            return False
+        removed_nodes = [self.content.get_node_selector(path) for path in removed_paths]
+        modified_nodes = [(self.content.get_node_selector(path), path[-1]) for path in dirty_paths]
+        if None in removed_nodes or any(node is None for node, element in modified_nodes):
+            return False
+        self.update_statistics['partial'] = True
+        try:
+            for node in removed_nodes:
+                try:
+                    response = self._send(None, node=node)
+                except HTTPError, e:
+                    if e.status != 404: # the element was added after the last update or was already removed
+                        raise
                 else:
-                    self.manager.storage.delete(self.name)
-            except XCAPStorageError:
-                pass
+                    self.etag = response.etag
+            for node, element in modified_nodes:
+                response = self._send(etree.tostring(element.element, encoding='UTF-8', with_tail=False), node=node)
+                self.etag = response.etag
+        except (BadStatusLine, ConnectionLost, URLError), e:
+            raise XCAPError("failed to update %s document: %s" % (self.name, e))
+        except HTTPError, e:
+            if e.status == 412: # Precondition Failed
+                raise FetchRequiredError("document %s was modified externally" % self.name)
+            elif e.status in (404, 409): # the parent of an element is missing or the change violates the constraints of the document
+                self.update_statistics['partial'] = False
+                return False
+            else:
+                raise XCAPError("failed to update %s document: %s" % (self.name, e))
+        return True
+
+    def _send(self, data, node=None):
+        kw = dict(etag=self.etag) if self.etag is not None else dict(etagnot='*')
+        self.update_statistics['requests'] += 1
+        if data is not None:
+            self.update_statistics['bytes_sent'] += len(data)
+            content_type = self.payload_type.content_type if node is None else 'application/xcap-el+xml'
+            return self.manager.client.put(self.application, data, node, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': content_type}, **kw)
+        else:
+            return self.manager.client.delete(self.application, node, globaltree=self.global_tree, filename=self.filename, **kw)
 
 
 class DialogRulesDocument(Document):
@@ -588,7 +657,7 @@ class OfflineStatus(object):
         return {'pidf': self.pidf.toxml()}
 
     def __setstate__(self, state):
-        self.pidf = pidf.PIDFDocument.parse(state['pidf'])
+        self.pidf = pidf.PIDFDocument.parse(state['pidf'], validate=False)
 
 
 class Operation(object):
@@ -1041,9 +1110,11 @@ class XCAPManager(object):
                 log.exception()
             operation.applied = True
             api.sleep(0) # Operations are quite CPU intensive
+        notification_center = NotificationCenter()
         try:
             for document in (doc for doc in self.documents if doc.dirty and doc.supported):
                 document.update()
+                notification_center.post_notification('XCAPManagerDidUpdateDocument', sender=self, data=NotificationData(document=document.name, **document.update_statistics))
         except FetchRequiredError:
             for document in (doc for doc in self.documents if doc.dirty and doc.supported):
                 document.reset()
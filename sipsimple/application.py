@@ -7,9 +7,10 @@ application.
 
 from __future__ import absolute_import
 
-__all__ = ["SIPApplication"]
+__all__ = ["SIPApplication", "EngineShard"]
 
 import os
+import zlib
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
@@ -23,6 +24,7 @@ from uuid import uuid4
 from xcaplib import client as xcap_client
 from zope.interface import implements
 
+from sipsimple import log
 from sipsimple.account import AccountManager
 from sipsimple.addressbook import AddressbookManager
 from sipsimple.audio import AudioDevice, RootAudioBridge
@@ -51,6 +53,63 @@ class ApplicationAttribute(object):
         raise AttributeError('cannot delete attribute')
 
 
+class EngineShard(object):
+    """
+    Describes the share of the SIP signalling that is handled by the current
+    process, when the application is run as one of count processes which
+    share the load. Each process runs its own engine, listens on the
+    configured SIP ports offset by its index times the port stride, uses its
+    own slice of the RTP port range and only starts the accounts that are
+    assigned to it. As each account registers the contact of the process it
+    runs in, the requests for the account are routed to the right process by
+    the registrar.
+
+    The port stride must be larger than the spread of the configured SIP
+    ports, so that the ports of a process never clash with the ones of
+    another. If it is not given, it is derived from the configured ports.
+    """
+
+    def __init__(self, index, count, port_stride=None):
+        if count < 1:
+            raise ValueError("count must be a positive number")
+        if not (0 <= index < count):
+            raise ValueError("index must be between 0 and %d" % (count - 1))
+        if port_stride is not None and port_stride < 1:
+            raise ValueError("port_stride must be a positive number")
+        self.index = index
+        self.count = count
+        self.port_stride = port_stride
+
+    def __repr__(self):
+        return "%s(%d, %d)" % (self.__class__.__name__, self.index, self.count)
+
+    def owns(self, key):
+        # crc32 rather than hash, as the assignment needs to be the same in all the processes
+        return (zlib.crc32(str(key)) & 0xffffffff) % self.count == self.index
+
+    def port(self, port, ports=()):
+        # ports are all the configured SIP ports, which determine the stride when it is not given
+        if not port:
+            return port
+        ports = [item for item in ports if item] or [port]
+        spread = max(ports) - min(ports)
+        stride = self.port_stride if self.port_stride is not None else spread + 1
+        if stride <= spread:
+            raise ValueError("port_stride must be larger than the spread of the SIP ports (%d)" % spread)
+        port += self.index * stride
+        if port > 65535:
+            raise ValueError("the SIP ports of shard %d exceed 65535" % self.index)
+        return port
+
+    def port_range(self, start, end):
+        size = (end - start) // self.count
+        if size < 2:
+            raise ValueError("the port range %d-%d is too small to be shared by %d processes" % (start, end, self.count))
+        size -= size % 2
+        start += self.index * size
+        return start, start + size
+
+
 class SIPApplication(object):
     __metaclass__ = Singleton
 
@@ -60,6 +119,7 @@ class SIPApplication(object):
     engine = ApplicationAttribute(value=None)
     thread = ApplicationAttribute(value=None)
 
+    shard = ApplicationAttribute(value=None)
     state = ApplicationAttribute(value=None)
 
     alert_audio_device = ApplicationAttribute(value=None)
@@ -77,9 +137,11 @@ class SIPApplication(object):
     alert_audio_mixer = classproperty(lambda cls: cls.alert_audio_bridge.mixer if cls.alert_audio_bridge else None)
     voice_audio_mixer = classproperty(lambda cls: cls.voice_audio_bridge.mixer if cls.voice_audio_bridge else None)
 
-    def start(self, storage):
+    def start(self, storage, shard=None):
         if not ISIPSimpleStorage.providedBy(storage):
             raise TypeError("storage must implement the ISIPSimpleStorage interface")
+        if shard is not None and not isinstance(shard, EngineShard):
+            raise TypeError("shard must be an EngineShard instance or None")
 
         with self._lock:
             if self.state is not None:
@@ -88,6 +150,7 @@ class SIPApplication(object):
 
         self.engine = Engine()
         self.storage = storage
+        self.shard = shard
 
         thread_manager = ThreadManager()
         thread_manager.start()
@@ -106,6 +169,7 @@ class SIPApplication(object):
             self.engine = None
             self.state = None
             self.storage = None
+            self.shard = None
             raise
 
         # run the reactor thread
@@ -152,8 +216,8 @@ class SIPApplication(object):
                        user_agent=settings.user_agent,
                        # SIP
                        detect_sip_loops=True,
-                       udp_port=settings.sip.udp_port if 'udp' in settings.sip.transport_list else None,
-                       tcp_port=settings.sip.tcp_port if 'tcp' in settings.sip.transport_list else None,
+                       udp_port=self._sip_port(settings.sip.udp_port) if 'udp' in settings.sip.transport_list else None,
+                       tcp_port=self._sip_port(settings.sip.tcp_port) if 'tcp' in settings.sip.transport_list else None,
                        tls_port=None,
                        # TLS
                        tls_verify_server=False,
@@ -161,7 +225,7 @@ class SIPApplication(object):
                        tls_cert_file=None,
                        tls_privkey_file=None,
                        # rtp
-                       rtp_port_range=(settings.rtp.port_range.start, settings.rtp.port_range.end),
+                       rtp_port_range=self._rtp_port_range(),
                        # audio
                        codecs=list(settings.rtp.audio_codec_list),
                        # video
@@ -178,7 +242,7 @@ class SIPApplication(object):
         account = account_manager.default_account
         if account is not None:
             try:
-                self.engine.set_tls_options(port=settings.sip.tls_port,
+                self.engine.set_tls_options(port=self._sip_port(settings.sip.tls_port),
                                             verify_server=account.tls.verify_server,
                                             ca_file=settings.tls.ca_list.normalized if settings.tls.ca_list else None,
                                             cert_file=account.tls.certificate.normalized if account.tls.certificate else None,
@@ -312,9 +376,28 @@ class SIPApplication(object):
         thread_manager = ThreadManager()
         thread_manager.stop()
 
+        # write any configuration changes that are still pending
+        configuration_manager = ConfigurationManager()
+        try:
+            configuration_manager.flush()
+        except Exception:
+            log.exception()
+
         # stop the reactor
         reactor.stop()
 
+    def _sip_port(self, port):
+        if self.shard is None:
+            return port
+        settings = SIPSimpleSettings()
+        return self.shard.port(port, (settings.sip.udp_port, settings.sip.tcp_port, settings.sip.tls_port))
+
+    def _rtp_port_range(self):
+        settings = SIPSimpleSettings()
+        if self.shard is not None:
+            return self.shard.port_range(settings.rtp.port_range.start, settings.rtp.port_range.end)
+        return settings.rtp.port_range.start, settings.rtp.port_range.end
+
     def _network_conditions_changed(self):
         if self.running and self._timer is None:
             def notify():
@@ -322,7 +405,7 @@ class SIPApplication(object):
                     settings = SIPSimpleSettings()
                     if 'tcp' in settings.sip.transport_list:
                         self.engine.set_tcp_port(None)
-                        self.engine.set_tcp_port(settings.sip.tcp_port)
+                        self.engine.set_tcp_port(self._sip_port(settings.sip.tcp_port))
                     if 'tls' in settings.sip.transport_list:
                         self._initialize_tls()
                     notification_center = NotificationCenter()
@@ -436,14 +519,18 @@ class SIPApplication(object):
                                               settings.video.max_bitrate)
             if 'user_agent' in notification.data.modified:
                 self.engine.user_agent = settings.user_agent
-            if 'sip.udp_port' in notification.data.modified:
-                self.engine.set_udp_port(settings.sip.udp_port)
-            if 'sip.tcp_port' in notification.data.modified:
-                self.engine.set_tcp_port(settings.sip.tcp_port)
-            if {'sip.tls_port', 'tls.ca_list', 'default_account'}.intersection(notification.data.modified):
+            sip_ports_modified = {'sip.udp_port', 'sip.tcp_port', 'sip.tls_port'}.intersection(notification.data.modified)
+            if sip_ports_modified and self.shard is not None and self.shard.port_stride is None:
+                # the stride depends on all the SIP ports, so the ones in use all move when one of them changes
+                sip_ports_modified.update('sip.%s_port' % transport for transport in settings.sip.transport_list)
+            if 'sip.udp_port' in sip_ports_modified:
+                self.engine.set_udp_port(self._sip_port(settings.sip.udp_port))
+            if 'sip.tcp_port' in sip_ports_modified:
+                self.engine.set_tcp_port(self._sip_port(settings.sip.tcp_port))
+            if 'sip.tls_port' in sip_ports_modified or {'tls.ca_list', 'default_account'}.intersection(notification.data.modified):
                 self._initialize_tls()
             if 'rtp.port_range' in notification.data.modified:
-                self.engine.rtp_port_range = (settings.rtp.port_range.start, settings.rtp.port_range.end)
+                self.engine.rtp_port_range = self._rtp_port_range()
             if 'rtp.audio_codec_list' in notification.data.modified:
                 self.engine.codecs = list(settings.rtp.audio_codec_list)
             if 'logs.trace_sip' in notification.data.modified:
@@ -9,7 +9,7 @@ __all__ = ['ConfigurationManager', 'ConfigurationError', 'ObjectNotFoundError',
 from abc import ABCMeta, abstractmethod
 from itertools import chain
 from operator import attrgetter
-from threading import Lock
+from threading import Lock, Timer
 from weakref import WeakSet
 
 from application.notification import NotificationCenter, NotificationData
@@ -48,12 +48,21 @@ class ConfigurationManager(object):
     Singleton class used for storing and retrieving options, organized in
     sections. A section contains a list of objects, each with an assigned name
     which allows access to the object.
+
+    If save_delay is set to a number of seconds, save() does not write the
+    data right away, but schedules a write to happen after that delay, so
+    that all the saves requested within the window result in a single write
+    to the backend. Pending data is written when flush() is called.
     """
     __metaclass__ = Singleton
 
     def __init__(self):
         self.backend = None
         self.data = None
+        self.save_delay = None
+        self._save_lock = Lock()
+        self._save_pending = False
+        self._save_timer = None
 
     def start(self):
         """
@@ -146,11 +155,49 @@ class ConfigurationManager(object):
 
     def save(self):
         """
-        Flush the modified objects. Cannot be called before start().
+        Flush the modified objects, or schedule them to be flushed if the
+        save_delay is set. Cannot be called before start().
+        """
+        if self.backend is None:
+            raise RuntimeError("ConfigurationManager cannot be used unless started")
+        with self._save_lock:
+            if not self.save_delay:
+                self._cancel_save_timer()
+                self._save_pending = False
+                self.backend.save(self.data)
+                return
+            self._save_pending = True
+            if self._save_timer is None:
+                self._save_timer = Timer(self.save_delay, self._save_timer_expired)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self):
+        """
+        Write the data to the backend if there is a save pending. Cannot be
+        called before start().
         """
         if self.backend is None:
             raise RuntimeError("ConfigurationManager cannot be used unless started")
-        self.backend.save(self.data)
+        with self._save_lock:
+            self._cancel_save_timer()
+            if self._save_pending:
+                self._save_pending = False
+                self.backend.save(self.data)
+
+    def _cancel_save_timer(self):
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+
+    @run_in_thread('file-io')
+    def _save_timer_expired(self):
+        try:
+            self.flush()
+        except Exception, e:
+            log.exception()
+            notification_center = NotificationCenter()
+            notification_center.post_notification('CFGManagerSaveFailed', sender=self, data=NotificationData(object=None, operation='flush', exception=e))
 
     def _get(self, data_tree, key):
         subtree_key = key.pop(0)
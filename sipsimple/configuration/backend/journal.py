@@ -0,0 +1,191 @@
+"""Configuration backend for storing settings in an append-only journal"""
+
+__all__ = ["JournalParserError", "JournalBuilderError", "JournalBackend"]
+
+import errno
+import json
+import os
+import platform
+import random
+
+from application.system import makedirs, openfile, unlink
+from zope.interface import implements
+
+from sipsimple.configuration.backend import IConfigurationBackend, ConfigurationBackendError
+
+
+class JournalParserError(ConfigurationBackendError):
+    """Error raised when the journal file cannot be parsed."""
+
+class JournalBuilderError(ConfigurationBackendError):
+    """Error raised when the configuration data cannot be saved."""
+
+
+class JournalBackend(object):
+    """
+    Implementation of a configuration backend that stores data in a journal
+    file to which only the changes since the previous save are appended.
+
+    Each line in the journal is a JSON list, either [path, value] which sets
+    the entry found at path (a list of names) to value, or [path] which
+    removes the entry found at path. An empty group is stored as an entry
+    whose value is an empty dictionary. When the number of records in the
+    journal exceeds the number of entries in the data by more than the
+    compaction threshold, the journal is rewritten to only contain the
+    current entries.
+    """
+
+    implements(IConfigurationBackend)
+
+    def __init__(self, filename, compaction_threshold=1000):
+        """
+        Initialize the configuration backend with the specified file.
+
+        The file is not read at this time, but rather each time the load method
+        is called.
+        """
+        self.filename = filename
+        self.compaction_threshold = compaction_threshold
+        self._entries = None
+        self._records = 0
+        self._needs_compaction = False
+
+    def load(self):
+        """
+        Read the journal configured with this backend and replay it, returning
+        a dictionary conforming to the IConfigurationBackend specification.
+        """
+
+        try:
+            file = open(self.filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                self._entries = {}
+                self._records = 0
+                self._needs_compaction = True
+                return {}
+            else:
+                raise ConfigurationBackendError("failed to read configuration journal: %s" % str(e))
+
+        data = {}
+        records = 0
+        with file:
+            lines = file.read().split('\n')
+        # the last line is either empty or the result of an interrupted write, in which case it is discarded
+        self._needs_compaction = lines[-1] != ''
+        for lineno, line in enumerate(lines[:-1], 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise JournalParserError("invalid record at line %d" % lineno)
+            if type(record) is not list or len(record) not in (1, 2) or type(record[0]) is not list or not record[0]:
+                raise JournalParserError("invalid record at line %d" % lineno)
+            if len(record) == 2:
+                self._set(data, record[0], record[1])
+            else:
+                self._remove(data, record[0])
+            records += 1
+
+        self._entries = self._flatten(data)
+        self._records = records
+        return data
+
+    def save(self, data):
+        """
+        Given a dictionary conforming to the IConfigurationBackend
+        specification, append the changes made to it since the last save to
+        the journal configured with this backend.
+        """
+        entries = self._flatten(data)
+        if self._entries is None:
+            self._entries = {}
+            self._needs_compaction = True
+        if self._needs_compaction:
+            self._compact(entries)
+            return
+        old_entries = self._entries
+        records = [[list(path)] for path in old_entries if path not in entries]
+        records.extend([list(path), value] for path, value in entries.iteritems() if path not in old_entries or old_entries[path] != value)
+        if not records:
+            return
+        try:
+            file = openfile(self.filename, 'ab', permissions=0600)
+            file.write(''.join(json.dumps(record) + '\n' for record in records))
+            file.close()
+        except (IOError, OSError), e:
+            self._needs_compaction = True
+            raise ConfigurationBackendError("failed to write configuration journal: %s" % str(e))
+        self._entries = entries
+        self._records += len(records)
+        if self._records > len(entries) + self.compaction_threshold:
+            self._compact(entries)
+
+    def compact(self):
+        """
+        Rewrite the journal so that it only contains the records needed to
+        rebuild the data that was last loaded or saved.
+        """
+        if self._entries is not None:
+            self._compact(self._entries)
+
+    def _compact(self, entries):
+        records = ([list(path), value] for path, value in sorted(entries.iteritems()))
+        config_directory = os.path.dirname(self.filename)
+        tmp_filename = '%s.%d.%08X' % (self.filename, os.getpid(), random.getrandbits(32))
+        try:
+            if config_directory:
+                makedirs(config_directory)
+            file = openfile(tmp_filename, 'wb', permissions=0600)
+            file.write(''.join(json.dumps(record) + '\n' for record in records))
+            file.close()
+            if platform.system() == 'Windows':
+                # os.rename does not work on Windows if the destination file already exists.
+                # It seems there is no atomic way to do this on Windows.
+                unlink(self.filename)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError), e:
+            self._needs_compaction = True
+            raise ConfigurationBackendError("failed to write configuration journal: %s" % str(e))
+        self._entries = entries
+        self._records = len(entries)
+        self._needs_compaction = False
+
+    def _flatten(self, group, prefix=(), entries=None):
+        if entries is None:
+            entries = {}
+        if prefix and not group:
+            entries[prefix] = {}
+        for name, data in group.iteritems():
+            path = prefix + (name,)
+            if type(data) is dict:
+                self._flatten(data, path, entries)
+            elif data is None or type(data) is unicode:
+                entries[path] = data
+            elif type(data) is list:
+                entries[path] = tuple(data)
+            else:
+                raise JournalBuilderError("expected unicode, dict or list object, got %s" % type(data).__name__)
+        return entries
+
+    def _set(self, data, path, value):
+        for name in path[:-1]:
+            group = data.get(name)
+            if type(group) is not dict:
+                group = data[name] = {}
+            data = group
+        data[path[-1]] = value
+
+    def _remove(self, data, path):
+        groups = []
+        for name in path[:-1]:
+            group = data.get(name)
+            if type(group) is not dict:
+                return
+            groups.append((data, name))
+            data = group
+        data.pop(path[-1], None)
+        # groups left empty by the removal are dropped; a group that is meant to stay has its own record
+        for parent, name in reversed(groups):
+            if parent[name]:
+                break
+            del parent[name]
@@ -82,6 +82,7 @@ class SIPSettings(SettingsGroup):
     tcp_port = CorrelatedSetting(type=Port, sibling='tls_port', validator=sip_port_validator, default=0)
     tls_port = CorrelatedSetting(type=Port, sibling='tcp_port', validator=sip_port_validator, default=0)
     transport_list = Setting(type=SIPTransportList, default=SIPTransportList(('tls', 'tcp', 'udp')))
+    route_stagger = Setting(type=NonNegativeInteger, default=None, nillable=True)
 
 
 class TLSSettings(SettingsGroup):
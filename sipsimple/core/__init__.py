@@ -3,8 +3,9 @@ from sipsimple.core._core import *
 from sipsimple.core._engine import *
 from sipsimple.core._helpers import *
 from sipsimple.core._primitives import *
+from sipsimple.core._trace import *
 
-required_revision = 181
+required_revision = 186
 if CORE_REVISION != required_revision:
     raise ImportError("Wrong SIP core revision %d (expected %d)" % (CORE_REVISION, required_revision))
 del required_revision
@@ -143,7 +143,7 @@ cdef class BaseSIPURI:
             raise TypeError("unorderable types: {0.__class__.__name__}() {2} {1.__class__.__name__}()".format(self, other, operator_map[op]))
 
     def matches(self, address):
-        match = re.match(r'^((?P<scheme>sip|sips):)?(?P<username>.+?)(@(?P<domain>.+?)(:(?P<port>\d+?))?)?(;(?P<parameters>.+?))?(\?(?P<headers>.+?))?$', address)
+        match = _re_sipuri_address.match(address)
         if match is None:
             return False
         components = match.groupdict()
@@ -249,21 +249,14 @@ cdef class FrozenSIPURI(BaseSIPURI):
 
     @classmethod
     def parse(cls, object uri_str):
-        if not isinstance(uri_str, basestring):
-            raise TypeError('a string or unicode is required')
-        cdef bytes uri_bytes = str(uri_str)
-        cdef pjsip_uri *uri = NULL
-        cdef pj_pool_t *pool = NULL
-        cdef pj_str_t tmp
-        cdef char buffer[4096]
-        pool = pj_pool_create_on_buf("FrozenSIPURI_parse", buffer, sizeof(buffer))
-        if pool == NULL:
-            raise SIPCoreError("Could not allocate memory pool")
-        pj_strdup2_with_null(pool, &tmp, uri_bytes)
-        uri = pjsip_parse_uri(pool, tmp.ptr, tmp.slen, 0)
-        if uri == NULL:
-            raise SIPCoreError("Not a valid SIP URI: %s" % uri_str)
-        return FrozenSIPURI_create(<pjsip_sip_uri *>pjsip_uri_get_uri(uri))
+        return FrozenSIPURI_parse(uri_str)
+
+    @classmethod
+    def parse_many(cls, object uri_strs):
+        cdef list uris = []
+        for uri_str in uri_strs:
+            uris.append(FrozenSIPURI_parse(uri_str))
+        return uris
 
 
 # Factory functions
@@ -328,10 +321,46 @@ cdef FrozenSIPURI FrozenSIPURI_create(pjsip_sip_uri *uri):
     kwargs["headers"] = frozendict(kwargs["headers"])
     return FrozenSIPURI(**kwargs)
 
+cdef FrozenSIPURI FrozenSIPURI_parse(object uri_str):
+    # FrozenSIPURI objects are immutable, so the result of parsing a string is cached and the same object is returned
+    # for the same string. When the cache is full an arbitrary entry is evicted, which is good enough considering that
+    # the URIs which are seen over and over again will quickly make their way back in.
+    cdef FrozenSIPURI result
+    cdef bytes uri_bytes
+    cdef pjsip_uri *uri = NULL
+    cdef pj_pool_t *pool = NULL
+    cdef pj_str_t tmp
+    cdef char buffer[4096]
+    if not isinstance(uri_str, basestring):
+        raise TypeError('a string or unicode is required')
+    result = _FrozenSIPURI_parse_cache.get(uri_str)
+    if result is not None:
+        return result
+    uri_bytes = str(uri_str)
+    pool = pj_pool_create_on_buf("FrozenSIPURI_parse", buffer, sizeof(buffer))
+    if pool == NULL:
+        raise SIPCoreError("Could not allocate memory pool")
+    pj_strdup2_with_null(pool, &tmp, uri_bytes)
+    uri = pjsip_parse_uri(pool, tmp.ptr, tmp.slen, 0)
+    if uri == NULL:
+        raise SIPCoreError("Not a valid SIP URI: %s" % uri_str)
+    result = FrozenSIPURI_create(<pjsip_sip_uri *>pjsip_uri_get_uri(uri))
+    if len(_FrozenSIPURI_parse_cache) >= _FrozenSIPURI_parse_cache_size:
+        try:
+            _FrozenSIPURI_parse_cache.popitem()
+        except KeyError:
+            pass
+    _FrozenSIPURI_parse_cache[uri_str] = result
+    return result
+
 
 # Globals
 #
 
+cdef dict _FrozenSIPURI_parse_cache = {}
+cdef int _FrozenSIPURI_parse_cache_size = 4096
+cdef object _re_sipuri_address = re.compile(r'^((?P<scheme>sip|sips):)?(?P<username>.+?)(@(?P<domain>.+?)(:(?P<port>\d+?))?)?(;(?P<parameters>.+?))?(\?(?P<headers>.+?))?$')
+
 cdef PJSTR _Credentials_scheme_digest = PJSTR("digest")
 
 
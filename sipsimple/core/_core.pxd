@@ -8,7 +8,7 @@ cdef extern from *:
 # system imports
 
 from libc.stdlib cimport malloc, free
-from libc.string cimport memcpy
+from libc.string cimport memcpy, memset, strlen
 
 
 # Python C imports
@@ -47,6 +47,7 @@ cdef extern from "pjlib.h":
         char *ptr
         int slen
     ctypedef pj_str_t *pj_str_ptr_const "const pj_str_t *"
+    int pj_strcmp(pj_str_t *str1, pj_str_t *str2) nogil
 
     # errors
     pj_str_t pj_strerror(int statcode, char *buf, int bufsize) nogil
@@ -103,6 +104,7 @@ cdef extern from "pjlib.h":
     int pj_rwmutex_destroy(pj_rwmutex_t *mutex) nogil
     int pj_thread_is_registered() nogil
     int pj_thread_register(char *thread_name, long *thread_desc, pj_thread_t **thread) nogil
+    pj_thread_t *pj_thread_this() nogil
 
     # sockets
     enum:
@@ -127,6 +129,26 @@ cdef extern from "pjlib.h":
     int pj_sockaddr_has_addr(pj_sockaddr *addr) nogil
     int pj_sockaddr_init(int af, pj_sockaddr *addr, pj_str_t *cp, unsigned int port) nogil
     int pj_inet_pton(int af, pj_str_t *src, void *dst) nogil
+    enum:
+        PJ_INVALID_SOCKET
+    ctypedef long pj_sock_t
+    ctypedef void *pj_sockaddr_t_ptr_const "const pj_sockaddr_t *"
+    int pj_SOCK_DGRAM() nogil
+    unsigned int pj_sockaddr_get_len(pj_sockaddr *addr) nogil
+    int pj_sock_socket(int family, int type, int protocol, pj_sock_t *sock) nogil
+    int pj_sock_sendto(pj_sock_t sockfd, void *buf, long *len, unsigned int flags, pj_sockaddr *to, int tolen) nogil
+    int pj_sock_close(pj_sock_t sockfd) nogil
+
+    # active sockets
+    struct pj_activesock_t
+    struct pj_activesock_cfg
+    struct pj_activesock_cb:
+        int on_data_recvfrom(pj_activesock_t *asock, void *data, size_t size, pj_sockaddr_t_ptr_const src_addr,
+                             int addr_len, int status) nogil
+    int pj_activesock_create_udp(pj_pool_t *pool, pj_sockaddr *addr, pj_activesock_cfg *opt, pj_ioqueue_t *ioqueue,
+                                 pj_activesock_cb *cb, void *user_data, pj_activesock_t **p_asock, pj_sockaddr *bound_addr) nogil
+    int pj_activesock_start_recvfrom(pj_activesock_t *asock, pj_pool_t *pool, unsigned int buff_size, unsigned int flags) nogil
+    int pj_activesock_close(pj_activesock_t *asock) nogil
 
     # dns
     struct pj_dns_resolver
@@ -137,6 +159,10 @@ cdef extern from "pjlib.h":
         long sec
         long msec
     void pj_gettimeofday(pj_time_val *tv) nogil
+    ctypedef union pj_timestamp:
+        unsigned long long u64
+    int pj_get_timestamp(pj_timestamp *ts) nogil
+    int pj_get_timestamp_freq(pj_timestamp *freq) nogil
     void pj_time_val_normalize(pj_time_val *tv) nogil
 
     # timers
@@ -1069,6 +1095,7 @@ cdef extern from "pjsip.h":
         pjsip_rx_data_tp_info tp_info
         pjsip_rx_data_msg_info msg_info
     void *pjsip_hdr_clone(pj_pool_t *pool, void *hdr) nogil
+    pjsip_msg *pjsip_msg_clone(pj_pool_t *pool, pjsip_msg *msg) nogil
     void pjsip_msg_add_hdr(pjsip_msg *msg, pjsip_hdr *hdr) nogil
     void *pjsip_msg_find_hdr(pjsip_msg *msg, pjsip_hdr_e type, void *start) nogil
     void *pjsip_msg_find_hdr_by_name(pjsip_msg *msg, pj_str_t *name, void *start) nogil
@@ -1137,6 +1164,7 @@ cdef extern from "pjsip.h":
                                    pj_str_t *to, pj_str_t *contact, pj_str_t *call_id,
                                    int cseq,pj_str_t *text, pjsip_tx_data **p_tdata) nogil
     pj_timer_heap_t *pjsip_endpt_get_timer_heap(pjsip_endpoint *endpt) nogil
+    pj_ioqueue_t *pjsip_endpt_get_ioqueue(pjsip_endpoint *endpt) nogil
     int pjsip_endpt_create_resolver(pjsip_endpoint *endpt, pj_dns_resolver **p_resv) nogil
     int pjsip_endpt_set_resolver(pjsip_endpoint *endpt, pj_dns_resolver *resv) nogil
     pj_dns_resolver* pjsip_endpt_get_resolver(pjsip_endpoint *endpt) nogil
@@ -1410,6 +1438,18 @@ cdef class frozendict(object):
     cdef dict dict
     cdef long hash
 
+cdef class SIPMessageHeaders(object):
+    # attributes
+    cdef object __weakref__
+    cdef pj_pool_t *_pool
+    cdef pjsip_msg *_msg
+    cdef dict _cache
+    cdef dict _headers
+
+    # private methods
+    cdef object _lookup(self, object key)
+    cdef dict _get_headers(self)
+
 cdef class PJSTR(object):
     # attributes
     cdef pj_str_t pj_str
@@ -1523,6 +1563,7 @@ cdef class FrozenSIPURI(BaseSIPURI):
 
 cdef SIPURI SIPURI_create(pjsip_sip_uri *base_uri)
 cdef FrozenSIPURI FrozenSIPURI_create(pjsip_sip_uri *base_uri)
+cdef FrozenSIPURI FrozenSIPURI_parse(object uri_str)
 
 # core.headers
 
@@ -1804,7 +1845,11 @@ cdef object _pj_status_to_str(int status)
 cdef object _pj_status_to_def(int status)
 cdef dict _pjsip_param_to_dict(pjsip_param *param_list)
 cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t *pool)
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name, int *multi_header)
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg)
 cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg)
+cdef int _detach_message_headers() except -1
 cdef int _is_valid_ip(int af, object ip) except -1
 cdef int _get_ip_version(object ip) except -1
 cdef int _add_headers_to_tdata(pjsip_tx_data *tdata, object headers) except -1
@@ -1812,6 +1857,38 @@ cdef int _remove_headers_from_tdata(pjsip_tx_data *tdata, object headers) except
 cdef int _BaseSIPURI_to_pjsip_sip_uri(BaseSIPURI uri, pjsip_sip_uri *pj_uri, pj_pool_t *pool) except -1
 cdef int _BaseRouteHeader_to_pjsip_route_hdr(BaseIdentityHeader header, pjsip_route_hdr *pj_header, pj_pool_t *pool) except -1
 
+# core.trace
+
+cdef class SIPTraceBuffer(object):
+    # attributes
+    cdef char *_data
+    cdef int _size
+    cdef int _head
+    cdef int _tail
+    cdef int _used
+    cdef list _methods
+    cdef char _status_codes[700]
+    cdef int _filter_status
+    cdef int _sample_rate
+    cdef int _sample_count
+    cdef unsigned long _seen
+    cdef unsigned long _captured
+    cdef unsigned long _filtered
+    cdef unsigned long _sampled_out
+    cdef unsigned long _dropped
+
+    # private methods
+    cdef int _accepts(self, pjsip_msg *msg)
+    cdef int _add(self, int received, pjsip_msg *msg, char *packet, int length, char *transport,
+                  pj_str_t *source_ip, int source_port, pj_str_t *destination_ip, int destination_port) except -1
+    cdef int _add_rx(self, pjsip_rx_data *rdata) except -1
+    cdef int _add_tx(self, pjsip_tx_data *tdata) except -1
+    cdef void _write(self, void *data, int length)
+    cdef void _read(self, void *data, int length)
+
+cdef void _copy_c_string(char *destination, char *source, int size)
+cdef void _copy_pj_str(char *destination, pj_str_t *source, int size)
+
 # core.ua
 
 ctypedef int (*timer_callback)(object, object) except -1 with gil
@@ -1821,12 +1898,41 @@ cdef class Timer(object):
     cdef double schedule_time
     cdef timer_callback callback
     cdef object obj
+    cdef Timer _prev
+    cdef Timer _next
+    cdef int _level
+    cdef unsigned long long _sequence
+    cdef unsigned long long _batch
 
     # private methods
     cdef int schedule(self, float delay, timer_callback callback, object obj) except -1
     cdef int cancel(self) except -1
     cdef int call(self) except -1
 
+cdef class TimerWheel(object):
+    # attributes
+    cdef double _resolution
+    cdef list _slots
+    cdef long long _current_tick
+    cdef unsigned long long _sequence
+    cdef unsigned long long _batch
+    cdef int _count
+    cdef int _level_count[5]
+
+    # private methods
+    cdef long long _tick(self, double timestamp)
+    cdef int add(self, Timer timer) except -1
+    cdef int remove(self, Timer timer) except -1
+    cdef double next_deadline(self)
+    cdef list expire(self, double now)
+    cdef dict statistics(self, double now)
+    cdef int _insert(self, Timer timer, long long tick) except -1
+    cdef int _cascade(self) except -1
+    cdef int _reinsert(self, Timer sentinel) except -1
+    cdef int _link(self, Timer timer, Timer sentinel, int level) except -1
+    cdef int _unlink(self, Timer timer) except -1
+    cdef int _clear_slot(self, Timer sentinel) except -1
+
 cdef class PJSIPThread(object):
     # attributes
     cdef pj_thread_t *_obj
@@ -1836,7 +1942,7 @@ cdef class PJSIPUA(object):
     # attributes
     cdef object _threads
     cdef object _event_handler
-    cdef list _timers
+    cdef TimerWheel _timers
     cdef PJLIB _pjlib
     cdef PJCachingPool _caching_pool
     cdef PJSIPEndpoint _pjsip_endpoint
@@ -1852,6 +1958,7 @@ cdef class PJSIPUA(object):
     cdef pjsip_module _event_module
     cdef PJSTR _event_module_name
     cdef int _trace_sip
+    cdef int _eager_headers
     cdef int _detect_sip_loops
     cdef int _enable_colorbar_device
     cdef PJSTR _user_agent
@@ -1871,12 +1978,22 @@ cdef class PJSIPUA(object):
     cdef list old_devices
     cdef list old_video_devices
     cdef object _zrtp_cache
+    cdef SIPTraceBuffer _trace_buffer
+    cdef pj_activesock_t *_wakeup_asock
+    cdef pj_sock_t _wakeup_sock
+    cdef pj_sockaddr _wakeup_addr
+    cdef pj_thread_t *_poll_thread
+    cdef int _polling
+    cdef int _foreign_activity
+    cdef double _idle_timeout
 
     # private methods
     cdef object _get_sound_devices(self, int is_output)
     cdef object _get_default_sound_device(self, int is_output)
     cdef object _get_video_devices(self)
     cdef object _get_default_video_device(self)
+    cdef int _init_wakeup(self) except -1
+    cdef int _wakeup(self) except -1
     cdef int _poll_log(self) except -1
     cdef int _handle_exception(self, int is_fatal) except -1
     cdef int _check_self(self) except -1
@@ -1890,12 +2007,15 @@ cdef class PJSIPUA(object):
     cdef void reset_memory_pool(self, pj_pool_t* pool)
 
 cdef int _PJSIPUA_cb_rx_request(pjsip_rx_data *rdata) with gil
+cdef int _cb_wakeup_recvfrom(pj_activesock_t *asock, void *data, size_t size, pj_sockaddr_t_ptr_const src_addr,
+                             int addr_len, int status) nogil
 cdef void _cb_detect_nat_type(void *user_data, pj_stun_nat_detect_result_ptr_const res) with gil
 cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) with gil
 cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil
 cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil
 cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) with gil
 cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) with gil
+cdef double _monotonic_time()
 cdef PJSIPUA _get_ua()
 cdef int deallocate_weakref(object weak_ref, object timer) except -1 with gil
 
@@ -2229,7 +2349,7 @@ cdef class Subscription(object):
     cdef int _cancel_timers(self, PJSIPUA ua, int cancel_timeout, int cancel_refresh) except -1
     cdef int _send_subscribe(self, PJSIPUA ua, int expires, pj_time_val *timeout,
                              object extra_headers, object content_type, object body) except -1
-    cdef int _cb_state(self, PJSIPUA ua, object state, int code, object reason, dict headers) except -1
+    cdef int _cb_state(self, PJSIPUA ua, object state, int code, object reason, object headers) except -1
     cdef int _cb_got_response(self, PJSIPUA ua, pjsip_rx_data *rdata) except -1
     cdef int _cb_notify(self, PJSIPUA ua, pjsip_rx_data *rdata) except -1
     cdef int _cb_timeout_timer(self, PJSIPUA ua)
@@ -5,6 +5,7 @@ include "_core.sound.pxi"
 include "_core.pipe.pxi"
 include "_core.video.pxi"
 include "_core.util.pxi"
+include "_core.trace.pxi"
 
 include "_core.ua.pxi"
 
@@ -22,7 +23,7 @@ include "_core.mediatransport.pxi"
 
 PJ_VERSION = pj_get_version()
 PJ_SVN_REVISION = int(PJ_SVN_REV)
-CORE_REVISION = 181
+CORE_REVISION = 186
 
 # exports
 
@@ -30,7 +31,7 @@ __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION",
            "SIPCoreError", "PJSIPError", "PJSIPTLSError", "SIPCoreInvalidStateError",
            "AudioMixer", "ToneGenerator", "RecordingWaveFile", "WaveFile", "MixerPort", "PipeFile", "RecordingPipeFile",
            "VideoCamera", "FrameBufferVideoRenderer",
-           "sip_status_messages",
+           "sip_status_messages", "SIPMessageHeaders",
            "BaseCredentials", "Credentials", "FrozenCredentials", "BaseSIPURI", "SIPURI", "FrozenSIPURI",
            "BaseHeader", "Header", "FrozenHeader",
            "BaseContactHeader", "ContactHeader", "FrozenContactHeader",
@@ -44,6 +45,7 @@ __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION",
            "BaseSubjectHeader", "SubjectHeader", "FrozenSubjectHeader",
            "BaseReplacesHeader", "ReplacesHeader", "FrozenReplacesHeader",
            "BaseGatewayIdHeader", "GatewayIdHeader", "FrozenGatewayIdHeader",
+           "SIPTraceBuffer", "SIPTraceRecord",
            "Request",
            "Referral",
            "sipfrag_re",
@@ -232,7 +232,7 @@ cdef class Subscription:
 
     # callback methods
 
-    cdef int _cb_state(self, PJSIPUA ua, object state, int code, object reason, dict headers) except -1:
+    cdef int _cb_state(self, PJSIPUA ua, object state, int code, object reason, object headers) except -1:
         # PJSIP holds the dialog lock when this callback is entered
         cdef object prev_state = self.state
         cdef int expires
@@ -275,13 +275,14 @@ cdef class Subscription:
                 _add_event("SIPSubscriptionDidEnd", dict(obj=self))
             else:
                 min_expires = headers.get('Min-Expires')
+                retry_after = headers.get('Retry-After')
                 if self._term_reason is not None:
-                    _add_event("SIPSubscriptionDidFail", dict(obj=self, code=self._term_code, reason=self._term_reason, min_expires=min_expires))
+                    _add_event("SIPSubscriptionDidFail", dict(obj=self, code=self._term_code, reason=self._term_reason, min_expires=min_expires, retry_after=retry_after))
                 else:
                     subscription_state = headers.get('Subscription-State')
                     if subscription_state is not None and subscription_state.state == 'terminated':
                         reason = subscription_state.reason
-                    _add_event("SIPSubscriptionDidFail", dict(obj=self, code=code, reason=reason, min_expires=min_expires))
+                    _add_event("SIPSubscriptionDidFail", dict(obj=self, code=code, reason=reason, min_expires=min_expires, retry_after=retry_after))
         if prev_state != state:
             _add_event("SIPSubscriptionChangedState", dict(obj=self, prev_state=prev_state, state=state))
 
@@ -0,0 +1,210 @@
+from collections import namedtuple
+
+
+SIPTraceRecord = namedtuple('SIPTraceRecord', ['timestamp', 'received', 'transport', 'source_ip', 'source_port', 'destination_ip', 'destination_port', 'data'])
+
+
+# C types
+
+cdef struct _trace_record:
+    double timestamp
+    int received
+    int length
+    int source_port
+    int destination_port
+    char transport[16]
+    char source_ip[64]
+    char destination_ip[64]
+
+
+# classes
+
+cdef class SIPTraceBuffer:
+    # The SIP trace buffer is a preallocated ring buffer into which the trace module copies the raw packets it
+    # sees, without creating any python objects on the path of the engine thread. The packets are converted into
+    # SIPTraceRecord objects only when the buffer is drained, which is meant to happen in bulk on another thread.
+
+    def __cinit__(self, *args, **kwargs):
+        self._data = NULL
+
+    def __init__(self, int size=4194304, object methods=None, object status_codes=None, int sample_rate=1):
+        cdef int code
+        if self._data != NULL:
+            raise SIPCoreError("SIPTraceBuffer.__init__() was already called")
+        if size <= sizeof(_trace_record):
+            raise ValueError("size must be larger than %d bytes" % sizeof(_trace_record))
+        if sample_rate < 1:
+            raise ValueError("sample_rate must be a positive number")
+        if methods is not None:
+            self._methods = [PJSTR(str(method)) for method in methods]
+        memset(self._status_codes, 0, sizeof(self._status_codes))
+        if status_codes is not None:
+            for code in status_codes:
+                if not (100 <= code <= 699):
+                    raise ValueError("invalid SIP status code: %d" % code)
+                self._status_codes[code] = 1
+            self._filter_status = 1
+        self._sample_rate = sample_rate
+        self._data = <char *> malloc(size)
+        if self._data == NULL:
+            raise MemoryError()
+        self._size = size
+
+    def __dealloc__(self):
+        if self._data != NULL:
+            free(self._data)
+            self._data = NULL
+
+    property size:
+
+        def __get__(self):
+            return self._size
+
+    property used:
+
+        def __get__(self):
+            return self._used
+
+    property methods:
+
+        def __get__(self):
+            if self._methods is None:
+                return None
+            return frozenset(method.str for method in self._methods)
+
+    property status_codes:
+
+        def __get__(self):
+            cdef int code
+            if not self._filter_status:
+                return None
+            return frozenset(code for code in range(100, 700) if self._status_codes[code])
+
+    property sample_rate:
+
+        def __get__(self):
+            return self._sample_rate
+
+    property statistics:
+
+        def __get__(self):
+            return dict(seen=self._seen, captured=self._captured, filtered=self._filtered, sampled_out=self._sampled_out, dropped=self._dropped)
+
+    def drain(self, int max_records=-1):
+        cdef _trace_record record
+        cdef object data
+        cdef list records = []
+        while self._used > 0 and (max_records < 0 or len(records) < max_records):
+            self._read(&record, sizeof(_trace_record))
+            data = PyString_FromStringAndSize(NULL, record.length)
+            self._read(PyString_AsString(data), record.length)
+            records.append(SIPTraceRecord(record.timestamp, bool(record.received), PyString_FromString(record.transport),
+                                          PyString_FromString(record.source_ip), record.source_port,
+                                          PyString_FromString(record.destination_ip), record.destination_port, data))
+        return records
+
+    def clear(self):
+        self._head = self._tail = self._used = 0
+
+    cdef int _accepts(self, pjsip_msg *msg):
+        cdef pjsip_cseq_hdr *cseq_hdr
+        cdef pjsip_method *method = NULL
+        cdef PJSTR method_name
+        if msg == NULL:
+            return self._methods is None and not self._filter_status
+        if msg.type == PJSIP_RESPONSE_MSG:
+            if self._filter_status and not (100 <= msg.line.status.code <= 699 and self._status_codes[msg.line.status.code]):
+                return 0
+            cseq_hdr = <pjsip_cseq_hdr *> pjsip_msg_find_hdr(msg, PJSIP_H_CSEQ, NULL)
+            if cseq_hdr != NULL:
+                method = &cseq_hdr.method
+        else:
+            method = &msg.line.req.method
+        if self._methods is None:
+            return 1
+        if method == NULL:
+            return 0
+        for method_name in self._methods:
+            if pj_strcmp(&method.name, &method_name.pj_str) == 0:
+                return 1
+        return 0
+
+    cdef int _add(self, int received, pjsip_msg *msg, char *packet, int length, char *transport,
+                  pj_str_t *source_ip, int source_port, pj_str_t *destination_ip, int destination_port) except -1:
+        cdef _trace_record record
+        cdef pj_time_val now
+        self._seen += 1
+        if not self._accepts(msg):
+            self._filtered += 1
+            return 0
+        self._sample_count += 1
+        if self._sample_count < self._sample_rate:
+            self._sampled_out += 1
+            return 0
+        self._sample_count = 0
+        if length < 0 or sizeof(_trace_record) + length > self._size - self._used:
+            self._dropped += 1
+            return 0
+        pj_gettimeofday(&now)
+        record.timestamp = now.sec + now.msec / 1000.0
+        record.received = received
+        record.length = length
+        record.source_port = source_port
+        record.destination_port = destination_port
+        _copy_c_string(record.transport, transport, sizeof(record.transport))
+        _copy_pj_str(record.source_ip, source_ip, sizeof(record.source_ip))
+        _copy_pj_str(record.destination_ip, destination_ip, sizeof(record.destination_ip))
+        self._write(&record, sizeof(_trace_record))
+        self._write(packet, length)
+        self._captured += 1
+        return 0
+
+    cdef int _add_rx(self, pjsip_rx_data *rdata) except -1:
+        cdef pj_str_t source_ip
+        source_ip.ptr = rdata.pkt_info.src_name
+        source_ip.slen = strlen(rdata.pkt_info.src_name)
+        return self._add(1, rdata.msg_info.msg, rdata.pkt_info.packet, rdata.pkt_info.len,
+                         rdata.tp_info.transport.type_name, &source_ip, rdata.pkt_info.src_port,
+                         &rdata.tp_info.transport.local_name.host, rdata.tp_info.transport.local_name.port)
+
+    cdef int _add_tx(self, pjsip_tx_data *tdata) except -1:
+        cdef pj_str_t destination_ip
+        destination_ip.ptr = tdata.tp_info.dst_name
+        destination_ip.slen = strlen(tdata.tp_info.dst_name)
+        return self._add(0, tdata.msg, tdata.buf.start, tdata.buf.cur - tdata.buf.start,
+                         tdata.tp_info.transport.type_name, &tdata.tp_info.transport.local_name.host,
+                         tdata.tp_info.transport.local_name.port, &destination_ip, tdata.tp_info.dst_port)
+
+    cdef void _write(self, void *data, int length):
+        cdef int chunk = min(length, self._size - self._head)
+        memcpy(self._data + self._head, data, chunk)
+        if chunk < length:
+            memcpy(self._data, <char *> data + chunk, length - chunk)
+        self._head = (self._head + length) % self._size
+        self._used += length
+
+    cdef void _read(self, void *data, int length):
+        cdef int chunk = min(length, self._size - self._tail)
+        memcpy(data, self._data + self._tail, chunk)
+        if chunk < length:
+            memcpy(<char *> data + chunk, self._data, length - chunk)
+        self._tail = (self._tail + length) % self._size
+        self._used -= length
+
+
+# functions
+
+cdef void _copy_c_string(char *destination, char *source, int size):
+    cdef int length = 0
+    if source != NULL:
+        length = min(<int> strlen(source), size - 1)
+        memcpy(destination, source, length)
+    destination[length] = 0
+
+cdef void _copy_pj_str(char *destination, pj_str_t *source, int size):
+    cdef int length = min(source.slen, size - 1)
+    if length < 0:
+        length = 0
+    memcpy(destination, source.ptr, length)
+    destination[length] = 0
+
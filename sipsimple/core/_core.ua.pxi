@@ -1,10 +1,8 @@
 
 import errno
-import heapq
 import re
 import random
 import sys
-import time
 import traceback
 import os
 import tempfile
@@ -19,7 +17,7 @@ cdef class Timer:
             raise ValueError("callback must be non-NULL")
         if self._scheduled:
             raise RuntimeError("already scheduled")
-        self.schedule_time = PyFloat_AsDouble(time.time() + delay)
+        self.schedule_time = _monotonic_time() + delay
         self.callback = callback
         self.obj = obj
         ua._add_timer(self)
@@ -38,24 +36,232 @@ cdef class Timer:
         self._scheduled = 0
         self.callback(self.obj, self)
 
-    def __richcmp__(self, other, op):
-        cdef double diff
-        if not isinstance(self, Timer) or not isinstance(other, Timer):
-            return NotImplemented
-        diff = (<Timer>self).schedule_time - (<Timer>other).schedule_time
-        if op == 0: # <
-            return diff < 0.0
-        elif op == 1: # <=
-            return diff <= 0.0
-        elif op == 2: # ==
-            return diff == 0.0
-        elif op == 3: # !=
-            return diff != 0.0
-        elif op == 4: # >
-            return diff > 0.0
-        elif op == 5: # >=
-            return diff >= 0.0
-        return
+
+cdef class TimerWheel:
+    # A hierarchical timing wheel that keeps the scheduled timers in circular doubly linked lists, one for each
+    # slot, so that adding and removing a timer are O(1) operations. The first level has 256 slots, one for each
+    # tick, and each of the next 3 levels has 64 slots covering the whole span of the previous level. Timers that
+    # are further away than the last level can cover (about 7.7 days with the default resolution) are kept in an
+    # overflow list. The timers from a slot of a higher level are cascaded to the lower levels when the wheel
+    # reaches the slot. The time is taken from a monotonic clock.
+
+    def __cinit__(self, double resolution=0.01):
+        cdef Timer sentinel
+        cdef int index
+        if resolution <= 0:
+            raise ValueError("resolution must be a positive number")
+        self._resolution = resolution
+        self._slots = list()
+        for index in range(_TW_SLOT_COUNT):
+            sentinel = Timer()
+            sentinel._prev = sentinel._next = sentinel
+            self._slots.append(sentinel)
+        self._current_tick = self._tick(_monotonic_time())
+
+    def __dealloc__(self):
+        cdef Timer sentinel
+        if self._slots is not None:
+            for sentinel in self._slots:
+                self._clear_slot(sentinel)
+
+    property count:
+
+        def __get__(self):
+            return self._count
+
+    cdef long long _tick(self, double timestamp):
+        # The tick is adjusted so that it agrees with the deadlines computed by next_deadline as tick * resolution,
+        # otherwise the division could round a deadline that was reached to the previous tick and leave the wheel
+        # waiting for it with a 0 timeout.
+        cdef long long tick = <long long> (timestamp / self._resolution)
+        if (tick + 1) * self._resolution <= timestamp:
+            tick += 1
+        elif tick > 0 and tick * self._resolution > timestamp:
+            tick -= 1
+        return tick
+
+    cdef int add(self, Timer timer) except -1:
+        self._sequence += 1
+        timer._sequence = self._sequence
+        timer._batch = 0
+        self._insert(timer, self._tick(timer.schedule_time))
+        return 0
+
+    cdef int remove(self, Timer timer) except -1:
+        timer._batch = 0
+        if timer._next is None:
+            return 0
+        self._unlink(timer)
+        return 0
+
+    cdef double next_deadline(self):
+        # Returns the time when the wheel needs attention next or -1 if there are no timers. This is the earliest of
+        # the first timer on the first level and the time when the next slot from the higher levels will be cascaded,
+        # as the cascaded timers can expire before the ones from the first level that are past the cascade boundary.
+        cdef Timer sentinel
+        cdef Timer timer
+        cdef double deadline
+        cdef double cascade_deadline
+        cdef int index
+        if self._count == 0:
+            return -1
+        cascade_deadline = ((self._current_tick | _TW_ROOT_MASK) + 1) * self._resolution
+        if self._level_count[0] > 0:
+            for index in range(_TW_ROOT_SIZE):
+                sentinel = self._slots[(self._current_tick + index) & _TW_ROOT_MASK]
+                timer = sentinel._next
+                if timer is sentinel:
+                    continue
+                deadline = timer.schedule_time
+                while timer is not sentinel:
+                    deadline = min(deadline, timer.schedule_time)
+                    timer = timer._next
+                return min(deadline, cascade_deadline)
+        return cascade_deadline
+
+    cdef list expire(self, double now):
+        # Removes the timers that expired at the given time from the wheel and returns them in the order in
+        # which they expired. Timers that expired at the same time are returned in the order they were added.
+        # The returned timers are tagged with the number of the batch, which is cleared when they are removed
+        # or added again, so that the caller can skip the ones that a previous callback cancelled or rescheduled.
+        cdef Timer sentinel
+        cdef Timer timer
+        cdef Timer next_timer
+        cdef list expired = list()
+        cdef long long now_tick = self._tick(now)
+        self._batch += 1
+        while self._current_tick < now_tick:
+            if self._count == 0:
+                self._current_tick = now_tick
+                break
+            if self._level_count[0] == 0:
+                # nothing to expire from the first level until the next cascade
+                if (self._current_tick | _TW_ROOT_MASK) + 1 > now_tick:
+                    self._current_tick = now_tick
+                    break
+                self._current_tick = (self._current_tick | _TW_ROOT_MASK) + 1
+            else:
+                sentinel = self._slots[self._current_tick & _TW_ROOT_MASK]
+                timer = sentinel._next
+                while timer is not sentinel:
+                    next_timer = timer._next
+                    self._unlink(timer)
+                    timer._batch = self._batch
+                    expired.append((timer.schedule_time, timer._sequence, timer))
+                    timer = next_timer
+                self._current_tick += 1
+            if self._current_tick & _TW_ROOT_MASK == 0:
+                self._cascade()
+        sentinel = self._slots[self._current_tick & _TW_ROOT_MASK]
+        timer = sentinel._next
+        while timer is not sentinel:
+            next_timer = timer._next
+            if timer.schedule_time <= now:
+                self._unlink(timer)
+                timer._batch = self._batch
+                expired.append((timer.schedule_time, timer._sequence, timer))
+            timer = next_timer
+        expired.sort()
+        return [entry[2] for entry in expired]
+
+    cdef dict statistics(self, double now):
+        cdef Timer sentinel
+        cdef Timer timer
+        cdef double remaining
+        cdef int index
+        cdef list histogram = [[limit, 0] for limit in _TW_HISTOGRAM_LIMITS]
+        for sentinel in self._slots:
+            timer = sentinel._next
+            while timer is not sentinel:
+                remaining = timer.schedule_time - now
+                for index in range(len(_TW_HISTOGRAM_LIMITS)):
+                    if _TW_HISTOGRAM_LIMITS[index] is None or remaining <= _TW_HISTOGRAM_LIMITS[index]:
+                        histogram[index][1] += 1
+                        break
+                timer = timer._next
+        deadline = self.next_deadline()
+        return dict(pending=self._count,
+                    next_deadline=max(deadline - now, 0.0) if deadline >= 0 else None,
+                    levels=[self._level_count[index] for index in range(_TW_LEVEL_COUNT)],
+                    histogram=[tuple(entry) for entry in histogram])
+
+    cdef int _insert(self, Timer timer, long long tick) except -1:
+        cdef long long delta
+        cdef int level
+        cdef int index
+        if tick < self._current_tick:
+            tick = self._current_tick
+        delta = tick - self._current_tick
+        if delta < _TW_ROOT_SIZE:
+            level = 0
+            index = tick & _TW_ROOT_MASK
+        elif delta < 1LL << (_TW_ROOT_BITS + _TW_LEVEL_BITS):
+            level = 1
+            index = _TW_ROOT_SIZE + ((tick >> _TW_ROOT_BITS) & _TW_LEVEL_MASK)
+        elif delta < 1LL << (_TW_ROOT_BITS + 2*_TW_LEVEL_BITS):
+            level = 2
+            index = _TW_ROOT_SIZE + _TW_LEVEL_SIZE + ((tick >> (_TW_ROOT_BITS + _TW_LEVEL_BITS)) & _TW_LEVEL_MASK)
+        elif delta < 1LL << (_TW_ROOT_BITS + 3*_TW_LEVEL_BITS):
+            level = 3
+            index = _TW_ROOT_SIZE + 2*_TW_LEVEL_SIZE + ((tick >> (_TW_ROOT_BITS + 2*_TW_LEVEL_BITS)) & _TW_LEVEL_MASK)
+        else:
+            level = 4
+            index = _TW_SLOT_COUNT - 1
+        self._link(timer, self._slots[index], level)
+        return 0
+
+    cdef int _cascade(self) except -1:
+        # called when the first level completes a rotation
+        cdef long long tick = self._current_tick
+        if (tick >> _TW_ROOT_BITS) & _TW_LEVEL_MASK == 0:
+            if (tick >> (_TW_ROOT_BITS + _TW_LEVEL_BITS)) & _TW_LEVEL_MASK == 0:
+                if (tick >> (_TW_ROOT_BITS + 2*_TW_LEVEL_BITS)) & _TW_LEVEL_MASK == 0:
+                    self._reinsert(self._slots[_TW_SLOT_COUNT - 1])
+                self._reinsert(self._slots[_TW_ROOT_SIZE + 2*_TW_LEVEL_SIZE + ((tick >> (_TW_ROOT_BITS + 2*_TW_LEVEL_BITS)) & _TW_LEVEL_MASK)])
+            self._reinsert(self._slots[_TW_ROOT_SIZE + _TW_LEVEL_SIZE + ((tick >> (_TW_ROOT_BITS + _TW_LEVEL_BITS)) & _TW_LEVEL_MASK)])
+        self._reinsert(self._slots[_TW_ROOT_SIZE + ((tick >> _TW_ROOT_BITS) & _TW_LEVEL_MASK)])
+        return 0
+
+    cdef int _reinsert(self, Timer sentinel) except -1:
+        cdef Timer timer
+        cdef list timers = list()
+        timer = sentinel._next
+        while timer is not sentinel:
+            timers.append(timer)
+            timer = timer._next
+        for timer in timers:
+            self._unlink(timer)
+            self._insert(timer, self._tick(timer.schedule_time))
+        return 0
+
+    cdef int _link(self, Timer timer, Timer sentinel, int level) except -1:
+        timer._prev = sentinel._prev
+        timer._next = sentinel
+        sentinel._prev._next = timer
+        sentinel._prev = timer
+        timer._level = level
+        self._level_count[level] += 1
+        self._count += 1
+        return 0
+
+    cdef int _unlink(self, Timer timer) except -1:
+        timer._prev._next = timer._next
+        timer._next._prev = timer._prev
+        timer._prev = timer._next = None
+        self._level_count[timer._level] -= 1
+        self._count -= 1
+        return 0
+
+    cdef int _clear_slot(self, Timer sentinel) except -1:
+        # break the reference cycles between the timers in a slot
+        cdef Timer timer = sentinel._next
+        cdef Timer next_timer
+        while timer is not None and timer is not sentinel:
+            next_timer = timer._next
+            timer._prev = timer._next = None
+            timer = next_timer
+        sentinel._prev = sentinel._next = None
+        return 0
 
 
 cdef class PJSIPUA:
@@ -65,11 +271,12 @@ cdef class PJSIPUA:
             raise SIPCoreError("Can only have one PJSUPUA instance at the same time")
         _ua = <void *> self
         self._threads = []
-        self._timers = list()
+        self._timers = TimerWheel()
         self._events = {}
         self._incoming_events = set()
         self._incoming_requests = set()
         self._sent_messages = set()
+        self._wakeup_sock = PJ_INVALID_SOCKET
 
     def __init__(self, event_handler, *args, **kwargs):
         global _event_queue_lock
@@ -100,6 +307,13 @@ cdef class PJSIPUA:
         status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "event_queue_lock", &_event_queue_lock)
         if status != 0:
             raise PJSIPError("Could not initialize event queue mutex", status)
+        self._idle_timeout = kwargs["idle_timeout"]
+        if self._idle_timeout <= 0:
+            raise ValueError("idle_timeout must be a positive number")
+        if kwargs["wakeup"]:
+            # without it the wait is only interrupted by network activity, which is how the engine worked before
+            # when combined with an idle_timeout of 100ms
+            self._init_wakeup()
         self._ip_address = kwargs["ip_address"]
         self.codecs = kwargs["codecs"]
         self.video_codecs = kwargs["video_codecs"]
@@ -135,6 +349,7 @@ cdef class PJSIPUA:
         if status != 0:
             raise PJSIPError("Could not add 'gruu' to Supported header", status)
         self._trace_sip = int(bool(kwargs["trace_sip"]))
+        self._eager_headers = int(bool(kwargs["eager_headers"]))
         self._detect_sip_loops = int(bool(kwargs["detect_sip_loops"]))
         self._enable_colorbar_device = int(bool(kwargs["enable_colorbar_device"]))
         self._opus_fix_module_name = PJSTR("mod-core-opus-fix")
@@ -213,6 +428,32 @@ cdef class PJSIPUA:
             self._check_self()
             self._trace_sip = int(bool(value))
 
+    property eager_headers:
+
+        def __get__(self):
+            self._check_self()
+            return bool(self._eager_headers)
+
+        def __set__(self, value):
+            self._check_self()
+            self._eager_headers = int(bool(value))
+
+    property trace_buffer:
+
+        def __get__(self):
+            self._check_self()
+            return self._trace_buffer
+
+        def __set__(self, SIPTraceBuffer value):
+            self._check_self()
+            self._trace_buffer = value
+
+    property timer_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return self._timers.statistics(_monotonic_time())
+
     property detect_sip_loops:
 
         def __get__(self):
@@ -776,10 +1017,17 @@ cdef class PJSIPUA:
             pj_mutex_destroy(self.video_lock)
             self.video_lock = NULL
         _process_handler_queue(self, &_dealloc_handler_queue)
+        if self._wakeup_asock != NULL:
+            pj_activesock_close(self._wakeup_asock)
+            self._wakeup_asock = NULL
+        if self._wakeup_sock != PJ_INVALID_SOCKET:
+            pj_sock_close(self._wakeup_sock)
+            self._wakeup_sock = PJ_INVALID_SOCKET
         if _event_queue_lock != NULL:
             pj_mutex_lock(_event_queue_lock)
             pj_mutex_destroy(_event_queue_lock)
             _event_queue_lock = NULL
+        _detach_message_headers()
         self._pjsip_endpoint = None
         self._pjmedia_endpoint = None
         self._caching_pool = None
@@ -787,38 +1035,90 @@ cdef class PJSIPUA:
         _ua = NULL
         self._poll_log()
 
+    cdef int _init_wakeup(self) except -1:
+        cdef pj_activesock_cb wakeup_cb
+        cdef pj_sockaddr local_addr
+        cdef PJSTR loopback_address = PJSTR("127.0.0.1")
+        cdef int status
+        memset(&wakeup_cb, 0, sizeof(wakeup_cb))
+        wakeup_cb.on_data_recvfrom = _cb_wakeup_recvfrom
+        status = pj_sockaddr_init(pj_AF_INET(), &local_addr, &loopback_address.pj_str, 0)
+        if status != 0:
+            raise PJSIPError("Could not initialize wake-up socket address", status)
+        status = pj_activesock_create_udp(self._pjsip_endpoint._pool, &local_addr, NULL,
+                                          pjsip_endpt_get_ioqueue(self._pjsip_endpoint._obj), &wakeup_cb, NULL,
+                                          &self._wakeup_asock, &self._wakeup_addr)
+        if status != 0:
+            raise PJSIPError("Could not create wake-up socket", status)
+        status = pj_activesock_start_recvfrom(self._wakeup_asock, self._pjsip_endpoint._pool, 16, 0)
+        if status != 0:
+            raise PJSIPError("Could not start reading from wake-up socket", status)
+        status = pj_sock_socket(pj_AF_INET(), pj_SOCK_DGRAM(), 0, &self._wakeup_sock)
+        if status != 0:
+            raise PJSIPError("Could not create wake-up sender socket", status)
+        return 0
+
+    cdef int _wakeup(self) except -1:
+        # Interrupt a poll that is waiting for events in the engine thread. It is a no-op when called from the
+        # engine thread itself, or when a wake-up is already pending, as the wait will be recomputed anyway.
+        global _wakeup_pending
+        cdef long length = 1
+        cdef char data = 0
+        cdef int status
+        if not self._polling or pj_thread_this() == self._poll_thread:
+            return 0
+        self._foreign_activity = 1
+        if _wakeup_pending or self._wakeup_sock == PJ_INVALID_SOCKET:
+            return 0
+        _wakeup_pending = 1
+        with nogil:
+            status = pj_sock_sendto(self._wakeup_sock, &data, &length, 0, &self._wakeup_addr, pj_sockaddr_get_len(&self._wakeup_addr))
+        if status != 0:
+            # nothing will be received to clear the flag, so let the next call try again
+            _wakeup_pending = 0
+        return 0
+
+    def wakeup(self):
+        self._check_self()  # this wakes up the engine thread if it's waiting for events
+
     cdef int _poll_log(self) except -1:
         cdef object event_name
         cdef dict event_params
         cdef list events
         events = _get_clear_event_queue()
-        for event_name, event_params in events:
-            self._event_handler(event_name, **event_params)
+        if events:
+            self._event_handler(events)
 
     def poll(self):
         global _post_poll_handler_queue
         cdef int status
-        cdef double now
+        cdef double next_deadline
         cdef object retval = None
         cdef float max_timeout
         cdef pj_time_val pj_max_timeout
         cdef list timers
         cdef Timer timer
+        cdef unsigned long long batch
 
         self._check_self()
 
-        max_timeout = 0.100
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            else:
-                max_timeout = min(max((<Timer>self._timers[0]).schedule_time - time.time(), 0.0), max_timeout)
-                break
+        self._polling = 1
+        self._poll_thread = pj_thread_this()
+        if self._foreign_activity:
+            # Other threads used the core since the last poll and may have scheduled PJSIP timers after
+            # the wait was computed, so wait for a short interval in order to pick them up in time.
+            self._foreign_activity = 0
+            max_timeout = 0.100
+        else:
+            max_timeout = self._idle_timeout
+        next_deadline = self._timers.next_deadline()
+        if next_deadline >= 0:
+            max_timeout = min(max(next_deadline - _monotonic_time(), 0.0), max_timeout)
         pj_max_timeout.sec = int(max_timeout)
         pj_max_timeout.msec = int(max_timeout * 1000) % 1000
         with nogil:
             status = pjsip_endpt_handle_events(self._pjsip_endpoint._obj, &pj_max_timeout)
+        self._polling = 0
         IF UNAME_SYSNAME == "Darwin":
             if status not in [0, PJ_ERRNO_START_SYS + errno.EBADF]:
                 raise PJSIPError("Error while handling events", status)
@@ -827,20 +1127,13 @@ cdef class PJSIPUA:
                 raise PJSIPError("Error while handling events", status)
         _process_handler_queue(self, &_post_poll_handler_queue)
 
-        timers = list()
-        now = time.time()
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            elif (<Timer>self._timers[0]).schedule_time <= now:
-                # timer needs to be processed
-                timer = heapq.heappop(self._timers)
-                timers.append(timer)
-            else:
-                break
+        timers = self._timers.expire(_monotonic_time())
+        batch = self._timers._batch
         for timer in timers:
-            timer.call()
+            # skip the timers that were cancelled or rescheduled by a timer that was called before them
+            if timer._next is None and timer._batch == batch:
+                timer._batch = 0
+                timer.call()
 
         self._poll_log()
         if self._fatal_error:
@@ -869,14 +1162,16 @@ cdef class PJSIPUA:
     cdef int _check_thread(self) except -1:
         if not pj_thread_is_registered():
             self._threads.append(PJSIPThread())
+        self._wakeup()
         return 0
 
     cdef int _add_timer(self, Timer timer) except -1:
-        heapq.heappush(self._timers, timer)
+        self._timers.add(timer)
+        self._wakeup()
         return 0
 
     cdef int _remove_timer(self, Timer timer) except -1:
-        # Don't remove it from the heap, just mark it as not scheduled
+        self._timers.remove(timer)
         timer._scheduled = 0
         return 0
 
@@ -1063,6 +1358,12 @@ cdef int _PJSIPUA_cb_rx_request(pjsip_rx_data *rdata) with gil:
     except:
         ua._handle_exception(0)
 
+cdef int _cb_wakeup_recvfrom(pj_activesock_t *asock, void *data, size_t size, pj_sockaddr_t_ptr_const src_addr,
+                             int addr_len, int status) nogil:
+    global _wakeup_pending
+    _wakeup_pending = 0
+    return 1
+
 cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) with gil:
     cdef PJSIPUA ua
     cdef pjsip_msg_body *body
@@ -1142,6 +1443,8 @@ cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil:
     except:
         return 0
     try:
+        if ua._trace_buffer is not None:
+            ua._trace_buffer._add_rx(rdata)
         if ua._trace_sip:
             _add_event("SIPEngineSIPTrace",
                         dict(received=True, source_ip=rdata.pkt_info.src_name, source_port=rdata.pkt_info.src_port,
@@ -1160,6 +1463,8 @@ cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil:
     except:
         return 0
     try:
+        if ua._trace_buffer is not None:
+            ua._trace_buffer._add_tx(tdata)
         if ua._trace_sip:
             _add_event("SIPEngineSIPTrace",
                         dict(received=False,
@@ -1214,6 +1519,13 @@ cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) with gil:
 
 # functions
 
+cdef double _monotonic_time():
+    cdef pj_timestamp timestamp
+    cdef pj_timestamp frequency
+    pj_get_timestamp(&timestamp)
+    pj_get_timestamp_freq(&frequency)
+    return <double> timestamp.u64 / frequency.u64
+
 cdef PJSIPUA _get_ua():
     global _ua
     cdef PJSIPUA ua
@@ -1230,6 +1542,16 @@ cdef int deallocate_weakref(object weak_ref, object timer) except -1 with gil:
 # globals
 
 cdef void *_ua = NULL
+cdef int _TW_ROOT_BITS = 8
+cdef int _TW_LEVEL_BITS = 6
+cdef int _TW_ROOT_SIZE = 1 << _TW_ROOT_BITS
+cdef int _TW_ROOT_MASK = _TW_ROOT_SIZE - 1
+cdef int _TW_LEVEL_SIZE = 1 << _TW_LEVEL_BITS
+cdef int _TW_LEVEL_MASK = _TW_LEVEL_SIZE - 1
+cdef int _TW_LEVEL_COUNT = 5 # 4 wheel levels and the overflow list
+cdef int _TW_SLOT_COUNT = _TW_ROOT_SIZE + 3*_TW_LEVEL_SIZE + 1
+cdef tuple _TW_HISTOGRAM_LIMITS = (0.1, 1, 10, 60, 600, 3600, None)
+cdef int _wakeup_pending = 0
 cdef PJSTR _user_agent_hdr_name = PJSTR("User-Agent")
 cdef PJSTR _server_hdr_name = PJSTR("Server")
 cdef PJSTR _event_hdr_name = PJSTR("Event")
@@ -2,8 +2,10 @@
 import platform
 import re
 import sys
+import weakref
 
 from application.version import Version
+from collections import Mapping
 
 
 cdef class PJSTR:
@@ -154,6 +156,151 @@ cdef class frozendict:
         return self.dict.values()
 
 
+cdef class SIPMessageHeaders:
+    # A read-only mapping of the headers of a SIP message which keeps a clone of the message in its own memory pool
+    # and only converts a header to its python representation when it is looked up. Operations which need all the
+    # headers (iteration, length, comparison) convert the whole message once, after which the clone is released.
+
+    def __cinit__(self, *args, **kwargs):
+        self._pool = NULL
+        self._msg = NULL
+        self._cache = {}
+        self._headers = None
+
+    def __init__(self, *args, **kwargs):
+        raise TypeError("SIPMessageHeaders objects cannot be created directly")
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+        except:
+            return
+        ua.release_memory_pool(self._pool)
+        self._pool = NULL
+
+    def __reduce__(self):
+        return (dict, (self._get_headers(),), None)
+
+    def __repr__(self):
+        return "SIPMessageHeaders(%r)" % self._get_headers()
+
+    def __len__(self):
+        return len(self._get_headers())
+
+    def __iter__(self):
+        return iter(self._get_headers())
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __richcmp__(SIPMessageHeaders self, other, op):
+        if isinstance(other, SIPMessageHeaders):
+            other = (<SIPMessageHeaders>other)._get_headers()
+        if op == 2:
+            return self._get_headers() == other
+        elif op == 3:
+            return self._get_headers() != other
+        else:
+            return NotImplemented
+
+    __hash__ = None
+
+    def copy(self):
+        return self._get_headers().copy()
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is None else value
+
+    def has_key(self, key):
+        return self._lookup(key) is not None
+
+    def items(self):
+        return self._get_headers().items()
+
+    def iteritems(self):
+        return self._get_headers().iteritems()
+
+    def iterkeys(self):
+        return self._get_headers().iterkeys()
+
+    def itervalues(self):
+        return self._get_headers().itervalues()
+
+    def keys(self):
+        return self._get_headers().keys()
+
+    def values(self):
+        return self._get_headers().values()
+
+    cdef object _lookup(self, object key):
+        cdef pj_str_t name
+        cdef pjsip_hdr *header
+        cdef int multi_header
+        cdef list values = None
+        if self._headers is not None:
+            return self._headers.get(key)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+        if type(key) is unicode:
+            try:
+                key = key.encode('ascii')
+            except UnicodeEncodeError:
+                return None
+        elif type(key) is not str:
+            return None
+        header_data = None
+        _str_to_pj_str(key, &name)
+        header = <pjsip_hdr *> (<pj_list *> &self._msg.hdr).next
+        while header != &self._msg.hdr:
+            if pj_strcmp(&header.name, &name) == 0:
+                header_data = _pjsip_hdr_to_object(header, key, &multi_header)
+                if header_data is not None:
+                    if not multi_header:
+                        break
+                    if values is None:
+                        values = []
+                    values.append(header_data)
+                    header_data = None
+            header = <pjsip_hdr *> (<pj_list *> header).next
+        if values is not None:
+            header_data = values
+        self._cache[key] = header_data
+        return header_data
+
+    cdef dict _get_headers(self):
+        cdef PJSIPUA ua
+        if self._headers is None:
+            self._headers = _pjsip_msg_headers_to_dict(self._msg)
+            # keep the objects that were already handed out, so that repeated lookups return the same objects
+            for key, value in self._cache.iteritems():
+                if value is not None:
+                    self._headers[key] = value
+            self._cache = None
+            self._msg = NULL
+            try:
+                ua = _get_ua()
+            except:
+                pass
+            else:
+                ua.release_memory_pool(self._pool)
+                self._pool = NULL
+        return self._headers
+
+Mapping.register(SIPMessageHeaders)
+
+
 # functions
 
 cdef int _str_to_pj_str(object string, pj_str_t *pj_str) except -1:
@@ -196,76 +343,78 @@ cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t
         pj_list_insert_after(<pj_list *> param_list, <pj_list *> param)
     return 0
 
-cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
-    cdef pjsip_msg_body *body
-    cdef pjsip_hdr *header
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name, int *multi_header):
     cdef pjsip_generic_array_hdr *array_header
-    cdef pjsip_ctype_hdr *ctype_header
     cdef pjsip_cseq_hdr *cseq_header
-    cdef char *buf
-    cdef int buf_len, i, status
-    headers = {}
+    cdef int i
+    header_data = None
+    multi_header[0] = 0
+    if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
+        array_header = <pjsip_generic_array_hdr *> header
+        header_data = []
+        for i from 0 <= i < array_header.count:
+            header_data.append(_pj_str_to_str(array_header.values[i]))
+    elif header_name == "Contact":
+        multi_header[0] = 1
+        header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
+    elif header_name == "Content-Length":
+        header_data = (<pjsip_clen_hdr *> header).len
+    elif header_name == "Content-Type":
+        header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
+    elif header_name == "CSeq":
+        cseq_header = <pjsip_cseq_hdr *> header
+        header_data = (cseq_header.cseq, _pj_str_to_str(cseq_header.method.name))
+    elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
+        header_data = (<pjsip_generic_int_hdr *> header).ivalue
+    elif header_name == "From":
+        header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "To":
+        header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "Route":
+        multi_header[0] = 1
+        header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Reason":
+        value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
+        protocol, sep, params_str = value.partition(';')
+        params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
+        header_data = FrozenReasonHeader(protocol, params)
+    elif header_name == "Record-Route":
+        multi_header[0] = 1
+        header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Retry-After":
+        header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
+    elif header_name == "Via":
+        multi_header[0] = 1
+        header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
+    elif header_name == "Warning":
+        match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
+        if match is not None:
+            warning_params = match.groupdict()
+            warning_params['code'] = int(warning_params['code'])
+            header_data = FrozenWarningHeader(**warning_params)
+    elif header_name == "Event":
+        header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
+    elif header_name == "Subscription-State":
+        header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
+    elif header_name == "Refer-To":
+        header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Subject":
+        header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Replaces":
+        header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
+    # skip the following headers:
+    elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
+        header_data = FrozenHeader(header_name, _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue))
+    return header_data
+
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg):
+    cdef pjsip_hdr *header
+    cdef int multi_header
+    cdef dict headers = {}
     header = <pjsip_hdr *> (<pj_list *> &msg.hdr).next
     while header != &msg.hdr:
         header_name = _pj_str_to_str(header.name)
-        header_data = None
-        multi_header = False
-        if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
-            array_header = <pjsip_generic_array_hdr *> header
-            header_data = []
-            for i from 0 <= i < array_header.count:
-                header_data.append(_pj_str_to_str(array_header.values[i]))
-        elif header_name == "Contact":
-            multi_header = True
-            header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
-        elif header_name == "Content-Length":
-            header_data = (<pjsip_clen_hdr *> header).len
-        elif header_name == "Content-Type":
-            header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
-        elif header_name == "CSeq":
-            cseq_header = <pjsip_cseq_hdr *> header
-            header_data = (cseq_header.cseq, _pj_str_to_str(cseq_header.method.name))
-        elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
-            header_data = (<pjsip_generic_int_hdr *> header).ivalue
-        elif header_name == "From":
-            header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "To":
-            header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "Route":
-            multi_header = True
-            header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Reason":
-            value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
-            protocol, sep, params_str = value.partition(';')
-            params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
-            header_data = FrozenReasonHeader(protocol, params)
-        elif header_name == "Record-Route":
-            multi_header = True
-            header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Retry-After":
-            header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
-        elif header_name == "Via":
-            multi_header = True
-            header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
-        elif header_name == "Warning":
-            match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
-            if match is not None:
-                warning_params = match.groupdict()
-                warning_params['code'] = int(warning_params['code'])
-                header_data = FrozenWarningHeader(**warning_params)
-        elif header_name == "Event":
-            header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
-        elif header_name == "Subscription-State":
-            header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
-        elif header_name == "Refer-To":
-            header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Subject":
-            header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Replaces":
-            header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
-        # skip the following headers:
-        elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
-            header_data = FrozenHeader(header_name, _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue))
+        header_data = _pjsip_hdr_to_object(header, header_name, &multi_header)
         if header_data is not None:
             if multi_header:
                 headers.setdefault(header_name, []).append(header_data)
@@ -273,7 +422,17 @@ cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
                 if header_name not in headers:
                     headers[header_name] = header_data
         header = <pjsip_hdr *> (<pj_list *> header).next
-    info_dict["headers"] = headers
+    return headers
+
+cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
+    cdef pjsip_msg_body *body
+    cdef char *buf
+    cdef int buf_len, status
+    cdef PJSIPUA ua = _get_ua()
+    if ua._eager_headers:
+        info_dict["headers"] = _pjsip_msg_headers_to_dict(msg)
+    else:
+        info_dict["headers"] = SIPMessageHeaders_create(msg)
     body = msg.body
     if body == NULL:
         info_dict["body"] = None
@@ -293,6 +452,26 @@ cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
         info_dict["reason"] = _pj_str_to_str(msg.line.status.reason)
     return 0
 
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg):
+    cdef SIPMessageHeaders headers
+    cdef bytes pool_name
+    cdef PJSIPUA ua = _get_ua()
+    headers = SIPMessageHeaders.__new__(SIPMessageHeaders)
+    pool_name = b"SIPMessageHeaders_%d" % id(headers)
+    headers._pool = ua.create_memory_pool(pool_name, 4096, 4096)
+    with nogil:
+        headers._msg = pjsip_msg_clone(headers._pool, msg)
+    _message_headers.add(headers)
+    return headers
+
+cdef int _detach_message_headers() except -1:
+    # the memory pools of the message clones do not outlive the engine, so convert the headers that are still in use
+    cdef SIPMessageHeaders headers
+    for headers in list(_message_headers):
+        headers._get_headers()
+    _message_headers.clear()
+    return 0
+
 cdef int _is_valid_ip(int af, object ip) except -1:
     cdef char buf[16]
     cdef pj_str_t src
@@ -393,6 +572,7 @@ def decode_device_name(device_name):
 # globals
 
 cdef object _re_pj_status_str_def = re.compile("^.*\((.*)\)$")
+cdef object _message_headers = weakref.WeakSet()
 cdef object _re_warning_hdr = re.compile('(?P<code>[0-9]{3}) (?P<agent>.*?) "(?P<text>.*?)"')
 sip_status_messages = SIPStatusMessages()
 
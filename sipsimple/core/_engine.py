@@ -13,6 +13,7 @@ import atexit
 from application.notification import NotificationCenter, NotificationData
 from application.python.types import Singleton
 from threading import Thread, RLock
+from time import time
 
 from sipsimple import log, __version__
 from sipsimple.core._core import PJSIPUA, PJ_VERSION, PJ_SVN_REVISION, SIPCoreError
@@ -32,7 +33,10 @@ class Engine(Thread):
                              "user_agent": "sipsimple-%s-pjsip-%s-r%s" % (__version__, PJ_VERSION, PJ_SVN_REVISION),
                              "log_level": 0,
                              "trace_sip": False,
+                             "eager_headers": False,
                              "detect_sip_loops": True,
+                             "idle_timeout": 5.0,
+                             "wakeup": True,
                              "rtp_port_range": (50000, 50500),
                              "zrtp_cache": None,
                              "codecs": ["G722", "speex", "PCMU", "PCMA"],
@@ -47,7 +51,9 @@ class Engine(Thread):
                                         "refer":           ["message/sipfrag;version=2.0"],
                                         "xcap-diff":       ["application/xcap-diff+xml"]},
                              "incoming_events": set(),
-                             "incoming_requests": set()}
+                             "incoming_requests": set(),
+                             "batched_events": set(),
+                             "coalesced_events": set()}
 
     def __init__(self):
         self.notification_center = NotificationCenter()
@@ -55,6 +61,9 @@ class Engine(Thread):
         self._thread_stopping = False
         self._lock = RLock()
         self._options = None
+        self._batched_events = frozenset()
+        self._coalesced_events = frozenset()
+        self._statistics = EngineStatistics()
         atexit.register(self.stop)
         super(Engine, self).__init__()
         self.daemon = True
@@ -64,6 +73,10 @@ class Engine(Thread):
         return (hasattr(self, "_ua") and hasattr(self, "_thread_started")
                 and self._thread_started and not self._thread_stopping)
 
+    @property
+    def statistics(self):
+        return self._statistics
+
     def __dir__(self):
         if hasattr(self, '_ua'):
             ua_attributes = [attr for attr in dir(self._ua) if not attr.startswith('__') and attr != 'poll']
@@ -96,14 +109,20 @@ class Engine(Thread):
                 return
             if self._thread_started:
                 self._thread_stopping = True
+                try:
+                    self._ua.wakeup()
+                except (AttributeError, SIPCoreError):
+                    pass
 
     # worker thread
     def run(self):
         self.notification_center.post_notification('SIPEngineWillStart', sender=self)
         init_options = Engine.default_start_options.copy()
         init_options.update(self._options)
+        self._batched_events = frozenset(init_options.pop("batched_events") or ())
+        self._coalesced_events = frozenset(init_options.pop("coalesced_events") or ())
         try:
-            self._ua = PJSIPUA(self._handle_event, **init_options)
+            self._ua = PJSIPUA(self._handle_events, **init_options)
         except Exception:
             log.exception('Exception occurred while starting the Engine')
             exc_type, exc_val, exc_tb = sys.exc_info()
@@ -131,9 +150,76 @@ class Engine(Thread):
         del self._ua
         self.notification_center.post_notification('SIPEngineDidEnd', sender=self)
 
-    def _handle_event(self, event_name, **kwargs):
-        sender = kwargs.pop("obj", None)
-        if sender is None:
-            sender = self
-        self.notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
+    def _handle_events(self, events):
+        # Called once per poll cycle with all the events that were gathered by the core during that cycle.
+        # Events listed in coalesced_events are reduced to the last one posted for a given sender, while
+        # events listed in batched_events are delivered together in a single SIPEngineGotEventBatch notification.
+        start_time = time()
+        received = len(events)
+        if self._coalesced_events:
+            events = self._coalesce_events(events)
+        batch = []
+        for event_name, params in events:
+            sender = params.pop("obj", None)
+            if sender is None:
+                sender = self
+            if event_name in self._batched_events:
+                batch.append((event_name, sender, NotificationData(**params)))
+            else:
+                self.notification_center.post_notification(event_name, sender, NotificationData(**params))
+        if batch:
+            self.notification_center.post_notification('SIPEngineGotEventBatch', sender=self, data=NotificationData(events=batch))
+        self._statistics.update(received=received, dispatched=len(events), batched=len(batch), latency=time() - start_time)
+
+    def _coalesce_events(self, events):
+        last_index = {}
+        for index, (event_name, params) in enumerate(events):
+            if event_name in self._coalesced_events:
+                last_index[event_name, id(params.get("obj", None))] = index
+        return [(event_name, params) for index, (event_name, params) in enumerate(events)
+                if event_name not in self._coalesced_events or last_index[event_name, id(params.get("obj", None))] == index]
+
+
+class EngineStatistics(object):
+    """Counters describing how events are dispatched from the engine thread"""
+
+    def __init__(self):
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.dispatch_cycles = 0
+            self.received_events = 0
+            self.dispatched_events = 0
+            self.coalesced_events = 0
+            self.batched_events = 0
+            self.last_events_per_cycle = 0
+            self.max_events_per_cycle = 0
+            self.last_dispatch_latency = 0.0
+            self.max_dispatch_latency = 0.0
+            self.total_dispatch_latency = 0.0
+
+    def update(self, received, dispatched, batched, latency):
+        with self._lock:
+            self.dispatch_cycles += 1
+            self.received_events += received
+            self.dispatched_events += dispatched
+            self.coalesced_events += received - dispatched
+            self.batched_events += batched
+            self.last_events_per_cycle = received
+            self.max_events_per_cycle = max(self.max_events_per_cycle, received)
+            self.last_dispatch_latency = latency
+            self.max_dispatch_latency = max(self.max_dispatch_latency, latency)
+            self.total_dispatch_latency += latency
+
+    @property
+    def average_events_per_cycle(self):
+        with self._lock:
+            return float(self.received_events) / self.dispatch_cycles if self.dispatch_cycles else 0.0
+
+    @property
+    def average_dispatch_latency(self):
+        with self._lock:
+            return self.total_dispatch_latency / self.dispatch_cycles if self.dispatch_cycles else 0.0
 
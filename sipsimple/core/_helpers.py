@@ -30,7 +30,7 @@ class Route(object):
     @address.setter
     def address(self, address):
         try:
-            socket.inet_aton(address)
+            socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
         except:
             raise ValueError('illegal address: %s' % address)
         self._address = address
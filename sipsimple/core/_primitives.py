@@ -51,7 +51,7 @@ class Registration(object):
             try:
                 self._make_and_send_request(ContactHeader.new(self._last_request.contact_header), RouteHeader.new(self._last_request.route_header), timeout, False)
             except SIPCoreError, e:
-                notification_center.post_notification('SIPRegistrationDidNotEnd', sender=self, data=NotificationData(code=0, reason=e.args[0]))
+                notification_center.post_notification('SIPRegistrationDidNotEnd', sender=self, data=NotificationData(code=0, reason=e.args[0], retry_after=None))
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -84,15 +84,18 @@ class Registration(object):
             if request is not self._current_request:
                 return
             self._current_request = None
+            if hasattr(notification.data, 'headers'):
+                min_expires = notification.data.headers.get('Min-Expires', None)
+                retry_after = notification.data.headers.get('Retry-After', None)
+            else:
+                min_expires = None
+                retry_after = None
             if self._unregistering:
-                notification.center.post_notification('SIPRegistrationDidNotEnd', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason))
+                notification.center.post_notification('SIPRegistrationDidNotEnd', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason, retry_after=retry_after))
             else:
-                if hasattr(notification.data, 'headers'):
-                    min_expires = notification.data.headers.get('Min-Expires', None)
-                else:
-                    min_expires = None
                 notification.center.post_notification('SIPRegistrationDidFail', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason,
-                                                                                                                   route_header=request.route_header, min_expires=min_expires))
+                                                                                                                   route_header=request.route_header, min_expires=min_expires,
+                                                                                                                   retry_after=retry_after))
 
     def _NH_SIPRequestWillExpire(self, notification):
         with self._lock:
@@ -229,7 +232,7 @@ class Publication(object):
             try:
                 self._make_and_send_request(None, RouteHeader.new(self._last_request.route_header), timeout, False)
             except SIPCoreError, e:
-                notification_center.post_notification('SIPPublicationDidNotEnd', sender=self, data=NotificationData(code=0, reason=e.args[0]))
+                notification_center.post_notification('SIPPublicationDidNotEnd', sender=self, data=NotificationData(code=0, reason=e.args[0], retry_after=None))
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -262,11 +265,15 @@ class Publication(object):
             self._current_request = None
             if notification.data.code == 412:
                 self._last_etag = None
+            if hasattr(notification.data, 'headers'):
+                retry_after = notification.data.headers.get('Retry-After', None)
+            else:
+                retry_after = None
             if self._unpublishing:
-                notification.center.post_notification('SIPPublicationDidNotEnd', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason))
+                notification.center.post_notification('SIPPublicationDidNotEnd', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason, retry_after=retry_after))
             else:
                 notification.center.post_notification('SIPPublicationDidFail', sender=self, data=NotificationData(code=notification.data.code, reason=notification.data.reason,
-                                                                                                                  route_header=request.route_header))
+                                                                                                                  route_header=request.route_header, retry_after=retry_after))
 
     def _NH_SIPRequestWillExpire(self, notification):
         with self._lock:
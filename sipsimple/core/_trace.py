@@ -0,0 +1,142 @@
+"""
+Implements a background SIP tracer that drains the SIP trace buffer of the
+engine in bulk and writes the captured packets to a file sink.
+"""
+
+__all__ = ["SIPTracer", "JSONTraceSink", "PcapTraceSink"]
+
+import json
+import socket
+import struct
+
+from threading import Event, Thread
+
+from sipsimple import log
+from sipsimple.core._core import SIPTraceBuffer, SIPCoreError
+from sipsimple.core._engine import Engine
+
+
+class JSONTraceSink(object):
+    """Writes trace records to a file, one JSON object per line"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+
+    def write(self, records):
+        lines = (json.dumps(dict(timestamp=record.timestamp,
+                                 received=record.received,
+                                 transport=record.transport,
+                                 source='%s:%d' % (record.source_ip, record.source_port),
+                                 destination='%s:%d' % (record.destination_ip, record.destination_port),
+                                 data=record.data.decode('utf-8', 'replace'))) for record in records)
+        self.file.write(''.join(line + '\n' for line in lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PcapTraceSink(object):
+    """
+    Writes trace records to a file in pcap format. The packets are wrapped
+    in synthesized IP and UDP headers regardless of the transport they were
+    sent over, which is enough for packet analyzers to decode the SIP
+    messages they contain.
+    """
+
+    linktype_raw = 101
+    max_payload = 65507
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(struct.pack('=IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, self.linktype_raw))
+
+    def write(self, records):
+        self.file.write(''.join(self._encode(record) for record in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def _encode(self, record):
+        payload = record.data[:self.max_payload]
+        udp_header = struct.pack('!HHHH', record.source_port, record.destination_port, len(payload) + 8, 0)
+        source_address, destination_address = self._address(record.source_ip), self._address(record.destination_ip)
+        if len(source_address) == 16 or len(destination_address) == 16:
+            source_address, destination_address = self._ipv6_address(source_address), self._ipv6_address(destination_address)
+            ip_header = struct.pack('!IHBB16s16s', 0x60000000, len(payload) + 8, socket.IPPROTO_UDP, 64, source_address, destination_address)
+        else:
+            ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, len(payload) + 28, 0, 0x4000, 64, socket.IPPROTO_UDP, 0, source_address, destination_address)
+        packet = ip_header + udp_header + payload
+        seconds, fraction = divmod(record.timestamp, 1)
+        return struct.pack('=IIII', int(seconds), int(fraction * 1000000), len(packet), len(packet)) + packet
+
+    @staticmethod
+    def _address(ip):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                return socket.inet_pton(family, ip.strip('[]'))
+            except (socket.error, ValueError):
+                pass
+        return '\0' * 4
+
+    @staticmethod
+    def _ipv6_address(address):
+        return address if len(address) == 16 else '\0' * 10 + '\xff\xff' + address
+
+
+class SIPTracer(object):
+    """
+    Captures the SIP packets sent and received by the engine into a SIP
+    trace buffer and periodically writes them to a sink from a background
+    thread. The packets can be restricted to certain methods and response
+    codes and only one in sample_rate of the remaining ones is captured.
+    """
+
+    def __init__(self, sink, size=4194304, methods=None, status_codes=None, sample_rate=1, interval=0.5):
+        self.sink = sink
+        self.interval = interval
+        self.buffer = SIPTraceBuffer(size=size, methods=methods, status_codes=status_codes, sample_rate=sample_rate)
+        self._stopped = Event()
+        self._thread = None
+
+    @property
+    def statistics(self):
+        return self.buffer.statistics
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError('SIPTracer was already started')
+        engine = Engine()
+        if not engine.is_running:
+            raise SIPCoreError('The engine is not running')
+        engine.trace_buffer = self.buffer
+        self._thread = Thread(name='SIP tracer', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None or self._stopped.is_set():
+            return
+        engine = Engine()
+        if engine.is_running and engine.trace_buffer is self.buffer:
+            engine.trace_buffer = None
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._flush()
+        self._flush()
+        self.sink.close()
+
+    def _flush(self):
+        records = self.buffer.drain()
+        if records:
+            try:
+                self.sink.write(records)
+            except (IOError, OSError) as e:
+                log.error('Could not write SIP trace records: %s' % e)
@@ -9,14 +9,15 @@ resources prior the starting of a SIP session.
 from __future__ import absolute_import
 
 import re
-from itertools import chain
+from collections import OrderedDict
+from functools import partial
+from itertools import chain, izip_longest
 from time import time
 from urlparse import urlparse
 
 # patch dns.entropy module which is not thread-safe
 import dns
 import sys
-from functools import partial
 from random import randint, randrange
 
 dns.entropy = dns.__class__('dns.entropy')
@@ -27,10 +28,10 @@ dns.entropy.between = randint
 
 sys.modules['dns.entropy'] = dns.entropy
 
-del partial, randint, randrange, sys
+del randint, randrange, sys
 
 # replace standard select and socket modules with versions from eventlib
-from eventlib import coros, proc
+from eventlib import api, coros, proc
 from eventlib.green import select
 from eventlib.green import socket
 import dns.name
@@ -42,7 +43,7 @@ dns.query.select = select
 dns.query._set_polling_backend(dns.query._select_for)
 
 from application.notification import IObserver, NotificationCenter, NotificationData
-from application.python import Null, limit
+from application.python import Null
 from application.python.decorator import decorator, preserve_signature
 from application.python.types import Singleton
 from dns import exception, rdatatype
@@ -85,28 +86,145 @@ class DNSLookupError(Exception):
     """
 
 
-class DNSCache(object):
+class DNSCacheStatistics(object):
     """
-    A simple DNS cache which uses twisted's timers to invalidate its expired
-    data.
+    Counters for the usage of a DNSCache. Stale hits are the answers served
+    after they expired, while they were being refreshed in the background.
     """
     def __init__(self):
-        self.data = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%d' % (name, value) for name, value in sorted(self.__dict__.iteritems())))
+
+
+class DNSCache(object):
+    """
+    A size bounded DNS cache which evicts the least recently used entries
+    when it is full. Besides answers it also keeps negative results (RFC
+    2308), for the time indicated by the SOA record of the response or for
+    negative_ttl seconds if that is missing. Answers are still served for
+    stale_ttl seconds after they expire, while they are refreshed in the
+    background. Expired entries are removed by a single periodic sweep.
+    """
+    max_ttl = 3600
+
+    def __init__(self, size=1024, negative_ttl=300, stale_ttl=60, sweep_interval=30):
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.sweep_interval = sweep_interval
+        self.data = OrderedDict()
+        self.statistics = DNSCacheStatistics()
+        self._refreshing = set()
+        self._sweep_timer = None
 
     def get(self, key):
-        return self.data.get(key, None)
+        try:
+            value, expiration = self.data.pop(key)
+        except KeyError:
+            self.statistics.misses += 1
+            return None
+        now = time()
+        if expiration + self.stale_ttl <= now:
+            self.statistics.expirations += 1
+            self.statistics.misses += 1
+            return None
+        self.data[key] = value, expiration
+        if expiration <= now:
+            self.statistics.stale_hits += 1
+            self._refresh(key)
+        else:
+            self.statistics.hits += 1
+        return value
 
     def put(self, key, value):
-        expiration = value.expiration-time()
-        if expiration > 0:
-            self.data[key] = value
-            reactor.callLater(limit(expiration, max=3600), self.data.pop, key, None)
+        now = time()
+        expiration = min(value.expiration, now+self.max_ttl)
+        if expiration > now:
+            self._store(key, value, expiration)
+
+    def get_negative(self, name, rdtype):
+        # negative entries use None as their class, which never appears in the keys of the resolver
+        key = (name, rdtype, None)
+        try:
+            error, expiration = self.data.pop(key)
+        except KeyError:
+            return None
+        if expiration <= time():
+            self.statistics.expirations += 1
+            return None
+        self.data[key] = error, expiration
+        self.statistics.negative_hits += 1
+        return error
+
+    def put_negative(self, name, rdtype, error, response=None):
+        ttl = self.negative_ttl
+        if response is not None:
+            for rrset in response.authority:
+                if rrset.rdtype == rdatatype.SOA:
+                    ttl = min(rrset.ttl, rrset[0].minimum)
+                    break
+        ttl = min(ttl, self.max_ttl)
+        if ttl > 0:
+            self._store((name, rdtype, None), error, time()+ttl)
 
     def flush(self, key=None):
         if key is not None:
             self.data.pop(key, None)
         else:
-            self.data = {}
+            self.data = OrderedDict()
+            if self._sweep_timer is not None and self._sweep_timer.active():
+                self._sweep_timer.cancel()
+            self._sweep_timer = None
+
+    def _store(self, key, value, expiration):
+        self.data.pop(key, None)
+        self.data[key] = value, expiration
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.statistics.evictions += 1
+        if self._sweep_timer is None:
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
+
+    def _sweep(self):
+        self._sweep_timer = None
+        now = time()
+        expired_keys = [key for key, (value, expiration) in self.data.iteritems() if expiration + (self.stale_ttl if key[2] is not None else 0) <= now]
+        for key in expired_keys:
+            del self.data[key]
+        self.statistics.expirations += len(expired_keys)
+        if self.data:
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
+
+    def _refresh(self, key):
+        if key not in self._refreshing:
+            self._refreshing.add(key)
+            proc.spawn(self._run_refresh, key)
+
+    def _run_refresh(self, key):
+        name, rdtype, rdclass = key
+        resolver = DNSResolver()
+        resolver.cache = None
+        resolver.timeout = 3.0
+        resolver.lifetime = 15.0
+        try:
+            answer = resolver.query(name, rdtype, rdclass)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            self.flush(key)
+        except exception.DNSException:
+            pass
+        else:
+            self.put(key, answer)
+            self.statistics.refreshes += 1
+        finally:
+            self._refreshing.discard(key)
 
 
 class InternalResolver(dns.resolver.Resolver):
@@ -117,15 +235,40 @@ class InternalResolver(dns.resolver.Resolver):
         self.search = [item for item in self.search if not item.to_text().endswith('local.')]
 
 
+class DNSQueryStatistics(object):
+    """
+    Counters for the queries performed by DNSResolver instances. A query is
+    coalesced when an identical query was already in flight and its result
+    was shared instead of sending a new request.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.coalesced = 0
+
+    def __repr__(self):
+        return '%s(queries=%d, coalesced=%d)' % (self.__class__.__name__, self.queries, self.coalesced)
+
+
 class DNSResolver(dns.resolver.Resolver):
     """
     The resolver used by DNSLookup.
 
     The lifetime setting on it applies to all the queries made on this resolver.
-    Each time a query is performed, its duration is subtracted from the lifetime
-    value.
+    Each time a query is performed, the time it took is subtracted from the
+    lifetime value. Queries which run in parallel on the same resolver only
+    consume the lifetime once.
+
+    Identical queries (same name, record type and nameservers) which are in
+    flight at the same time, from this or any other resolver, are coalesced
+    into a single DNS request whose result is shared by all of them. Waiting
+    for the shared result is bounded by the lifetime of the waiting resolver.
+    When the cache is a DNSCache, negative results are also cached and served
+    from it.
     """
 
+    pending_queries = {}
+    statistics = DNSQueryStatistics()
+
     def __init__(self):
         dns.resolver.Resolver.__init__(self, configure=False)
         dns_manager = DNSManager()
@@ -133,12 +276,57 @@ class DNSResolver(dns.resolver.Resolver):
         self.domain = dns_manager.domain
         self.nameservers = dns_manager.nameservers
 
-    def query(self, *args, **kw):
+    def query(self, qname, rdtype=rdatatype.A, *args, **kw):
         start_time = time()
+        deadline = start_time + self.lifetime
+        raise_on_no_answer = kw.pop('raise_on_no_answer', True)
         try:
-            return dns.resolver.Resolver.query(self, *args, **kw)
+            name = str(qname).lower().rstrip('.')
+            rdtype = rdatatype.from_text(rdtype) if isinstance(rdtype, basestring) else rdtype
+            key = (name, rdtype, tuple(self.nameservers))
+            self.statistics.queries += 1
+            cache = self.cache if isinstance(self.cache, DNSCache) else None
+            if cache is not None:
+                error = cache.get_negative(name, rdtype)
+                if error is not None and (raise_on_no_answer or not isinstance(error, dns.resolver.NoAnswer)):
+                    raise error
+            while key in self.pending_queries:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    raise exception.Timeout()
+                with api.timeout(timeout, exception.Timeout()):
+                    answer = self.pending_queries[key].wait()
+                if answer is not None:
+                    self.statistics.coalesced += 1
+                    if answer.rrset is None and raise_on_no_answer:
+                        raise dns.resolver.NoAnswer()
+                    return answer
+            event = self.pending_queries[key] = coros.event()
+            answer = None
+            try:
+                answer = dns.resolver.Resolver.query(self, qname, rdtype, raise_on_no_answer=False, *args, **kw)
+                if answer.rrset is None and cache is not None:
+                    cache.put_negative(name, rdtype, dns.resolver.NoAnswer(), answer.response)
+            except dns.resolver.NXDOMAIN, e:
+                if cache is not None:
+                    responses = getattr(e, 'kwargs', {}).get('responses') or {}
+                    cache.put_negative(name, rdtype, e, next(responses.itervalues(), None))
+                event.send_exception(e)
+                raise
+            except exception.DNSException, e:
+                event.send_exception(e)
+                raise
+            finally:
+                del self.pending_queries[key]
+                if not event.ready():
+                    # the answer is shared even when it has no records, as the waiters decide themselves whether
+                    # that is an error. this also wakes them up if the query was interrupted, so they can retry it.
+                    event.send(answer)
+            if answer.rrset is None and raise_on_no_answer:
+                raise dns.resolver.NoAnswer()
+            return answer
         finally:
-            self.lifetime -= min(self.lifetime, time()-start_time)
+            self.lifetime = max(min(self.lifetime, deadline-time()), 0)
 
 
 class SRVResult(object):
@@ -166,6 +354,43 @@ class NAPTRResult(object):
         self.address = address
 
 
+class RouteHealth(object):
+    """
+    Keeps track of the outcome of the requests sent over the routes returned
+    by DNSLookup.lookup_sip_proxy, so that later lookups can try the routes
+    which failed recently last and order the rest by their observed latency.
+    Routes for which nothing is known yet are tried first among their peers.
+    """
+    __metaclass__ = Singleton
+
+    failure_penalty = 300
+    smoothing_factor = 0.3
+
+    def __init__(self):
+        self.data = {}
+
+    def succeeded(self, route, latency):
+        key = (route.address, route.port, route.transport)
+        previous_latency, failure_time = self.data.get(key, (None, None))
+        if previous_latency is not None:
+            latency = previous_latency + self.smoothing_factor * (latency - previous_latency)
+        self.data[key] = latency, None
+
+    def failed(self, route):
+        key = (route.address, route.port, route.transport)
+        latency, failure_time = self.data.get(key, (None, None))
+        self.data[key] = latency, time()
+
+    def sort_key(self, route):
+        latency, failure_time = self.data.get((route.address, route.port, route.transport), (None, None))
+        if failure_time is not None and time() - failure_time < self.failure_penalty:
+            return 1, latency or 0
+        return 0, latency or 0
+
+    def clear(self):
+        self.data.clear()
+
+
 class DNSLookup(object):
 
     cache = DNSCache()
@@ -220,13 +445,16 @@ class DNSLookup(object):
 
     @run_in_waitable_green_thread
     @post_dns_lookup_notifications
-    def lookup_sip_proxy(self, uri, supported_transports, timeout=3.0, lifetime=15.0):
+    def lookup_sip_proxy(self, uri, supported_transports, timeout=3.0, lifetime=15.0, ipv6=False):
         """
         Performs an RFC 3263 compliant lookup of transport/ip/port combinations
         for a particular SIP URI. As arguments it takes a SIPURI object
         and a list of supported transports, in order of preference of the
         application. It returns a list of Route objects that can be used in
-        order of preference.
+        order of preference. Routes of equal preference are ordered based on
+        the health information in RouteHealth. If ipv6 is True, AAAA records
+        are looked up as well and the IPv6 and IPv4 addresses of each host are
+        interleaved, starting with IPv6 (RFC 8305).
 
         The DNSLookupDidSucceed notification contains a result attribute which
         is a list of Route objects. The DNSLookupDidFail notification contains
@@ -251,12 +479,12 @@ class DNSLookup(object):
 
         try:
             # If the host part of the URI is an IP address, we will not do any lookup
-            if re.match("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", uri.host):
+            if re.match("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", uri.host) or ':' in uri.host:
                 transport = 'tls' if uri.secure else uri.transport.lower()
                 if transport not in supported_transports:
                     raise DNSLookupError("Transport %s dictated by URI is not supported" % transport)
                 port = uri.port or (5061 if transport=='tls' else 5060)
-                return [Route(address=uri.host, port=port, transport=transport)]
+                return [Route(address=uri.host.strip('[]'), port=port, transport=transport)]
 
             resolver = DNSResolver()
             resolver.cache = self.cache
@@ -268,9 +496,9 @@ class DNSLookup(object):
                 transport = 'tls' if uri.secure else uri.transport.lower()
                 if transport not in supported_transports:
                     raise DNSLookupError("Transport %s dictated by URI is not supported" % transport)
-                addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
+                addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context, ipv6=ipv6)
                 if addresses[uri.host]:
-                    return [Route(address=addr, port=uri.port, transport=transport) for addr in addresses[uri.host]]
+                    return self._sort_routes([Route(address=addr, port=uri.port, transport=transport) for addr in addresses[uri.host]])
 
             # If the transport was already set as a parameter on the SIP URI, only do SRV lookups
             elif 'transport' in uri.parameters:
@@ -280,15 +508,16 @@ class DNSLookup(object):
                 if uri.secure and transport != 'tls':
                     raise DNSLookupError("Requested lookup for SIPS URI, but with %s transport parameter" % transport)
                 record_name = '%s.%s' % (transport_service_map[transport], uri.host)
-                services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
+                services = self._lookup_srv_records(resolver, [record_name], log_context=log_context, ipv6=ipv6)
                 if services[record_name]:
-                    return [Route(address=result.address, port=result.port, transport=transport) for result in services[record_name]]
+                    return self._sort_routes([Route(address=result.address, port=result.port, transport=transport) for result in services[record_name]],
+                                             [result.priority for result in services[record_name]])
                 else:
                     # If SRV lookup fails, try A lookup
-                    addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
+                    addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context, ipv6=ipv6)
                     port = 5061 if transport=='tls' else 5060
                     if addresses[uri.host]:
-                        return [Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]]
+                        return self._sort_routes([Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]])
 
             # Otherwise, it means we don't have a numeric IP address, a port isn't specified and neither is a transport. So we have to do a full NAPTR lookup
             else:
@@ -300,32 +529,31 @@ class DNSLookup(object):
                 # First try NAPTR lookup
                 naptr_services = [service for service, transport in naptr_service_transport_map.iteritems() if transport in supported_transports]
                 try:
-                    pointers = self._lookup_naptr_record(resolver, uri.host, naptr_services, log_context=log_context)
+                    pointers = self._lookup_naptr_record(resolver, uri.host, naptr_services, log_context=log_context, ipv6=ipv6)
                 except dns.resolver.Timeout:
                     pointers = []
                 if pointers:
-                    return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service]) for result in pointers]
+                    return self._sort_routes([Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service]) for result in pointers],
+                                             [(result.order, result.preference, result.priority) for result in pointers])
                 else:
                     # If that fails, try SRV lookup
                     routes = []
-                    for transport in supported_transports:
-                        record_name = '%s.%s' % (transport_service_map[transport], uri.host)
-                        try:
-                            services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
-                        except dns.resolver.Timeout:
-                            continue
-                        if services[record_name]:
-                            routes.extend(Route(address=result.address, port=result.port, transport=transport) for result in services[record_name])
+                    preferences = []
+                    record_names = ['%s.%s' % (transport_service_map[transport], uri.host) for transport in supported_transports]
+                    lookup_srv_record = partial(self._lookup_srv_record_ignoring_timeout, resolver, log_context=log_context, ipv6=ipv6)
+                    for index, (transport, services) in enumerate(zip(supported_transports, self._run_in_parallel(lookup_srv_record, record_names))):
+                        routes.extend(Route(address=result.address, port=result.port, transport=transport) for result in services)
+                        preferences.extend((index, result.priority) for result in services)
                     if routes:
-                        return routes
+                        return self._sort_routes(routes, preferences)
                     else:
                         # If SRV lookup fails, try A lookup
                         transport = 'tls' if uri.secure else 'udp'
                         if transport in supported_transports:
-                            addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
+                            addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context, ipv6=ipv6)
                             port = 5061 if transport=='tls' else 5060
                             if addresses[uri.host]:
-                                return [Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]]
+                                return self._sort_routes([Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]])
         except dns.resolver.Timeout:
             raise DNSLookupError("Timeout in lookup for routes for SIP URI %s" % uri)
         else:
@@ -373,56 +601,102 @@ class DNSLookup(object):
             raise DNSLookupError('Timeout in lookup for XCAP servers for domain %s' % uri.host)
 
 
-    def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
-        additional_addresses = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.A)
+    def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}, ipv6=False):
+        rdtypes = (rdatatype.AAAA, rdatatype.A) if ipv6 else (rdatatype.A,)
+        additional_addresses = dict(((rset.name.to_text(), rset.rdtype), rset) for rset in additional_records if rset.rdtype in rdtypes)
+        results = {}
+        queries = []
+        for hostname in hostnames:
+            for rdtype in rdtypes:
+                if (hostname, rdtype) in additional_addresses:
+                    results[hostname, rdtype] = [r.address for r in additional_addresses[hostname, rdtype]]
+                elif (hostname, rdtype) not in queries:
+                    queries.append((hostname, rdtype))
+        results.update(zip(queries, self._run_in_parallel(lambda query: self._lookup_a_record(resolver, query[0], query[1], log_context), queries)))
         addresses = {}
         for hostname in hostnames:
-            if hostname in additional_addresses:
-                addresses[hostname] = [r.address for r in additional_addresses[hostname]]
-            else:
-                try:
-                    answer = resolver.query(hostname, rdatatype.A)
-                except dns.resolver.Timeout, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    addresses[hostname] = []
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses[hostname] = [r.address for r in answer.rrset]
+            address_lists = [results[hostname, rdtype] for rdtype in rdtypes]
+            addresses[hostname] = [address for group in izip_longest(*address_lists) for address in group if address is not None]
         return addresses
 
+    def _lookup_a_record(self, resolver, hostname, rdtype=rdatatype.A, log_context={}):
+        notification_center = NotificationCenter()
+        query_type = rdatatype.to_text(rdtype)
+        try:
+            answer = resolver.query(hostname, rdtype)
+        except dns.resolver.Timeout, e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            raise
+        except exception.DNSException, e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            return []
+        else:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+            return [r.address for r in answer.rrset]
+
+
+    def _lookup_srv_records(self, resolver, srv_names, additional_records=[], log_context={}, ipv6=False):
+        srv_names = list(OrderedDict.fromkeys(srv_names))
+        results = self._run_in_parallel(partial(self._lookup_srv_record, resolver, additional_records=additional_records, log_context=log_context, ipv6=ipv6), srv_names)
+        return dict(zip(srv_names, results))
 
-    def _lookup_srv_records(self, resolver, srv_names, additional_records=[], log_context={}):
+    def _lookup_srv_record(self, resolver, srv_name, additional_records=[], log_context={}, ipv6=False):
         notification_center = NotificationCenter()
         additional_services = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.SRV)
-        services = {}
-        for srv_name in srv_names:
-            services[srv_name] = []
-            if srv_name in additional_services:
-                addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records)
-                for record in additional_services[srv_name]:
-                    services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+        services = []
+        if srv_name in additional_services:
+            addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records, ipv6=ipv6)
+            for record in additional_services[srv_name]:
+                services.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+        else:
+            try:
+                answer = resolver.query(srv_name, rdatatype.SRV)
+            except dns.resolver.Timeout, e:
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                raise
+            except exception.DNSException, e:
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
             else:
-                try:
-                    answer = resolver.query(srv_name, rdatatype.SRV)
-                except dns.resolver.Timeout, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context)
-                    for record in answer.rrset:
-                        services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
-            services[srv_name].sort(key=lambda result: (result.priority, -result.weight))
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+                addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context, ipv6=ipv6)
+                for record in answer.rrset:
+                    services.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+        services.sort(key=lambda result: (result.priority, -result.weight))
         return services
 
+    def _sort_routes(self, routes, preferences=None):
+        """
+        Orders the routes which have the same preference based on their health,
+        keeping the order given by the preferences otherwise.
+        """
+        route_health = RouteHealth()
+        if preferences is None:
+            preferences = [0] * len(routes)
+        return [route for preference, health, route in sorted(((preference, route_health.sort_key(route), route) for preference, route in zip(preferences, routes)), key=lambda item: item[:2])]
+
+    def _run_in_parallel(self, func, items):
+        """
+        Calls func for each of the items in separate green threads and returns
+        the results in the order of the items. If any of the calls raises an
+        exception, the other ones are killed and the exception is propagated.
+        """
+        if len(items) < 2:
+            return [func(item) for item in items]
+        procs = [proc.spawn(func, item) for item in items]
+        try:
+            return [p.wait() for p in procs]
+        finally:
+            proc.killall(procs, wait=True)
+
+
+    def _lookup_srv_record_ignoring_timeout(self, resolver, srv_name, log_context={}, ipv6=False):
+        try:
+            return self._lookup_srv_record(resolver, srv_name, log_context=log_context, ipv6=ipv6)
+        except dns.resolver.Timeout:
+            return []
+
 
-    def _lookup_naptr_record(self, resolver, domain, services, log_context={}):
+    def _lookup_naptr_record(self, resolver, domain, services, log_context={}, ipv6=False):
         notification_center = NotificationCenter()
         pointers = []
         try:
@@ -435,7 +709,7 @@ class DNSLookup(object):
         else:
             notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='NAPTR', query_name=str(domain), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
             records = [r for r in answer.rrset if r.service.lower() in services]
-            services = self._lookup_srv_records(resolver, [r.replacement.to_text() for r in records], answer.response.additional, log_context)
+            services = self._lookup_srv_records(resolver, [r.replacement.to_text() for r in records], answer.response.additional, log_context, ipv6=ipv6)
             for record in records:
                 pointers.extend(NAPTRResult(record.service.lower(), record.order, record.preference, r.priority, r.weight, r.port, r.address) for r in services.get(record.replacement.to_text(), ()))
         pointers.sort(key=lambda result: (result.order, result.preference))
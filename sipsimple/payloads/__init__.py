@@ -46,10 +46,11 @@ import os
 import sys
 import urllib
 from collections import defaultdict, deque
-from copy import deepcopy
 from decimal import Decimal
-from itertools import chain, izip
-from weakref import WeakValueDictionary
+from itertools import izip
+from operator import itemgetter
+from weakref import WeakValueDictionary, ref as weakref
+from xml.sax.saxutils import quoteattr
 
 from application.python import Null
 from application.python.descriptor import classproperty
@@ -98,6 +99,7 @@ class XMLDocumentType(type):
         cls.root_element = None
         cls.schema = None
         cls.parser = None
+        cls.unvalidated_parser = None
         for base in reversed(bases):
             if hasattr(base, 'element_map'):
                 cls.element_map.update(base.element_map)
@@ -130,9 +132,10 @@ class XMLDocumentType(type):
             """ % '\r\n'.join('<xs:import namespace="%s" schemaLocation="%s"/>' % (namespace, schema_location) for namespace, schema_location in location_map.iteritems())
             cls.schema = etree.XMLSchema(etree.XML(schema))
             cls.parser = etree.XMLParser(schema=cls.schema, remove_blank_text=True)
+            cls.unvalidated_parser = etree.XMLParser(remove_blank_text=True)
         else:
             cls.schema = None
-            cls.parser = etree.XMLParser(remove_blank_text=True)
+            cls.parser = cls.unvalidated_parser = etree.XMLParser(remove_blank_text=True)
 
 
 class XMLDocument(object):
@@ -143,34 +146,52 @@ class XMLDocument(object):
     schema_path = os.path.join(os.path.dirname(__file__), 'xml-schemas')
 
     @classmethod
-    def parse(cls, document):
+    def parse(cls, document, validate=True, lazy=False):
+        """
+        The document is validated against the schema by the parser while it
+        is parsed. Validation can be skipped for documents which come from a
+        trusted source, like the ones previously built by us. If lazy is True
+        the child elements are built on first access instead of upfront.
+        """
+        parser = cls.parser if validate else cls.unvalidated_parser
         try:
             if isinstance(document, str):
-                xml = etree.XML(document, parser=cls.parser)
+                xml = etree.XML(document, parser=parser)
             elif isinstance(document, unicode):
-                xml = etree.XML(document.encode('utf-8'), parser=cls.parser)
+                xml = etree.XML(document.encode('utf-8'), parser=parser)
             else:
-                xml = etree.parse(document, parser=cls.parser).getroot()
-            if cls.schema is not None:
-                cls.schema.assertValid(xml)
-            return cls.root_element.from_element(xml, xml_document=cls)
+                xml = etree.parse(document, parser=parser).getroot()
+            return cls.root_element.from_element(xml, xml_document=cls, lazy=lazy)
         except (etree.DocumentInvalid, etree.XMLSyntaxError, ValueError), e:
             raise ParserError(str(e))
 
     @classmethod
     def build(cls, root_element, encoding=None, pretty_print=False, validate=True):
+        """
+        The document is serialized directly from the element tree of the root
+        element. If the root element is not dirty, the validated document is
+        cached on it and returned by the next builds until it is modified.
+        Documents built without validation are not cached, so that they are
+        never returned to a build which asks for validation.
+        """
         if type(root_element) is not cls.root_element:
             raise TypeError("can only build XML documents from root elements of type %s" % cls.root_element.__name__)
+        encoding = encoding or cls.encoding
+        dirty = root_element.__dirty__
+        if not dirty:
+            try:
+                return root_element.__dict__['__build_cache__'][encoding, pretty_print]
+            except KeyError:
+                pass
         element = root_element.to_element()
         if validate and cls.schema is not None:
             cls.schema.assertValid(element)
         # Cleanup namespaces and move element NS mappings to the global scope.
-        normalized_element = etree.Element(element.tag, attrib=element.attrib, nsmap=dict(chain(element.nsmap.iteritems(), cls.nsmap.iteritems())))
-        normalized_element.text = element.text
-        normalized_element.tail = element.tail
-        normalized_element.extend(deepcopy(child) for child in element)
-        etree.cleanup_namespaces(normalized_element)
-        return etree.tostring(normalized_element, encoding=encoding or cls.encoding, method='xml', xml_declaration=True, pretty_print=pretty_print)
+        etree.cleanup_namespaces(element, top_nsmap=cls.nsmap)
+        document = etree.tostring(element, encoding=encoding, method='xml', xml_declaration=True, pretty_print=pretty_print)
+        if not dirty and (validate or cls.schema is None):
+            root_element.__dict__.setdefault('__build_cache__', {})[encoding, pretty_print] = document
+        return document
 
     @classmethod
     def create(cls, build_kw={}, **kw):
@@ -298,6 +319,7 @@ class XMLElementChild(object):
         self.onset = onset
         self.ondel = ondel
         self.values = weakobjectmap()
+        self.pending = weakobjectmap()
 
     def __get__(self, obj, objtype):
         if obj is None:
@@ -305,11 +327,12 @@ class XMLElementChild(object):
         try:
             return self.values[obj]
         except KeyError:
-            return None
+            return self._load(obj)
 
     def __set__(self, obj, value):
         if value is not None and not isinstance(value, self.type):
             value = self.type(value)
+        self._load(obj)
         same_value = False
         old_value = self.values.get(obj)
         if value is old_value:
@@ -319,8 +342,10 @@ class XMLElementChild(object):
             same_value = True
         if old_value is not None:
             obj.element.remove(old_value.element)
+            obj._detach_child(old_value)
         if value is not None:
             obj._insert_element(value.element)
+            obj._attach_child(value)
         self.values[obj] = value
         if not same_value:
             obj.__dirty__ = True
@@ -328,6 +353,7 @@ class XMLElementChild(object):
             self.onset(obj, self, value)
 
     def __delete__(self, obj):
+        self._load(obj)
         try:
             old_value = self.values.pop(obj)
         except KeyError:
@@ -335,10 +361,25 @@ class XMLElementChild(object):
         else:
             if old_value is not None:
                 obj.element.remove(old_value.element)
+                obj._detach_child(old_value)
                 obj.__dirty__ = True
         if self.ondel:
             self.ondel(obj, self)
 
+    def _load(self, obj):
+        # build the child of a lazily parsed element from its XML element
+        try:
+            type, element = self.pending.pop(obj)
+        except KeyError:
+            return None
+        try:
+            value = type.from_element(element, xml_document=obj._xml_document, lazy=True)
+        except ValidationError:
+            return None # we should accept partially valid documents
+        obj._attach_child(value)
+        self.values[obj] = value
+        return value
+
 
 class XMLElementChoiceChildWrapper(object):
     __slots__ = ('descriptor', 'type')
@@ -396,6 +437,7 @@ class XMLElementChoiceChild(object):
         self.onset = onset
         self.ondel = ondel
         self.values = weakobjectmap()
+        self.pending = weakobjectmap()
 
     def __get__(self, obj, objtype):
         if obj is None:
@@ -403,11 +445,12 @@ class XMLElementChoiceChild(object):
         try:
             return self.values[obj]
         except KeyError:
-            return None
+            return self._load(obj)
 
     def __set__(self, obj, value):
         if value is not None and type(value) not in self.types:
             raise TypeError("%s is not an acceptable type for %s" % (value.__class__.__name__, obj.__class__.__name__))
+        self._load(obj)
         same_value = False
         old_value = self.values.get(obj)
         if value is old_value:
@@ -417,8 +460,10 @@ class XMLElementChoiceChild(object):
             same_value = True
         if old_value is not None:
             obj.element.remove(old_value.element)
+            obj._detach_child(old_value)
         if value is not None:
             obj._insert_element(value.element)
+            obj._attach_child(value)
         self.values[obj] = value
         if not same_value:
             obj.__dirty__ = True
@@ -426,6 +471,7 @@ class XMLElementChoiceChild(object):
             self.onset(obj, self, value)
 
     def __delete__(self, obj):
+        self._load(obj)
         try:
             old_value = self.values.pop(obj)
         except KeyError:
@@ -433,10 +479,25 @@ class XMLElementChoiceChild(object):
         else:
             if old_value is not None:
                 obj.element.remove(old_value.element)
+                obj._detach_child(old_value)
                 obj.__dirty__ = True
         if self.ondel:
             self.ondel(obj, self)
 
+    def _load(self, obj):
+        # build the child of a lazily parsed element from its XML element
+        try:
+            type, element = self.pending.pop(obj)
+        except KeyError:
+            return None
+        try:
+            value = type.from_element(element, xml_document=obj._xml_document, lazy=True)
+        except ValidationError:
+            return None # we should accept partially valid documents
+        obj._attach_child(value)
+        self.values[obj] = value
+        return value
+
 
 class XMLStringChoiceChild(XMLElementChoiceChild):
     """
@@ -549,24 +610,131 @@ class XMLElement(XMLElementBase):
 
     qname = classproperty(lambda cls: '{%s}%s' % (cls._xml_namespace, cls._xml_tag))
 
+    # weak reference to the element which contains this one, set while it is part of a tree
+    __parent__ = None
+
+    # the number of removed items an element keeps track of, past which it is rebuilt as a whole
+    removed_children_limit = 16
+
     def __init__(self):
         self.element = etree.Element(self.qname, nsmap=self._xml_document.nsmap)
         self.__dirty__ = True
 
+    # An element is dirty if it was modified itself, if any of the child elements it contains is dirty or if any
+    # of its items was removed. Rather than walking the tree to find out, each element keeps the children which are
+    # dirty and tells its parent when its own state changes, so that checking whether a tree is dirty doesn't depend
+    # on its size. Children which were not built yet by a lazy parse are clean by definition and are not linked to
+    # their parent until built.
+
     def __get_dirty__(self):
-        return (self.__dict__['__dirty__']
-                or any(child.__dirty__ for child in (getattr(self, name) for name in self._xml_element_children) if child is not None)
+        return (self.__dict__.get('__dirty__', False)
+                or bool(self.__dict__.get('__dirty_children__'))
+                or bool(self.__dict__.get('__removed_children__'))
                 or super(XMLElement, self).__get_dirty__())
 
     def __set_dirty__(self, dirty):
         super(XMLElement, self).__set_dirty__(dirty)
+        was_dirty = self.__dirty__
         if not dirty:
-            for child in (child for child in (getattr(self, name) for name in self._xml_element_children) if child is not None):
+            # the document may have changed since it was cached by XMLDocument.build
+            self.__dict__.pop('__build_cache__', None)
+            self.__dict__.pop('__removed_children__', None)
+            for child in self.__dict__.get('__dirty_children__', {}).values():
                 child.__dirty__ = dirty
         self.__dict__['__dirty__'] = dirty
+        if self.__dirty__ != was_dirty:
+            self._notify_parent()
 
     __dirty__ = property(__get_dirty__, __set_dirty__)
 
+    def dirty_paths(self):
+        """
+        Return the paths to the subtrees which changed since this element was
+        last marked as clean. Each path is a tuple of elements starting with
+        this element and ending with an element which was modified itself, as
+        opposed to only containing modified elements, and which needs to be
+        rebuilt as a whole. The elements below it are not traversed.
+        """
+        paths = []
+        pending = deque([(self,)])
+        while pending:
+            path = pending.popleft()
+            element = path[-1]
+            if element.__dict__.get('__dirty__', False):
+                paths.append(path)
+            else:
+                pending.extend(path + (child,) for child in element.__dict__.get('__dirty_children__', {}).itervalues())
+        return paths
+
+    def removed_paths(self):
+        """
+        Return the paths to the items which were removed since this element was
+        last marked as clean from lists which were not modified themselves.
+        Each path is a tuple of elements starting with this element and ending
+        with the removed item, which is no longer part of the tree. The items
+        are only recorded if the root element of the tree tracks removals.
+        """
+        paths = []
+        pending = deque([(self,)])
+        while pending:
+            path = pending.popleft()
+            element = path[-1]
+            if not element.__dict__.get('__dirty__', False):
+                paths.extend(path + (child,) for child in element.__dict__.get('__removed_children__', {}).itervalues())
+                pending.extend(path + (child,) for child in element.__dict__.get('__dirty_children__', {}).itervalues())
+        return paths
+
+    def _attach_child(self, child):
+        parent = child.__parent__() if child.__parent__ is not None else None
+        if parent is not None and parent is not self:
+            parent._detach_child(child)
+        child.__parent__ = weakref(self)
+        if child.__dirty__:
+            self._update_dirty_child(child, True)
+
+    def _detach_child(self, child):
+        if child.__parent__ is not None and child.__parent__() is self:
+            child.__parent__ = None
+            self._update_dirty_child(child, False)
+
+    def _update_dirty_child(self, child, dirty):
+        was_dirty = self.__dirty__
+        # children are indexed by id as elements with an ID compare and hash by their ID
+        if dirty:
+            self.__dict__.setdefault('__dirty_children__', {})[id(child)] = child
+        else:
+            self.__dict__.get('__dirty_children__', {}).pop(id(child), None)
+        if self.__dirty__ != was_dirty:
+            self._notify_parent()
+
+    def _add_removed_child(self, child):
+        # The removed items are only kept for the trees which track them and only up to a limit, past which (or
+        # otherwise) the element is marked as modified itself, which doesn't keep references to the removed items.
+        # Nothing is kept either for an element which was already modified, as it will be rebuilt as a whole.
+        if self.__dict__.get('__dirty__', False):
+            return
+        removed_children = self.__dict__.get('__removed_children__', {})
+        if len(removed_children) >= self.removed_children_limit or not self._tracks_removals():
+            self.__dict__.pop('__removed_children__', None)
+            self.__dirty__ = True
+            return
+        was_dirty = self.__dirty__
+        self.__dict__['__removed_children__'] = removed_children
+        removed_children[id(child)] = child
+        if not was_dirty:
+            self._notify_parent()
+
+    def _tracks_removals(self):
+        element = self
+        while element.__parent__ is not None and element.__parent__() is not None:
+            element = element.__parent__()
+        return getattr(element, 'track_removals', False)
+
+    def _notify_parent(self):
+        parent = self.__parent__() if self.__parent__ is not None else None
+        if parent is not None:
+            parent._update_dirty_child(self, self.__dirty__)
+
     def check_validity(self):
         # check attributes
         for name, attribute in self._xml_attributes.iteritems():
@@ -576,6 +744,8 @@ class XMLElement(XMLElementBase):
                 raise ValidationError("required attribute %s of %s is not set" % (name, self.__class__.__name__))
         # check element children
         for name, element_child in self._xml_element_children.iteritems():
+            if self in element_child.pending:
+                continue
             # if child has default but it was not set, will also be added with this occasion
             child = getattr(self, name, None)
             if child is None and element_child.required:
@@ -586,17 +756,16 @@ class XMLElement(XMLElementBase):
             self.check_validity()
         except ValidationError, e:
             raise BuilderError(str(e))
-        # build element children
-        for name in self._xml_element_children:
-            descriptor = getattr(self.__class__, name)
-            child = descriptor.__get__(self, StoredAttribute)
+        # build element children (the ones which were not built yet by a lazy parse did not change)
+        for descriptor in self._xml_element_children.itervalues():
+            child = descriptor.values.get(self)
             if child is not None:
                 child.to_element()
         self._build_element()
         return self.element
 
     @classmethod
-    def from_element(cls, element, xml_document=None):
+    def from_element(cls, element, xml_document=None, lazy=False):
         obj = cls.__new__(cls)
         obj._xml_document = xml_document if xml_document is not None else cls._xml_document
         obj.element = element
@@ -611,7 +780,9 @@ class XMLElement(XMLElementBase):
         # set element children
         for child in element:
             element_child, type = cls._xml_children_qname_map.get(child.tag, (None, None))
-            if element_child is not None:
+            if element_child is not None and lazy and element_child.onset is None:
+                element_child.pending[obj] = type, child
+            elif element_child is not None:
                 try:
                     value = type.from_element(child, xml_document=obj._xml_document)
                 except ValidationError:
@@ -656,18 +827,38 @@ class XMLElement(XMLElementBase):
         cls._unregister_xml_attribute(attribute)
         delattr(cls, attribute)
 
+    def _element_order(self, tag):
+        return self._xml_children_order.get(tag, self._xml_children_order.get(None, sys.maxint))
+
     def _insert_element(self, element):
         if element in self.element:
             return
-        order = self._xml_children_order.get(element.tag, self._xml_children_order.get(None, sys.maxint))
-        for i in xrange(len(self.element)):
-            child_order = self._xml_children_order.get(self.element[i].tag, self._xml_children_order.get(None, sys.maxint))
-            if child_order > order:
-                position = i
+        # The children are kept sorted by their order, so the element goes after the last child which doesn't have a
+        # greater order. Searching for it backwards only goes over the children which must come after the element,
+        # which are usually few or none, as most elements have a single kind of children with multiple instances.
+        order = self._element_order(element.tag)
+        for child in reversed(self.element):
+            if self._element_order(child.tag) <= order:
+                child.addnext(element)
                 break
         else:
-            position = len(self.element)
-        self.element.insert(position, element)
+            self.element.insert(0, element)
+
+    def _insert_elements(self, elements):
+        # Insert the elements sorted by their order in one pass, where each element is placed after the previous one
+        # and after the children which follow it and don't have a greater order.
+        previous = None
+        for order, element in sorted(((self._element_order(element.tag), element) for element in elements), key=itemgetter(0)):
+            if element in self.element:
+                continue
+            if previous is None:
+                self._insert_element(element)
+            else:
+                sibling = previous.getnext()
+                while sibling is not None and self._element_order(sibling.tag) <= order:
+                    previous, sibling = sibling, sibling.getnext()
+                previous.addnext(element)
+            previous = element
 
     def __eq__(self, other):
         if isinstance(other, XMLElement):
@@ -714,19 +905,23 @@ class XMLRootElementType(XMLElementType):
 class XMLRootElement(XMLElement):
     __metaclass__ = XMLRootElementType
 
+    # if True, the items removed from the lists of the tree are kept until it is marked as clean, so they can be
+    # returned by removed_paths, otherwise the lists they were removed from are marked as modified themselves
+    track_removals = False
+
     def __init__(self):
         XMLElement.__init__(self)
         self.__cache__ = WeakValueDictionary({self.element: self})
 
     @classmethod
-    def from_element(cls, element, xml_document=None):
-        obj = super(XMLRootElement, cls).from_element(element, xml_document)
+    def from_element(cls, element, xml_document=None, lazy=False):
+        obj = super(XMLRootElement, cls).from_element(element, xml_document, lazy)
         obj.__cache__ = WeakValueDictionary({obj.element: obj})
         return obj
 
     @classmethod
-    def parse(cls, document):
-        return cls._xml_document.parse(document)
+    def parse(cls, document, validate=True, lazy=False):
+        return cls._xml_document.parse(document, validate=validate, lazy=lazy)
 
     def toxml(self, encoding=None, pretty_print=False, validate=True):
         return self._xml_document.build(self, encoding=encoding, pretty_print=pretty_print, validate=validate)
@@ -772,6 +967,40 @@ class XMLRootElement(XMLElement):
     def get_xpath(self, element):
         raise NotImplementedError
 
+    def get_node_selector(self, path):
+        """
+        Return the XCAP node selector for the last element of a path, as
+        returned by dirty_paths or removed_paths, or None if the element
+        cannot be addressed. Elements are selected by their ID attribute if
+        they have one and by their position otherwise, which is only possible
+        while they are part of the tree.
+        """
+        if not path or path[0] is not self:
+            raise ValueError('the path must start with the root element')
+        nsmap = dict((namespace, prefix) for prefix, namespace in self._xml_document.nsmap.iteritems())
+        nsmap[self._xml_namespace] = None
+        xpath_nsmap = {}
+        components = ['/' + self._xml_tag]
+        for parent, element in izip(path, path[1:]):
+            try:
+                prefix = nsmap[element._xml_namespace]
+            except KeyError:
+                return None
+            if prefix:
+                name = '%s:%s' % (prefix, element._xml_tag)
+                xpath_nsmap[element._xml_namespace] = prefix
+            else:
+                name = element._xml_tag
+            id_attribute = type(element)._xml_id
+            if id_attribute is not None and not id_attribute.xmlname.startswith('{') and element.element.get(id_attribute.xmlname) is not None:
+                components.append('/%s[@%s=%s]' % (name, id_attribute.xmlname, quoteattr(element.element.get(id_attribute.xmlname))))
+            elif element.element.getparent() is parent.element:
+                position = 1 + sum(1 for sibling in element.element.itersiblings(element.element.tag, preceding=True))
+                components.append('/%s[%d]' % (name, position))
+            else:
+                return None
+        return ''.join(components) + ('?' + ''.join('xmlns(%s=%s)' % (prefix, namespace) for namespace, prefix in xpath_nsmap.iteritems()) if xpath_nsmap else '')
+
     def find_parent(self, element):
         raise NotImplementedError
 
@@ -874,17 +1103,10 @@ class XMLListMixin(XMLElementBase):
         else:
             self.remove(self._xmlid_map[cls][id])
 
-    def __get_dirty__(self):
-        return any(item.__dirty__ for item in self._element_map.itervalues()) or super(XMLListMixin, self).__get_dirty__()
-
-    def __set_dirty__(self, dirty):
-        super(XMLListMixin, self).__set_dirty__(dirty)
-        if not dirty:
-            for item in self._element_map.itervalues():
-                item.__dirty__ = dirty
-
     def _parse_element(self, element):
         super(XMLListMixin, self)._parse_element(element)
+        for item in self._element_map.itervalues():
+            self._detach_child(item)
         self._element_map.clear()
         self._xmlid_map.clear()
         for child in element[:]:
@@ -901,6 +1123,7 @@ class XMLListMixin(XMLElementBase):
                         if value._xml_id is not None:
                             self._xmlid_map[child_class][value._xml_id] = value
                         self._element_map[value.element] = value
+                        self._attach_child(value)
 
     def _build_element(self):
         super(XMLListMixin, self)._build_element()
@@ -918,26 +1141,45 @@ class XMLListMixin(XMLElementBase):
             elif item == old_item:
                 item.__dirty__ = old_item.__dirty__
                 same_value = True
-            self.element.remove(old_item.element)
+            if old_item.element.getparent() is self.element: # it was not inserted yet if it was added by the same update
+                self.element.remove(old_item.element)
             del self._xmlid_map[item.__class__][item._xml_id]
             del self._element_map[old_item.element]
-        self._insert_element(item.element)
+            self._detach_child(old_item)
+        pending_elements = self.__dict__.get('__pending_elements__')
+        if pending_elements is not None:
+            pending_elements.append(item.element)
+        else:
+            self._insert_element(item.element)
         if item._xml_id is not None:
             self._xmlid_map[item.__class__][item._xml_id] = item
         self._element_map[item.element] = item
+        self._attach_child(item)
         if not same_value:
-            self.__dirty__ = True
+            item.__dirty__ = True
 
     def remove(self, item):
         self.element.remove(item.element)
         if item._xml_id is not None:
             del self._xmlid_map[item.__class__][item._xml_id]
         del self._element_map[item.element]
-        self.__dirty__ = True
+        self._detach_child(item)
+        self._add_removed_child(item)
 
     def update(self, sequence):
-        for item in sequence:
-            self.add(item)
+        # The items are added one by one, which goes through the add method of subclasses, but their elements are
+        # only inserted at the end, in one pass. The ones replaced in the meantime are no longer in the element map.
+        if '__pending_elements__' in self.__dict__:
+            for item in sequence:
+                self.add(item)
+            return
+        pending_elements = self.__dict__['__pending_elements__'] = []
+        try:
+            for item in sequence:
+                self.add(item)
+        finally:
+            del self.__dict__['__pending_elements__']
+            self._insert_elements(element for element in pending_elements if element in self._element_map)
 
     def clear(self):
         for item in self._element_map.values():
@@ -0,0 +1,49 @@
+
+"""Parsing of payload documents on a pool of worker threads"""
+
+__all__ = ['PayloadParser']
+
+from application.python.threadpool import ThreadPool, run_in_threadpool
+from application.python.types import Singleton
+from eventlib import coros
+
+from sipsimple.threading import call_in_twisted_thread
+
+
+class PayloadParser(object):
+    """
+    Parses payload documents for the subscribers. By default the documents
+    are parsed inline, but when enabled the parsing is done on a pool of
+    worker threads, while the calling green thread waits for the result
+    without blocking the reactor. As each subscription waits for the result
+    before handling its next notification, the documents it receives are
+    still delivered in the order in which they arrived.
+
+    The parse method must be called from a green thread when enabled.
+    """
+
+    __metaclass__ = Singleton
+
+    threadpool = ThreadPool(name='PayloadParser', min_threads=0, max_threads=4)
+    threadpool.start()
+
+    def __init__(self):
+        self.enabled = False
+
+    def parse(self, document_class, data, **kw):
+        if not self.enabled:
+            return document_class.parse(data, **kw)
+        event = coros.event()
+        self._parse(document_class, data, kw, event)
+        return event.wait()
+
+    @run_in_threadpool(threadpool)
+    def _parse(self, document_class, data, kw, event):
+        try:
+            document = document_class.parse(data, **kw)
+        except Exception, e:
+            call_in_twisted_thread(event.send_exception, e)
+        else:
+            call_in_twisted_thread(event.send, document)
+
+
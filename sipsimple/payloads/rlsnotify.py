@@ -3,7 +3,8 @@
 
 __all__ = ['RLSNotify']
 
-import email
+from email.message import Message
+from hashlib import sha1
 
 from sipsimple.payloads import IterateItems, ParserError
 from sipsimple.payloads import rlmi, pidf
@@ -19,6 +20,94 @@ class ResourceURI(unicode):
         return NotImplemented if equal is NotImplemented else not equal
 
 
+class MultipartPart(object):
+    """A part of a multipart body, which refers to the body instead of holding a copy of its content"""
+
+    def __init__(self, data, start, end, headers):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.headers = headers
+        self._digest = None
+
+    @property
+    def content_id(self):
+        return self.headers.get('content-id')
+
+    @property
+    def content_type(self):
+        return self.headers.get('content-type', 'text/plain').partition(';')[0].strip().lower()
+
+    @property
+    def body(self):
+        return self.data[self.start:self.end]
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = sha1(buffer(self.data, self.start, self.end - self.start)).digest()
+        return self._digest
+
+
+def parse_headers(data, start, end):
+    """Parse the MIME headers found in data between start and end and return them together with the position where the body starts"""
+    headers = {}
+    name = None
+    position = start
+    while position < end:
+        line_end = data.find('\n', position, end)
+        if line_end == -1:
+            line_end = end
+        line = data[position:line_end].rstrip('\r')
+        position = line_end + 1
+        if not line:
+            break
+        elif line[0] in ' \t' and name is not None:
+            headers[name] += ' ' + line.strip()
+        else:
+            name, separator, value = line.partition(':')
+            name = name.strip().lower()
+            headers[name] = value.strip()
+    return headers, min(position, end)
+
+
+def parse_multipart(data, start, boundary):
+    """
+    Split the multipart body found in data after start into its parts in a
+    single pass. Only the headers of the parts are parsed, their content is
+    left in place and is only copied when it is accessed.
+    """
+    delimiter = '--' + boundary
+    parts = []
+    position = _find_delimiter(data, delimiter, start)
+    while position != -1:
+        position += len(delimiter)
+        if data.startswith('--', position):
+            break
+        line_end = data.find('\n', position)
+        if line_end == -1:
+            break
+        part_start = line_end + 1
+        position = _find_delimiter(data, delimiter, part_start)
+        if position == -1:
+            part_end = len(data) # accept bodies which are missing the closing delimiter
+        elif data.startswith('\r\n', position - 2) and position - 2 >= part_start:
+            part_end = position - 2
+        else:
+            part_end = max(position - 1, part_start)
+        headers, body_start = parse_headers(data, part_start, part_end)
+        parts.append(MultipartPart(data, body_start, part_end, headers))
+    return parts
+
+
+def _find_delimiter(data, delimiter, start):
+    # a delimiter is only recognized at the beginning of a line
+    position = data.find(delimiter, start)
+    while position > 0 and data[position-1] != '\n':
+        position = data.find(delimiter, position + 1)
+    return position
+
+
 class Resource(object):
     __prioritymap__ = dict(active=10, pending=20, terminated=30)
 
@@ -28,9 +117,30 @@ class Resource(object):
         self.state = state
         self.reason = reason
         self.pidf_list = pidf_list or []
+        self.changed = True
+        self._digests = None
+
+    @property
+    def pidf_list(self):
+        # the PIDF documents are only parsed when they are first accessed
+        if self._pidf_list is None:
+            pidf_list = []
+            for part in self._pidf_parts:
+                try:
+                    pidf_list.append(pidf.PIDFDocument.parse(part.body))
+                except ParserError:
+                    pass
+            self._pidf_list = pidf_list
+            self._pidf_parts = ()
+        return self._pidf_list
+
+    @pidf_list.setter
+    def pidf_list(self, pidf_list):
+        self._pidf_list = pidf_list
+        self._pidf_parts = ()
 
     @classmethod
-    def from_payload(cls, xml_element, payload_map):
+    def from_payload(cls, xml_element, payload_map, previous_resources=None):
         try:
             name = next(element for element in xml_element if isinstance(element, rlmi.Name))
         except StopIteration:
@@ -47,17 +157,25 @@ class Resource(object):
             instance = sorted(instances, key=lambda item: cls.__prioritymap__[item.state])[0]
             state = instance.state
             reason = instance.reason
-        pidf_list = []
+        parts = []
         for instance in (instance for instance in instances if instance.cid is not None):
             try:
-                payload = payload_map['<%s>' % instance.cid].get_payload()
+                parts.append(payload_map['<%s>' % instance.cid])
             except KeyError:
                 continue
-            try:
-                pidf_list.append(pidf.PIDFDocument.parse(payload))
-            except ParserError:
-                pass
-        return cls(xml_element.uri, name, state, reason, pidf_list)
+        resource = cls(xml_element.uri, name, state, reason)
+        resource._pidf_list = None
+        resource._pidf_parts = parts
+        if previous_resources is not None:
+            # the resources whose content didn't change since the previous notification reuse its documents
+            resource._digests = [part.digest for part in parts]
+            previous = previous_resources.get(resource.uri)
+            if previous is not None and previous._digests == resource._digests and (previous.name, previous.state, previous.reason) == (name, state, reason):
+                resource.changed = False
+                if previous._pidf_list is not None:
+                    resource._pidf_list = previous._pidf_list
+                    resource._pidf_parts = ()
+        return resource
 
 
 class RLSNotify(object):
@@ -77,15 +195,34 @@ class RLSNotify(object):
     def __len__(self):
         return len(self.resources)
 
+    @property
+    def changed_resources(self):
+        return [resource for resource in self.resources if resource.changed]
+
     @classmethod
-    def parse(cls, payload):
-        message = email.message_from_string(payload)
+    def parse(cls, payload, previous_resources=None, lazy=True):
+        """
+        Parse the payload, which consists of the MIME headers of the
+        multipart/related body followed by an empty line and the body itself.
+        If previous_resources is a mapping from URIs to the resources received
+        in the previous notifications of the same subscription, the resources
+        whose state and content didn't change are marked as unchanged and reuse
+        the documents which were already parsed for them. If lazy is True the
+        PIDF documents of the resources are parsed on first access, otherwise
+        they are parsed upfront.
+        """
+        headers, body_start = parse_headers(payload, 0, len(payload))
+        message = Message()
+        message['Content-Type'] = headers.get('content-type', 'text/plain')
         if message.get_content_type() != cls.content_type:
             raise ParserError("expected multipart/related content, got %s" % message.get_content_type())
-        payloads = message.get_payload()
+        boundary = message.get_boundary()
+        if boundary is None:
+            raise ParserError("multipart/related content has no boundary")
+        payloads = parse_multipart(payload, body_start, boundary)
         if len(payloads) == 0:
             raise ParserError("multipart/related body contains no parts")
-        payload_map = dict((payload['Content-ID'], payload) for payload in payloads if payload['Content-ID'] is not None)
+        payload_map = dict((payload.content_id, payload) for payload in payloads if payload.content_id is not None)
         root_id = message.get_param('start')
         root_type = message.get_param('type', '').lower()
         if root_id is not None:
@@ -95,10 +232,13 @@ class RLSNotify(object):
                 raise ParserError('cannot find root element')
         else:
             root = payloads[0]
-        if root_type != rlmi.RLMIDocument.content_type != root.get_content_type():
+        if root_type != rlmi.RLMIDocument.content_type != root.content_type:
             raise ParserError("the multipart/related root element must be of type %s" % rlmi.RLMIDocument.content_type)
-        rlmi_document = rlmi.RLMIDocument.parse(root.get_payload())
-        resources = [Resource.from_payload(xml_element, payload_map) for xml_element in rlmi_document[rlmi.Resource, IterateItems]]
+        rlmi_document = rlmi.RLMIDocument.parse(root.body)
+        resources = [Resource.from_payload(xml_element, payload_map, previous_resources) for xml_element in rlmi_document[rlmi.Resource, IterateItems]]
+        if not lazy:
+            for resource in resources:
+                resource.pidf_list
         return cls(rlmi_document.uri, rlmi_document.version, rlmi_document.full_state, resources)
 
 
@@ -301,17 +301,42 @@ class MSRPStreamBase(object):
 #
 
 class ChunkInfo(object):
-    __slots__ = 'content_type', 'header', 'footer', 'data'
+    __slots__ = 'content_type', 'header', 'footer', 'data', 'size', 'limit', '_parts', '_captured'
 
-    def __init__(self, content_type, header='', footer='', data=''):
+    def __init__(self, content_type, header='', footer='', data='', limit=None):
         self.content_type = content_type
         self.header = header
         self.footer = footer
         self.data = data
+        self.size = len(data)
+        self.limit = limit if self.has_readable_content else 0
+        self._parts = []
+        self._captured = 0
 
     def __repr__(self):
         return "{0.__class__.__name__}(content_type={0.content_type!r}, header={0.header!r}, footer={0.footer!r}, data={0.data!r})".format(self)
 
+    def add_data(self, data):
+        # only the first limit bytes are kept, the size of the rest is only accounted for
+        self.size += len(data)
+        if self.limit is not None:
+            data = data[:self.limit - self._captured]
+        if data:
+            self._parts.append(data)
+            self._captured += len(data)
+
+    def finish(self, footer):
+        self.footer = footer
+        self.data += ''.join(self._parts)
+        self._parts = []
+        if self.size > len(self.data):
+            self.data += '<<<%d more bytes>>>' % (self.size - len(self.data))
+
+    @property
+    def has_readable_content(self):
+        # the payload of the other content types is stripped from the normalized content, so there is no point in keeping it
+        return self.content_type is None or self.content_type in ('message/cpim', 'application/im-iscomposing+xml') or self.content_type.startswith(('text/', 'message/'))
+
     @property
     def content(self):
         return self.header + self.data + self.footer
@@ -324,7 +349,15 @@ class ChunkInfo(object):
             headers, sep, body = self.data.partition('\r\n\r\n')
             if not sep:
                 return self.header + self.data + self.footer
-            mime_headers, mime_sep, mime_body = body.partition('\n\n')
+            # the MIME headers end with an empty line, which is terminated by CRLF in the messages we send and may be
+            # terminated by LF only in the ones we receive, so the separator which comes first is used
+            crlf_position = body.find('\r\n\r\n')
+            lf_position = body.find('\n\n')
+            if crlf_position != -1 and (lf_position == -1 or crlf_position < lf_position):
+                mime_sep = '\r\n\r\n'
+            else:
+                mime_sep = '\n\n'
+            mime_headers, mime_sep, mime_body = body.partition(mime_sep)
             if not mime_sep:
                 return self.header + self.data + self.footer
             for mime_header in mime_headers.lower().splitlines():
@@ -345,6 +378,15 @@ class ChunkInfo(object):
 
 
 class NotificationProxyLogger(object):
+    """
+    Logger for msrplib that posts the MSRP traffic as MSRPTransportTrace
+    notifications when MSRP tracing is enabled. Chunks are only captured
+    while tracing is enabled and no more than max_chunk_data bytes of the
+    payload of each chunk are kept.
+    """
+
+    max_chunk_data = 65536
+
     def __init__(self):
         from application import log
         self.level = log.level
@@ -359,28 +401,34 @@ class NotificationProxyLogger(object):
         pass
 
     def received_new_chunk(self, data, transport, chunk):
-        self.chunks[chunk.transaction_id] = ChunkInfo(chunk.content_type, header=data)
+        if self.log_settings.trace_msrp:
+            self.chunks[chunk.transaction_id] = ChunkInfo(chunk.content_type, header=data, limit=self.max_chunk_data)
 
     def received_chunk_data(self, data, transport, transaction_id):
-        self.chunks[transaction_id].data += data
+        chunk_info = self.chunks.get(transaction_id)
+        if chunk_info is not None:
+            chunk_info.add_data(data)
 
     def received_chunk_end(self, data, transport, transaction_id):
-        chunk_info = self.chunks.pop(transaction_id)
-        chunk_info.footer = data
-        if self.log_settings.trace_msrp:
+        chunk_info = self.chunks.pop(transaction_id, None)
+        if chunk_info is not None:
+            chunk_info.finish(data)
             notification_data = NotificationData(direction='incoming', local_address=transport.getHost(), remote_address=transport.getPeer(), data=chunk_info.normalized_content)
             self.notification_center.post_notification('MSRPTransportTrace', sender=transport, data=notification_data)
 
     def sent_new_chunk(self, data, transport, chunk):
-        self.chunks[chunk.transaction_id] = ChunkInfo(chunk.content_type, header=data)
+        if self.log_settings.trace_msrp:
+            self.chunks[chunk.transaction_id] = ChunkInfo(chunk.content_type, header=data, limit=self.max_chunk_data)
 
     def sent_chunk_data(self, data, transport, transaction_id):
-        self.chunks[transaction_id].data += data
+        chunk_info = self.chunks.get(transaction_id)
+        if chunk_info is not None:
+            chunk_info.add_data(data)
 
     def sent_chunk_end(self, data, transport, transaction_id):
-        chunk_info = self.chunks.pop(transaction_id)
-        chunk_info.footer = data
-        if self.log_settings.trace_msrp:
+        chunk_info = self.chunks.pop(transaction_id, None)
+        if chunk_info is not None:
+            chunk_info.finish(data)
             notification_data = NotificationData(direction='outgoing', local_address=transport.getHost(), remote_address=transport.getPeer(), data=chunk_info.normalized_content)
             self.notification_center.post_notification('MSRPTransportTrace', sender=transport, data=notification_data)
 
@@ -14,17 +14,19 @@ from application.notification import IObserver, NotificationCenter, Notification
 from application.python import Null
 from application.python.types import Singleton
 from application.system import openfile
-from collections import defaultdict
-from email.message import Message as EmailMessage
+from collections import OrderedDict
 from email.parser import Parser as EmailParser
 from eventlib.coros import queue
 from eventlib.proc import spawn, ProcExit
 from functools import partial
+from time import time
 from msrplib.protocol import FailureReportHeader, SuccessReportHeader, UseNicknameHeader
 from msrplib.session import MSRPSession, contains_mime_type
 from otr import OTRSession, OTRTransport, OTRState, SMPStatus
 from otr.cryptography import DSAPrivateKey
 from otr.exceptions import IgnoreMessage, UnencryptedMessage, EncryptedMessageError, OTRError
+from twisted.internet import reactor
+from weakref import WeakSet
 from zope.interface import implements
 
 from sipsimple.core import SIPURI, BaseSIPURI
@@ -286,6 +288,144 @@ class OTREncryption(object):
 class ChatStreamError(MSRPStreamError): pass
 
 
+class ChatReassemblyStatistics(object):
+    def __init__(self):
+        self.buffered_bytes = 0
+        self.buffered_messages = 0
+        self.peak_bytes = 0
+        self.completed = 0
+        self.aborted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%d' % (name, value) for name, value in sorted(self.__dict__.iteritems())))
+
+
+class ChatReassemblyManager(object):
+    """
+    Keeps track of the memory used for reassembling the chunked messages
+    received by all the chat streams. A message is rejected once it would
+    make the data buffered by its stream exceed stream_budget bytes or the
+    data buffered by all the streams exceed global_budget bytes. Messages
+    whose next chunk does not arrive within idle_timeout seconds are
+    dropped by a periodic sweep.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self, stream_budget=10*1024*1024, global_budget=128*1024*1024, idle_timeout=60):
+        self.stream_budget = stream_budget
+        self.global_budget = global_budget
+        self.idle_timeout = idle_timeout
+        self.statistics = ChatReassemblyStatistics()
+        self.buffers = WeakSet()
+        self._sweep_timer = None
+
+    def reserve(self, buffer, size):
+        if buffer.size + size > self.stream_budget or self.statistics.buffered_bytes + size > self.global_budget:
+            return False
+        self.statistics.buffered_bytes += size
+        self.statistics.peak_bytes = max(self.statistics.peak_bytes, self.statistics.buffered_bytes)
+        self.buffers.add(buffer)
+        if self._sweep_timer is None:
+            self._sweep_timer = reactor.callLater(self.idle_timeout/2.0, self._sweep)
+        return True
+
+    def release(self, size):
+        self.statistics.buffered_bytes -= size
+
+    def _sweep(self):
+        self._sweep_timer = None
+        expiration = time() - self.idle_timeout
+        for buffer in list(self.buffers):
+            buffer.expire(expiration)
+        if self.statistics.buffered_messages:
+            self._sweep_timer = reactor.callLater(self.idle_timeout/2.0, self._sweep)
+
+
+class ChatMessageReassembly(object):
+    """
+    Collects the chunks of the messages received by a chat stream, within
+    the budgets imposed by the ChatReassemblyManager.
+    """
+
+    max_rejected = 100
+
+    def __init__(self):
+        self.manager = ChatReassemblyManager()
+        self.messages = {}
+        self.rejected = OrderedDict()
+        self.size = 0
+
+    def __del__(self):
+        self.clear()
+
+    def add(self, message_id, data):
+        """
+        Add a chunk of the message. Returns False if the message was rejected
+        because it is over budget, in which case the rest of its chunks should
+        be rejected as well.
+        """
+        if message_id in self.rejected:
+            return False
+        if not self.manager.reserve(self, len(data)):
+            self._remove(message_id)
+            self.rejected[message_id] = None
+            while len(self.rejected) > self.max_rejected:
+                self.rejected.popitem(last=False)
+            self.manager.statistics.rejected += 1
+            return False
+        try:
+            parts, size, last_activity = self.messages[message_id]
+        except KeyError:
+            parts, size = [], 0
+            self.manager.statistics.buffered_messages += 1
+        parts.append(data)
+        self.messages[message_id] = parts, size+len(data), time()
+        self.size += len(data)
+        return True
+
+    def complete(self, message_id, data):
+        """
+        Return the data of the message given its last chunk, or None if the
+        message was rejected.
+        """
+        if message_id in self.rejected:
+            del self.rejected[message_id]
+            return None
+        parts = self._remove(message_id)
+        if parts is None:
+            return data
+        self.manager.statistics.completed += 1
+        parts.append(data)
+        return ''.join(parts)
+
+    def abort(self, message_id):
+        self.rejected.pop(message_id, None)
+        if self._remove(message_id) is not None:
+            self.manager.statistics.aborted += 1
+
+    def expire(self, expiration):
+        for message_id in [message_id for message_id, (parts, size, last_activity) in self.messages.iteritems() if last_activity <= expiration]:
+            self._remove(message_id)
+            self.manager.statistics.expired += 1
+
+    def clear(self):
+        for message_id in self.messages.keys():
+            self._remove(message_id)
+        self.rejected.clear()
+
+    def _remove(self, message_id):
+        try:
+            parts, size, last_activity = self.messages.pop(message_id)
+        except KeyError:
+            return None
+        self.size -= size
+        self.manager.release(size)
+        self.manager.statistics.buffered_messages -= 1
+        return parts
+
+
 class ChatStream(MSRPStreamBase):
     type = 'chat'
     priority = 1
@@ -302,7 +442,7 @@ class ChatStream(MSRPStreamBase):
         super(ChatStream, self).__init__(direction='sendrecv')
         self.message_queue = queue()
         self.sent_messages = set()
-        self.incoming_queue = defaultdict(list)
+        self.incoming_queue = ChatMessageReassembly()
         self.message_queue_thread = None
         self.encryption = OTREncryption(self)
 
@@ -370,6 +510,7 @@ class ChatStream(MSRPStreamBase):
                 notification.center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
 
     def _NH_MediaStreamDidEnd(self, notification):
+        self.incoming_queue.clear()
         if self.message_queue_thread is not None:
             self.message_queue_thread.kill()
         else:
@@ -400,15 +541,20 @@ class ChatStream(MSRPStreamBase):
             self.msrp_session.send_report(chunk, 413, 'Unwanted Message')
             return
         if chunk.contflag == '#':
-            self.incoming_queue.pop(chunk.message_id, None)
+            self.incoming_queue.abort(chunk.message_id)
             self.msrp_session.send_report(chunk, 200, 'OK')
             return
         elif chunk.contflag == '+':
-            self.incoming_queue[chunk.message_id].append(chunk.data)
-            self.msrp_session.send_report(chunk, 200, 'OK')
+            if self.incoming_queue.add(chunk.message_id, chunk.data):
+                self.msrp_session.send_report(chunk, 200, 'OK')
+            else:
+                self.msrp_session.send_report(chunk, 413, 'Message Too Large')
             return
         else:
-            data = ''.join(self.incoming_queue.pop(chunk.message_id, [])) + chunk.data
+            data = self.incoming_queue.complete(chunk.message_id, chunk.data)
+            if data is None:
+                self.msrp_session.send_report(chunk, 413, 'Message Too Large')
+                return
 
         if content_type == 'message/cpim':
             try:
@@ -733,7 +879,6 @@ class SimplePayload(object):
 class CPIMPayload(object):
     standard_namespace = u'urn:ietf:params:cpim-headers:'
 
-    headers_re = re.compile(r'(?:([^:]+?)\.)?(.+?):\s*(.+?)(?:\r\n|$)')
     subject_re = re.compile(r'^(?:;lang=([a-z]{1,8}(?:-[a-z0-9]{1,8})*)\s+)?(.*)$')
     namespace_re = re.compile(r'^(?:(\S+) ?)?<(.*)>$')
 
@@ -779,15 +924,14 @@ class CPIMPayload(object):
             else:
                 header_list.append(u'{0.name}: {0.value}'.format(header))
 
-        headers = '\r\n'.join(header.encode('cpim-header') for header in header_list)
+        headers = '\r\n'.join(CPIMCodec.encode(header)[0] for header in header_list)
 
-        mime_message = EmailMessage()
-        mime_message.set_payload(self.content)
-        mime_message.set_type(self.content_type)
         if self.charset is not None:
-            mime_message.set_param('charset', self.charset)
+            mime_headers = 'MIME-Version: 1.0\r\nContent-Type: {0.content_type}; charset="{0.charset}"'.format(self)
+        else:
+            mime_headers = 'MIME-Version: 1.0\r\nContent-Type: {0.content_type}'.format(self)
 
-        return headers + '\r\n\r\n' + mime_message.as_string(), 'message/cpim'
+        return headers + '\r\n\r\n' + mime_headers + '\r\n\r\n' + self.content, 'message/cpim'
 
     @classmethod
     def decode(cls, message):
@@ -809,14 +953,19 @@ class CPIMPayload(object):
         namespaces = {u'': CPIMNamespace(cls.standard_namespace)}
         subjects = {}
 
-        for prefix, name, value in cls.headers_re.findall(headers):
+        for line in headers.split('\r\n'):
+            name, separator, value = line.partition(':')
+            value = value.lstrip()
+            if not separator or not value:
+                continue
+            prefix, separator, name = name.rpartition('.')
             namespace = namespaces.get(prefix)
 
-            if namespace is None or '.' in name:
+            if namespace is None or not name or '.' in prefix:
                 continue
 
             try:
-                value = value.decode('cpim-header')
+                value = CPIMCodec.decode(value)[0]
                 if namespace == cls.standard_namespace:
                     if name == 'From':
                         sender = ChatIdentity.parse(value)
@@ -853,15 +1002,63 @@ class CPIMPayload(object):
         elif subjects:
             subject = MultilingualText(**subjects)
 
-        mime_message = EmailParser().parsestr(body)
-        content_type = mime_message.get_content_type()
-        if content_type is None:
-            raise CPIMParserError("CPIM message missing Content-Type MIME header")
-        content = mime_message.get_payload()
-        charset = mime_message.get_content_charset()
+        try:
+            content_type, charset, content = cls._decode_mime_body(body)
+        except ValueError:
+            mime_message = EmailParser().parsestr(body)
+            content_type = mime_message.get_content_type()
+            if content_type is None:
+                raise CPIMParserError("CPIM message missing Content-Type MIME header")
+            content = mime_message.get_payload()
+            charset = mime_message.get_content_charset()
 
         return cls(content, content_type, charset, sender, recipients, courtesy_recipients, subject, timestamp, required, additional_headers)
 
+    @classmethod
+    def _decode_mime_body(cls, body):
+        # Single pass parser for the encapsulated MIME message, that only looks at its Content-Type header and returns
+        # the content as a slice of the body. It raises ValueError for anything it cannot handle the same way as the
+        # email parser, which is used in that case.
+        content_type_header = None
+        last_header = None
+        position = 0
+        while True:
+            end = body.find('\n', position)
+            if end == -1:
+                raise ValueError('missing end of headers')
+            line = body[position:end].rstrip('\r')
+            position = end + 1
+            if not line:
+                break
+            elif line[0] in ' \t':
+                if last_header is None:
+                    raise ValueError('unexpected continuation line')
+                if last_header == 'content-type':
+                    content_type_header += ' ' + line.strip()
+            else:
+                name, separator, value = line.partition(':')
+                if not separator or not name or name != name.rstrip():
+                    raise ValueError('invalid header line')
+                last_header = name.lower()
+                if last_header == 'content-type' and content_type_header is None:
+                    content_type_header = value.strip()
+        if content_type_header is None:
+            return 'text/plain', None, body[position:]
+        parameters = content_type_header.split(';')
+        content_type = parameters.pop(0).strip().lower()
+        if content_type.count('/') != 1:
+            content_type = 'text/plain'
+        charset = None
+        for parameter in parameters:
+            name, separator, value = parameter.partition('=')
+            if name.strip().lower() == 'charset':
+                value = value.strip()
+                if '"' in value[1:-1] or '\\' in value:
+                    raise ValueError('complex charset parameter')
+                charset = value.strip('"').lower()
+                break
+        return content_type, charset, body[position:]
+
 
 class CPIMParserError(StandardError): pass
 
@@ -890,6 +1087,8 @@ class CPIMCodec(codecs.Codec):
 
     @classmethod
     def decode(cls, input, errors='strict'):
+        if '\\' not in input:
+            return input.decode('utf-8', errors), len(input)  # nothing is escaped
         return input.decode('utf-8', errors).encode('raw-unicode-escape', errors).decode('unicode-escape', errors), len(input)
 
 
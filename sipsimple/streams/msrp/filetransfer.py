@@ -15,6 +15,8 @@ import time
 import uuid
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from functools import partial
 from application.notification import NotificationCenter, NotificationData, IObserver
 from application.python.threadpool import ThreadPool, run_in_threadpool
 from application.python.types import MarkerType
@@ -24,7 +26,8 @@ from msrplib.protocol import MSRPHeader, FailureReportHeader, SuccessReportHeade
 from msrplib.session import MSRPSession
 from msrplib.transport import make_response
 from Queue import Queue
-from threading import Event, Lock
+from threading import Condition, Event, Lock
+from twisted.internet.interfaces import IPushProducer
 from zope.interface import implements
 
 from sipsimple.configuration.settings import SIPSimpleSettings
@@ -205,6 +208,95 @@ class FileTransfersMetadata(object):
         self.lock.release()
 
 
+class FileHashEntry(object):
+    __slots__ = 'offset', 'hash'
+
+    def __init__(self, offset, hash):
+        self.offset = offset
+        self.hash = hash
+
+
+class FileHashIndex(object):
+    """
+    Persistent index of the hashes computed for the files that are sent.
+    The entries are keyed on the path, size, modification time and inode of
+    the file, so a file that was changed never matches. Hashes that are
+    still being computed are saved as well, so that hashing can resume from
+    the last saved offset. The index file is a sequence of pickled records,
+    each new or updated entry being appended to it, and it is compacted
+    when loaded.
+    """
+
+    __filename__ = 'file_hashes'
+    __maxentries__ = 1000
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.loaded = False
+        self.directory = None
+
+    @staticmethod
+    def key_for(path, fd):
+        file_stat = os.fstat(fd.fileno())
+        return path, file_stat.st_size, file_stat.st_mtime, file_stat.st_ino
+
+    def get(self, key):
+        with self.lock:
+            self._load()
+            return self.data.get(key)
+
+    def update(self, key, offset, hash):
+        with self.lock:
+            self._load()
+            self.data.pop(key, None)
+            self.data[key] = entry = FileHashEntry(offset, hash.copy())
+            while len(self.data) > self.__maxentries__:
+                self.data.popitem(last=False)
+            self._save(pickle.dumps((key, entry.offset, entry.hash), protocol=2), mode='ab')
+
+    def _load(self):
+        if self.loaded:
+            return
+        from sipsimple.application import SIPApplication
+        if ISIPSimpleApplicationDataStorage.providedBy(SIPApplication.storage):
+            self.directory = SIPApplication.storage.directory
+        if self.directory is not None:
+            try:
+                f = open(os.path.join(self.directory, self.__filename__), 'rb')
+            except IOError:
+                pass
+            else:
+                with f:
+                    unpickler = pickle.Unpickler(f)
+                    while True:
+                        try:
+                            key, offset, hash = unpickler.load()
+                        except Exception:  # end of file or a record that was not completely written
+                            break
+                        self.data.pop(key, None)
+                        self.data[key] = FileHashEntry(offset, hash)
+                for key in self.data.keys():
+                    path, size, mtime, inode = key
+                    try:
+                        file_stat = os.stat(path)
+                    except OSError:
+                        del self.data[key]
+                    else:
+                        if (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino) != (size, mtime, inode):
+                            del self.data[key]
+                while len(self.data) > self.__maxentries__:
+                    self.data.popitem(last=False)
+                self._save(''.join(pickle.dumps((key, entry.offset, entry.hash), protocol=2) for key, entry in self.data.iteritems()), mode='wb')
+        self.loaded = True
+
+    @run_in_thread('file-io')
+    def _save(self, data, mode):
+        if self.directory is not None:
+            with open(os.path.join(self.directory, self.__filename__), mode) as f:
+                f.write(data)
+
+
 class FileTransferHandler(object):
     __metaclass__ = ABCMeta
 
@@ -309,6 +401,12 @@ class EndTransfer: __metaclass__ = MarkerType
 class IncomingFileTransferHandler(FileTransferHandler):
     metadata = FileTransfersMetadata()
 
+    # the received data is hashed on its own pool, as the transfers wait for the hashing to finish while they hold
+    # a thread from the file transfers pool and would otherwise deadlock when that pool is exhausted
+    hash_threadpool = ThreadPool(name='FileTransferHashes', min_threads=0, max_threads=100)
+    hash_threadpool.start()
+    hash_queue_size = 64
+
     def __init__(self):
         super(IncomingFileTransferHandler, self).__init__()
         self.hash = sha1()
@@ -345,7 +443,8 @@ class IncomingFileTransferHandler(FileTransferHandler):
                     else:
                         stream.file_selector.name = filename
                         unlink(prev_file.filename)
-                    stream.file_selector.fd = openfile(stream.file_selector.name, 'ab')  # open doesn't seek to END in append mode on win32 until first write, but openfile does
+                    stream.file_selector.fd = open(stream.file_selector.name, 'r+b')  # the chunks are written at their own position, so no append mode
+                    stream.file_selector.fd.seek(0, os.SEEK_END)
                     self.offset = stream.file_selector.fd.tell()
                     self.hash = prev_file.partial_hash
                 except (KeyError, EnvironmentError, ValueError):
@@ -367,52 +466,87 @@ class IncomingFileTransferHandler(FileTransferHandler):
 
     def process_chunk(self, chunk):
         if chunk.method == 'SEND':
-            if not self.received_chunks and chunk.byte_range[0] == 1:
-                self.stream.file_selector.fd.truncate(0)
-                self.stream.file_selector.fd.seek(0)
-                self.hash = sha1()
-                self.offset = 0
             self.received_chunks += 1
             self.queue.put(chunk)
         elif chunk.method == 'FILE_OFFSET':
             if self.received_chunks > 0:
                 response = make_response(chunk, 413, 'Unwanted message')
             else:
-                offset = self.stream.file_selector.fd.tell()
                 response = make_response(chunk, 200, 'OK')
-                response.headers['Offset'] = MSRPHeader('Offset', offset)
+                response.headers['Offset'] = MSRPHeader('Offset', self.offset)
             self.stream.msrp_session.send_chunk(response)
 
     @run_in_threadpool(FileTransferHandler.threadpool)
     def start(self):
+        # The received chunks are written at the position given by their byte range, in batches made of all the chunks
+        # that are waiting in the queue, while the data that extends the contiguous part of the file received so far is
+        # hashed on another thread. The offset is the size of that contiguous part.
         notification_center = NotificationCenter()
         notification_center.post_notification('FileTransferHandlerDidStart', sender=self)
         file_selector = self.stream.file_selector
         fd = file_selector.fd
 
-        while True:
-            chunk = self.queue.get()
-            if chunk is EndTransfer:
-                break
-            try:
-                fd.write(chunk.data)
-            except EnvironmentError, e:
-                fd.close()
-                notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
-                notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=str(e)))
-                return
-            self.hash.update(chunk.data)
-            self.offset += chunk.size
-            transferred_bytes = chunk.byte_range[0] + chunk.size - 1
-            total_bytes = file_selector.size = chunk.byte_range[2]
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
-            if transferred_bytes == total_bytes:
-                break
+        hash_queue = Queue(maxsize=self.hash_queue_size)
+        hash_done = Event()
+        self._hash_received_data(hash_queue, hash_done)
+        pending_chunks = {}
+        first_chunk = True
+        error = None
 
-        fd.close()
+        try:
+            if file_selector.size:
+                fd.truncate(file_selector.size)  # preallocate the file
+            while self.offset != file_selector.size:
+                chunk = self.queue.get()
+                if chunk is EndTransfer:
+                    break
+                chunks = [chunk]
+                while chunks[-1] is not EndTransfer and not self.queue.empty():
+                    chunks.append(self.queue.get())
+                if chunks[-1] is EndTransfer:
+                    chunks.pop()
+                    self.queue.put(EndTransfer)
+                if first_chunk and chunks[0].byte_range[0] == 1 and self.offset > 0:
+                    # the sender does not resume the transfer, so start over
+                    self.hash = sha1()
+                    self.offset = 0
+                first_chunk = False
+                for start, data in self._coalesce_chunks(chunks):
+                    fd.seek(start)
+                    fd.write(data)
+                for chunk in chunks:
+                    pending_chunks[chunk.byte_range[0] - 1] = chunk.data
+                    file_selector.size = chunk.byte_range[2]
+                while pending_chunks:
+                    contiguous = [(start, data) for start, data in pending_chunks.iteritems() if start <= self.offset]
+                    if not contiguous:
+                        break
+                    for start, data in sorted(contiguous):
+                        del pending_chunks[start]
+                        end = start + len(data)
+                        if end > self.offset:
+                            hash_queue.put(data[self.offset-start:] if start < self.offset else data)
+                            self.offset = end
+                notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=self.offset, total_bytes=file_selector.size))
+            fd.flush()
+        except EnvironmentError, e:
+            error = str(e)
+        finally:
+            hash_queue.put(EndTransfer)
+            hash_done.wait()
+            if self.offset != file_selector.size:
+                try:
+                    fd.truncate(self.offset)  # only keep the part of the file that was hashed, so the transfer can be resumed
+                except EnvironmentError:
+                    pass
+            fd.close()
 
         # Transfer is finished
 
+        if error is not None:
+            notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=error))
+            notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=error))
+            return
         if self.offset != self.stream.file_selector.size:
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason='Incomplete file'))
             return
@@ -423,6 +557,32 @@ class IncomingFileTransferHandler(FileTransferHandler):
 
         notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=False, reason=None))
 
+    @run_in_threadpool(hash_threadpool)
+    def _hash_received_data(self, hash_queue, hash_done):
+        while True:
+            data = hash_queue.get()
+            if data is EndTransfer:
+                break
+            self.hash.update(data)
+        hash_done.set()
+
+    @staticmethod
+    def _coalesce_chunks(chunks):
+        # join the data of the chunks that follow one another, so it can be written at once
+        start = position = None
+        parts = []
+        for chunk in chunks:
+            chunk_start = chunk.byte_range[0] - 1
+            if chunk_start != position and parts:
+                yield start, ''.join(parts)
+                parts = []
+            if not parts:
+                start = chunk_start
+            parts.append(chunk.data)
+            position = chunk_start + len(chunk.data)
+        if parts:
+            yield start, ''.join(parts)
+
     def _NH_MediaStreamDidNotInitialize(self, notification):
         if self.stream.file_selector.fd is not None:
             position = self.stream.file_selector.fd.tell()
@@ -443,17 +603,99 @@ class IncomingFileTransferHandler(FileTransferHandler):
         super(IncomingFileTransferHandler, self)._NH_FileTransferHandlerDidEnd(notification)
 
 
+class SendWindow(object):
+    """
+    Flow control for outgoing file transfers. It limits the number of bytes
+    that were sent but not yet answered by the remote party. As the push
+    producer of the transport, it also stops the data while the transport
+    has more buffered than it can write.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = 0
+        self.paused = False
+        self.closed = False
+        self._condition = Condition()
+
+    def acquire(self, amount):
+        """
+        Wait until amount bytes fit in the window and account for them as being
+        in flight. Returns False if the window was closed in the meantime.
+        """
+        with self._condition:
+            while not self.closed and (self.paused or (self.in_flight and self.in_flight + amount > self.size)):
+                self._condition.wait()
+            if self.closed:
+                return False
+            self.in_flight += amount
+            return True
+
+    def release(self, amount):
+        with self._condition:
+            self.in_flight -= amount
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def pauseProducing(self):
+        with self._condition:
+            self.paused = True
+
+    def resumeProducing(self):
+        with self._condition:
+            self.paused = False
+            self._condition.notify_all()
+
+    def stopProducing(self):
+        self.close()
+
+
 class OutgoingFileTransferHandler(FileTransferHandler):
     file_part_size = 64*1024
+    send_window_size = 1024*1024
+    hash_block_size = 1024*1024
+    hash_checkpoint_size = 64*1024*1024
+
+    hash_index = FileHashIndex()
 
     def __init__(self):
         super(OutgoingFileTransferHandler, self).__init__()
         self.stop_event = Event()
         self.finished_event = Event()
         self.file_offset_event = Event()
+        self.hash_event = Event()
         self.message_id = '%x' % random.getrandbits(64)
         self.offset = 0
         self.headers = {}
+        self.send_window = SendWindow(self.send_window_size)
+        self.acknowledged_bytes = 0
+        self.start_time = None
+        self._producer_transport = None
+        self._hash_lock = Lock()
+        self._hash_started = False
+        self._hash_failure = None
+
+    @property
+    def statistics(self):
+        elapsed = time.time() - self.start_time if self.start_time is not None else 0
+        return dict(sent_bytes=self.offset, acknowledged_bytes=self.acknowledged_bytes, in_flight_bytes=self.send_window.in_flight,
+                    window_size=self.send_window.size, throughput=self.acknowledged_bytes/elapsed if elapsed > 0 else 0)
+
+    def prepare(self, file_selector):
+        """Start calculating the hash of the file, if needed, ahead of the stream being initialized"""
+        if file_selector.fd is None or not file_selector.size or file_selector.hash is not None:
+            return
+        with self._hash_lock:
+            if self._hash_started:
+                return
+            self._hash_started = True
+        self._calculate_file_hash(file_selector)
 
     def initialize(self, stream, session):
         super(OutgoingFileTransferHandler, self).initialize(stream, session)
@@ -468,48 +710,83 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         self.headers[SuccessReportHeader.name] = SuccessReportHeader('yes')
         self.headers[FailureReportHeader.name] = FailureReportHeader('yes')
 
-        if stream.file_selector.hash is None:
-            self._calculate_file_hash()
+        self.prepare(stream.file_selector)
+        if self._hash_started:
+            self._wait_for_file_hash()
         else:
             NotificationCenter().post_notification('FileTransferHandlerDidInitialize', sender=self)
 
     @run_in_threadpool(FileTransferHandler.threadpool)
-    def _calculate_file_hash(self):
-        file_hash = hashlib.sha1()
-        processed = 0
-
+    def _calculate_file_hash(self, file_selector):
         notification_center = NotificationCenter()
-        notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=0, total=self.stream.file_selector.size))
-
-        file_selector = self.stream.file_selector
         fd = file_selector.fd
+        try:
+            key = self.hash_index.key_for(file_selector.name, fd)
+        except EnvironmentError, e:
+            self._hash_failure = str(e)
+            self.hash_event.set()
+            return
+        entry = self.hash_index.get(key)
+        if entry is not None:
+            file_hash, processed = entry.hash.copy(), entry.offset
+        else:
+            file_hash, processed = sha1(), 0
+        checkpoint = processed
+
+        notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size))
+
+        try:
+            fd.seek(processed)
+        except EnvironmentError, e:
+            fd.close()
+            self._hash_failure = str(e)
+            self.hash_event.set()
+            return
+
+        # the file is read in large blocks, which always start at an offset that is a multiple of the block size
         while not self.stop_event.is_set():
             try:
-                content = fd.read(self.file_part_size)
+                content = fd.read(self.hash_block_size)
             except EnvironmentError, e:
                 fd.close()
-                notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason=str(e)))
-                return
+                self._hash_failure = str(e)
+                break
             if not content:
                 file_selector.hash = file_hash
-                notification_center.post_notification('FileTransferHandlerDidInitialize', sender=self)
+                self.hash_index.update(key, processed, file_hash)
                 break
             file_hash.update(content)
             processed += len(content)
+            if processed - checkpoint >= self.hash_checkpoint_size:
+                self.hash_index.update(key, processed, file_hash)
+                checkpoint = processed
             notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size))
         else:
             fd.close()
-            notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason='Interrupted transfer'))
+            self._hash_failure = 'Interrupted transfer'
+        self.hash_event.set()
+
+    @run_in_threadpool(FileTransferHandler.threadpool)
+    def _wait_for_file_hash(self):
+        self.hash_event.wait()
+        if self._hash_failure is None:
+            NotificationCenter().post_notification('FileTransferHandlerDidInitialize', sender=self)
+        else:
+            NotificationCenter().post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason=self._hash_failure))
 
     def end(self):
         self.stop_event.set()
         self.file_offset_event.set()    # in case we are busy waiting on it
+        self.send_window.close()        # or on the send window
 
     @run_in_threadpool(FileTransferHandler.threadpool)
     def start(self):
         notification_center = NotificationCenter()
         notification_center.post_notification('FileTransferHandlerDidStart', sender=self)
 
+        self.start_time = time.time()
+        self._register_producer()
+
         if self.stream.file_offset_supported:
             self._send_file_offset_chunk()
             self.file_offset_event.wait()
@@ -529,6 +806,8 @@ class OutgoingFileTransferHandler(FileTransferHandler):
                 if not data:
                     finished = True
                     break
+                if not self.send_window.acquire(len(data)):
+                    break
                 self._send_chunk(data)
         finally:
             fd.close()
@@ -544,18 +823,38 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         else:
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason='Incomplete transfer'))
 
-    def _on_transaction_response(self, response):
+    @run_in_twisted_thread
+    def _register_producer(self):
+        # the transport pauses the send window when its write buffer fills up and resumes it once it was drained
+        try:
+            transport = self.stream.msrp.transport
+            transport.registerProducer(self.send_window, True)
+        except (AttributeError, RuntimeError):  # no transport or another producer is already registered
+            pass
+        else:
+            self._producer_transport = transport
+
+    def _unregister_producer(self):
+        if self._producer_transport is not None:
+            self._producer_transport.unregisterProducer()
+            self._producer_transport = None
+
+    def _on_transaction_response(self, size, response):
+        self.send_window.release(size)
         if self.stop_event.is_set():
             return
         if response.code != 200:
             NotificationCenter().post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=response.comment))
             self.end()
+        else:
+            self.acknowledged_bytes += size
 
     @run_in_twisted_thread
     def _send_chunk(self, data):
+        data_len = len(data)
         if self.stop_event.is_set():
+            self.send_window.release(data_len)
             return
-        data_len = len(data)
         chunk = self.stream.msrp.make_send_request(message_id=self.message_id,
                                                    data=data,
                                                    start=self.offset+1,
@@ -563,8 +862,9 @@ class OutgoingFileTransferHandler(FileTransferHandler):
                                                    length=self.stream.file_selector.size)
         chunk.headers.update(self.headers)
         try:
-            self.stream.msrp_session.send_chunk(chunk, response_cb=self._on_transaction_response)
+            self.stream.msrp_session.send_chunk(chunk, response_cb=partial(self._on_transaction_response, data_len))
         except Exception, e:
+            self.send_window.release(data_len)
             NotificationCenter().post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
         else:
             self.offset += data_len
@@ -596,7 +896,8 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         if chunk.status.code == 200:
             transferred_bytes = chunk.byte_range[1]
             total_bytes = chunk.byte_range[2]
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
+            throughput = self.statistics['throughput']
+            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes, throughput=throughput))
             if transferred_bytes == total_bytes:
                 self.finished_event.set()
                 self.end()
@@ -604,6 +905,10 @@ class OutgoingFileTransferHandler(FileTransferHandler):
             notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=chunk.status.comment))
             self.end()
 
+    def _NH_FileTransferHandlerDidEnd(self, notification):
+        self._unregister_producer()
+        super(OutgoingFileTransferHandler, self)._NH_FileTransferHandlerDidEnd(notification)
+
 
 class FileTransferMSRPSession(MSRPSession):
     def _handle_incoming_FILE_OFFSET(self, chunk):
@@ -630,6 +935,7 @@ class FileTransferStream(MSRPStreamBase):
         self.transfer_id = transfer_id if transfer_id is not RandomID else str(uuid.uuid4())
         if direction == 'sendonly':
             self.handler = self.OutgoingTransferHandler()
+            self.handler.prepare(file_selector)  # hash the file while the session is being set up
         else:
             self.handler = self.IncomingTransferHandler()
 
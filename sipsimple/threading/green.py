@@ -1,13 +1,13 @@
 
 """Green thread utilities"""
 
-__all__ = ["Command", "InterruptCommand", "run_in_green_thread", "run_in_waitable_green_thread", "call_in_green_thread", "Worker"]
+__all__ = ["Command", "InterruptCommand", "run_in_green_thread", "run_in_waitable_green_thread", "call_in_green_thread", "race", "Worker"]
 
 import sys
 
 from application.python.decorator import decorator, preserve_signature
 from datetime import datetime
-from eventlib import coros
+from eventlib import coros, proc
 from eventlib.twistedutil import callInGreenThread
 from twisted.python import threadable
 
@@ -94,6 +94,86 @@ def run_in_waitable_green_thread(func):
     return wrapper
 
 
+def race(func, items, stagger=None, failures=(Exception,), cleanup=None):
+    """
+    Calls func for each of the items in a separate green thread and returns a
+    tuple with the item and the result of the first call that succeeds. The
+    calls are started in order, each one after the previous call failed or
+    after stagger seconds passed, whichever comes first. If stagger is None
+    the calls are made one after the other.
+
+    A call fails by raising one of the exceptions in failures, in which case
+    the next item is tried. If all the calls fail, the exception of the last
+    one is raised. Any other exception raised by a call ends the race and is
+    propagated. The calls which are still running when the race ends are
+    allowed to complete and cleanup is called with the item and the result
+    of every one of them that succeeds.
+
+    This function must be called from a green thread in the IO thread.
+    """
+    from twisted.internet import reactor
+    items = list(items)
+    if not items:
+        raise ValueError("no items to race")
+    results = coros.queue()
+    running = set()
+    def run(index):
+        try:
+            result = func(items[index])
+        except:
+            results.send((index, None, sys.exc_info()))
+        else:
+            results.send((index, result, None))
+    def start(index):
+        running.add(index)
+        proc.spawn(run, index)
+    def wait_for_others(count):
+        while count > 0:
+            index, result, exc_info = results.wait()
+            if index is None:
+                continue
+            count -= 1
+            if exc_info is None and cleanup is not None:
+                cleanup(items[index], result)
+    timer = None
+    next_index = 0
+    failure = None
+    try:
+        while True:
+            if not running:
+                if next_index == len(items):
+                    raise failure[0], failure[1], failure[2]
+                start(next_index)
+                next_index += 1
+            if stagger is not None and timer is None and next_index < len(items):
+                timer = reactor.callLater(stagger, results.send, (None, next_index, None))
+            index, result, exc_info = results.wait()
+            if index is None:
+                # the stagger interval elapsed, unless this is a leftover from a timer which was replaced
+                if result == next_index:
+                    timer = None
+                    start(next_index)
+                    next_index += 1
+                continue
+            running.discard(index)
+            if exc_info is None:
+                return items[index], result
+            elif not isinstance(exc_info[1], failures):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            failure = exc_info
+            if timer is not None and timer.active():
+                timer.cancel()
+            timer = None
+            if next_index < len(items):
+                start(next_index)
+                next_index += 1
+    finally:
+        if timer is not None and timer.active():
+            timer.cancel()
+        if running:
+            proc.spawn(wait_for_others, len(running))
+
+
 class Worker(object):
     def __init__(self, func, *args, **kw):
         self.func = func
@@ -7,13 +7,14 @@ __all__ = ["All", "Any", "ExponentialTimer", "ISOTimestamp", "MultilingualText",
 
 import os
 import platform
+import re
 import sys
 import dateutil.parser
 
 from application.notification import NotificationCenter
 from application.python.types import Singleton, MarkerType
 from datetime import datetime
-from dateutil.tz import tzlocal, tzutc
+from dateutil.tz import tzlocal, tzoffset, tzutc
 from twisted.internet import reactor
 
 from sipsimple.util._sha1 import sha1
@@ -31,12 +32,29 @@ class Any(object):
 
 
 class ISOTimestamp(datetime):
+    _format_re = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?(?:(Z)|([+-])(\d{2}):(\d{2}))?$')
+
     def __new__(cls, *args, **kw):
         if len(args) == 1:
             value = args[0]
             if isinstance(value, cls):
                 return value
             elif isinstance(value, basestring):
+                match = cls._format_re.match(value)
+                if match is not None:
+                    # fast path for the fixed format used by ISO 8601 timestamps on the wire
+                    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+                    if utc is not None:
+                        tzinfo = tzutc()
+                    elif sign is not None:
+                        offset = (int(offset_hours)*60 + int(offset_minutes)) * 60 * (-1 if sign == '-' else 1)
+                        tzinfo = tzoffset(None, offset) if offset else tzutc()
+                    else:
+                        tzinfo = None
+                    try:
+                        return datetime.__new__(cls, int(year), int(month), int(day), int(hour), int(minute), int(second), int(fraction.ljust(6, '0')) if fraction else 0, tzinfo)
+                    except ValueError:
+                        pass
                 value = dateutil.parser.parse(value)
                 return cls(value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond, value.tzinfo)
             elif isinstance(value, datetime):
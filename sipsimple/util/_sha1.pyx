@@ -23,7 +23,7 @@ cdef extern from "_sha1.h":
         uint32_t index                      # index into buffer
 
     cdef void sha1_init(sha1_context *context)
-    cdef void sha1_update(sha1_context *context, const uint8_t *data, size_t length)
+    cdef void sha1_update(sha1_context *context, const uint8_t *data, size_t length) nogil
     cdef void sha1_digest(sha1_context *context, uint8_t *digest)
 
 
@@ -72,8 +72,14 @@ cdef class sha1(object):
         if PyObject_CheckBuffer(data):
             PyObject_GetBuffer(data, &view, 0)
             if view.ndim > 1:
+                PyBuffer_Release(&view)
                 raise BufferError('Buffer must be single dimension')
-            sha1_update(&self.context, <uint8_t*>view.buf, view.len)
+            if view.len >= 2048:
+                # release the GIL for large buffers, so that multiple files can be hashed in parallel
+                with nogil:
+                    sha1_update(&self.context, <uint8_t*>view.buf, view.len)
+            else:
+                sha1_update(&self.context, <uint8_t*>view.buf, view.len)
             PyBuffer_Release(&view)
         elif PyUnicode_Check(data):
             raise TypeError('Unicode-objects must be encoded before hashing')